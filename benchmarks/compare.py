@@ -0,0 +1,70 @@
+"""
+Compare two benchmark result files and flag regressions.
+
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 0.2]
+
+Exits with status 1 when any benchmark got slower, used more memory or
+produced a larger payload than the baseline by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+# Métricas comparadas y mínimo absoluto por debajo del cual se ignora el cambio (ruido)
+METRICS = {
+    "seconds": 0.005,
+    "peak_bytes": 64 * 1024,
+    "payload_bytes": 1024,
+}
+
+
+def compare(baseline, candidate, threshold):
+    """
+    Return one row per benchmark and metric present in both result files
+    """
+    base = {r["name"]: r for r in baseline["results"]}
+    rows = []
+    for result in candidate["results"]:
+        previous = base.get(result["name"])
+        if previous is None:
+            continue
+        for metric, floor in METRICS.items():
+            old, new = previous.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            rows.append({
+                "name": result["name"],
+                "metric": metric,
+                "baseline": old,
+                "candidate": new,
+                "change": change,
+                "regression": change > threshold and new - old > floor,
+            })
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative increase considered a regression")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows = compare(baseline, candidate, args.threshold)
+    for row in rows:
+        flag = "REGRESIÓN" if row["regression"] else ""
+        print(f"{row['name']:<75} {row['metric']:<14} {row['baseline']:>14.4g} -> {row['candidate']:<14.4g} {row['change']:+7.1%} {flag}")
+
+    regressions = [row for row in rows if row["regression"]]
+    print(f"{len(regressions)} regresiones de {len(rows)} métricas comparadas")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
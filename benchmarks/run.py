@@ -0,0 +1,220 @@
+"""
+Benchmark harness for the `DataManager` getters and the `ui.charts` builders.
+
+Runs every getter on a synthetic CDM (see `benchmarks.synthetic_cdm`) with
+all caches cold, then builds every chart from the getter's result (cold
+and from the figure cache), and writes latency, peak Python memory and
+payload size to a JSON file that `benchmarks.compare` can diff across
+commits.
+
+    python -m benchmarks.run --persons 10k [--repeat 3] [--output results.json]
+
+Requires duckdb and duckdb_engine. Peak memory is measured with
+tracemalloc, so it covers Python allocations (DataFrames, figures) but not
+the database engine itself.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.synthetic_cdm import add_episodes, build, parse_scale
+
+# (getter, argumentos, constructor de gráfica con sus argumentos extra)
+BENCHMARKS = [
+    ("get_count_patients", (), ("create_big_number", ())),
+    ("get_sex", (), ("create_pie_chart", ())),
+    ("get_gender_concepts", (), None),
+    ("get_race", (), ("create_pie_chart", ())),
+    ("get_ethnicity", (), ("create_pie_chart", ())),
+    ("get_age_at_first_seen", (1,), ("create_histogram_bar_chart", (1,))),
+    ("get_year_of_birth_patients", (1,), ("create_histogram_bar_chart", (1,))),
+    ("get_conditions_per_person", (), ("create_treemap_conditions", ())),
+    ("get_domain_month_counts", (), None),
+    ("get_data_density_total_rows", (), ("create_line_chart_time", ())),
+    ("get_avg_records_per_person_per_month", (), ("create_line_chart_time", ())),
+    ("get_records_per_person_per_domain", (True,), ("create_box_plot", ())),
+    ("get_records_per_person_per_domain", (False,), ("create_box_plot", ())),
+    ("get_visits_concepts", (), ("create_bar_chart", ())),
+    ("get_visits_duration", (), ("create_big_number", ())),
+    ("get_visit_type_concept_id", (), ("create_bar_chart", ())),
+    ("get_domain_summary", ("condition",), None),
+    ("get_domain_top_concepts", ("condition",), ("create_treemap_conditions", ())),
+    ("get_domain_monthly_trend", ("condition",), ("create_line_chart_time", ())),
+    ("get_domain_records_per_person", ("condition",), ("create_box_plot", ())),
+    ("get_domain_type_breakdown", ("condition",), ("create_pie_chart", ())),
+    ("get_pregnancy_episode_count", (), ("create_big_number", ())),
+    ("get_pregnancy_outcomes", (), ("create_pie_chart", ())),
+    ("get_pregnancy_gestational_age", (), ("create_bar_chart", ())),
+    ("get_pregnancy_episodes_per_month", (), ("create_line_chart_time", ())),
+    ("get_person_timeline", (1,), ("create_timeline_chart", ())),
+]
+
+SOURCE = "bench"
+
+
+def _configure(db_path, schema):
+    """
+    Point the dashboard at the synthetic CDM, with persistence disabled so
+    every run measures the database; must run before importing `database`
+    """
+    config = Path(tempfile.mkdtemp(prefix="omop_bench_")) / "config.toml"
+    config.write_text(
+        f'[sources.{SOURCE}]\n'
+        f'schema = "{schema}"\n'
+        f'url_env = "BENCH_DATABASE_URL"\n'
+        f'results_schema = "{schema}_results"\n'
+    )
+    os.environ["DASHBOARD_CONFIG"] = str(config)
+    os.environ["BENCH_DATABASE_URL"] = f"duckdb:///{Path(db_path).resolve()}"
+    os.environ["RESULT_CACHE"] = "none"
+    os.environ["SHARED_CACHE"] = "none"
+    os.environ["CDM_VERSION"] = "bench"
+
+
+def _label(name, args):
+    return f"{name}({', '.join(repr(a) for a in args)})"
+
+
+def _measure(fn, repeat, reset):
+    """
+    Return median seconds over `repeat` cold calls, the peak traced memory
+    of one extra call, and the last result
+    """
+    seconds = []
+    for _ in range(repeat):
+        reset()
+        start = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - start)
+
+    reset()
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(seconds), peak, result
+
+
+def _chart_result(charts, builder, chart_args, df, label, repeat):
+    """
+    Return the result of building a chart from `df`, cold and warm
+    """
+    build_chart = getattr(charts, builder)
+    seconds, peak, fig = _measure(lambda: build_chart(df, *chart_args), repeat, charts.clear_figure_cache)
+    start = time.perf_counter()
+    build_chart(df, *chart_args)
+    warm = time.perf_counter() - start
+    payload = len(fig.to_json()) if fig is not None else 0
+    print(f"  {builder}: {seconds * 1000:.1f} ms, {payload:,} bytes de JSON")
+    return {
+        "name": f"{_label(builder, chart_args)} <- {label}",
+        "kind": "chart",
+        "seconds": seconds,
+        "warm_seconds": warm,
+        "peak_bytes": peak,
+        "payload_bytes": payload,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(persons, repeat, db_path=None, schema="cdm"):
+    """
+    Return the benchmark results for a synthetic CDM of `persons` persons
+    """
+    db_path = db_path or f"benchmarks/data/cdm_{persons}.duckdb"
+    if not Path(db_path).exists():
+        print(f"Generando CDM sintético de {persons:,} personas en {db_path}...")
+        build(db_path, persons, schema)
+    else:
+        add_episodes(db_path, schema)
+
+    _configure(db_path, schema)
+
+    import streamlit as st
+    from database.db_manager import DataManager
+    from database.instrumentation import get_records
+    from ui import charts
+
+    def clear_caches():
+        st.cache_data.clear()
+        DataManager.get_concept_names().clear()
+        DataManager.get_person_timelines().clear()
+
+    data_manager = DataManager()
+    results = []
+    for getter, args, chart in BENCHMARKS:
+        label = _label(getter, args)
+        method = getattr(data_manager, getter)
+        seconds, peak, df = _measure(lambda: method(*args, source=SOURCE), repeat, clear_caches)
+        start = time.perf_counter()
+        method(*args, source=SOURCE)
+        warm = time.perf_counter() - start
+        # get_person_timeline devuelve un Timeline: se mide como el DataFrame que dibuja la gráfica
+        if not hasattr(df, "memory_usage"):
+            df = df.to_frame()
+        results.append({
+            "name": label,
+            "kind": "getter",
+            "seconds": seconds,
+            "warm_seconds": warm,
+            "peak_bytes": peak,
+            "rows": len(df),
+            "payload_bytes": int(df.memory_usage(deep=True).sum()),
+        })
+        print(f"{label}: {seconds * 1000:.1f} ms, {len(df):,} filas")
+
+        if chart is not None:
+            results.append(_chart_result(charts, *chart, df, label, repeat))
+
+    # La página de rendimiento dibuja los tiempos registrados por los getters
+    results.append(_chart_result(charts, "create_latency_histogram", (), get_records(), "get_records()", repeat))
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "persons": persons,
+            "repeat": repeat,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard getters and charts")
+    parser.add_argument("--persons", default="10k", help="number of persons or a scale name (10k, 1m, 10m)")
+    parser.add_argument("--repeat", type=int, default=3, help="cold runs per benchmark (median is reported)")
+    parser.add_argument("--db", help="existing synthetic CDM to reuse")
+    parser.add_argument("--output", help="JSON file (default: benchmarks/results/<commit>-<persons>.json)")
+    args = parser.parse_args(argv)
+
+    persons = parse_scale(args.persons)
+    report = run(persons, args.repeat, args.db)
+
+    commit = (report["meta"]["commit"] or "nocommit")[:12]
+    output = Path(args.output or f"benchmarks/results/{commit}-{args.persons.lower()}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Resultados en {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""
+Synthetic OMOP CDM stand-in for benchmarks.
+
+Builds an OMOP-shaped DuckDB database with the tables and columns the
+dashboard reads, at a configurable number of persons, plus a pregnancy
+episode table in its results schema. Every value is
+derived from hash() of the row number, so the same scale always produces
+the same data.
+
+    python -m benchmarks.synthetic_cdm --persons 10k --output benchmarks/data/cdm_10k.duckdb
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Escalas con nombre aceptadas por --persons
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+
+# Eventos por persona (media) y tamaño del vocabulario sintético de cada tabla de eventos
+EVENT_TABLES = {
+    # tabla: (id, concepto, fecha, tipo, eventos por persona, conceptos, primer concept_id)
+    "condition_occurrence": ("condition_occurrence_id", "condition_concept_id", "condition_start_date", "condition_type_concept_id", 20, 2000, 1_000_000),
+    "measurement": ("measurement_id", "measurement_concept_id", "measurement_date", "measurement_type_concept_id", 60, 1000, 2_000_000),
+    "observation": ("observation_id", "observation_concept_id", "observation_date", "observation_type_concept_id", 15, 500, 3_000_000),
+    "procedure_occurrence": ("procedure_occurrence_id", "procedure_concept_id", "procedure_date", "procedure_type_concept_id", 15, 1000, 4_000_000),
+    "drug_exposure": ("drug_exposure_id", "drug_concept_id", "drug_exposure_start_date", "drug_type_concept_id", 25, 1500, 5_000_000),
+    "device_exposure": ("device_exposure_id", "device_concept_id", "device_exposure_start_date", "device_type_concept_id", 2, 100, 6_000_000),
+}
+
+# Conceptos fijos usados por person y visit_occurrence
+FIXED_CONCEPTS = [
+    (8532, "FEMALE", "Gender"), (8507, "MALE", "Gender"),
+    (8527, "White", "Race"), (8516, "Black or African American", "Race"), (8515, "Asian", "Race"), (0, "No matching concept", "Metadata"),
+    (38003564, "Not Hispanic or Latino", "Ethnicity"), (38003563, "Hispanic or Latino", "Ethnicity"),
+    (9201, "Inpatient Visit", "Visit"), (9202, "Outpatient Visit", "Visit"), (9203, "Emergency Room Visit", "Visit"),
+    (32817, "EHR", "Type Concept"), (32827, "EHR encounter record", "Type Concept"), (44818517, "Visit derived from encounter on claim", "Type Concept"),
+]
+
+# Fechas de eventos entre 2010 y ~2023
+FIRST_DATE = "2010-01-01"
+DAYS_SPAN = 5000
+
+
+def _uniform(expr, salt):
+    # Uniforme determinista en [0, 1) a partir de hash()
+    return f"((hash({expr}, {salt}) % 1000000) / 1000000.0)"
+
+
+def build(path, persons, schema="cdm"):
+    """
+    Create (or replace) the synthetic CDM at `path` and return the row count of each table
+    """
+    if duckdb is None:
+        raise RuntimeError("duckdb no está instalado: pip install duckdb duckdb_engine")
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.unlink(missing_ok=True)
+
+    con = duckdb.connect(str(path))
+    con.execute(f"CREATE SCHEMA {schema}")
+
+    con.execute(f"""
+        CREATE TABLE {schema}.person AS
+        SELECT
+            i AS person_id,
+            CASE WHEN {_uniform('i', 1)} < 0.9 THEN 8532 ELSE 8507 END AS gender_concept_id,
+            1940 + (hash(i, 2) % 70)::INT AS year_of_birth,
+            make_timestamp(1940 + (hash(i, 2) % 70)::INT, 1 + (hash(i, 3) % 12)::INT, 1 + (hash(i, 4) % 28)::INT, 0, 0, 0) AS birth_datetime,
+            ([8527, 8516, 8515, 0])[1 + (hash(i, 5) % 4)::INT] AS race_concept_id,
+            ([38003564, 38003563])[1 + (hash(i, 6) % 2)::INT] AS ethnicity_concept_id
+        FROM range(1, {persons} + 1) t(i)
+        """)
+
+    con.execute(f"""
+        CREATE TABLE {schema}.observation_period AS
+        SELECT
+            person_id AS observation_period_id,
+            person_id,
+            DATE '{FIRST_DATE}' + (hash(person_id, 7) % 1000)::INT AS observation_period_start_date,
+            DATE '{FIRST_DATE}' + {DAYS_SPAN} AS observation_period_end_date
+        FROM {schema}.person
+        """)
+
+    concepts = ", ".join(f"({cid}, '{name}', '{domain}')" for cid, name, domain in FIXED_CONCEPTS)
+    con.execute(f"""
+        CREATE TABLE {schema}.concept AS
+        SELECT * FROM (VALUES {concepts}) t(concept_id, concept_name, domain_id)
+        """)
+
+    for table, (id_col, concept_col, date_col, type_col, per_person, n_concepts, first_id) in EVENT_TABLES.items():
+        domain = table.split("_")[0].capitalize()
+        con.execute(f"""
+            INSERT INTO {schema}.concept
+            SELECT {first_id} + k, '{domain} concept ' || k, '{domain}'
+            FROM range({n_concepts}) t(k)
+            """)
+        # Conceptos con sesgo tipo Zipf: unos pocos concentran la mayoría de registros
+        con.execute(f"""
+            CREATE TABLE {schema}.{table} AS
+            SELECT
+                i AS {id_col},
+                1 + (hash(i, 11) % {persons}) AS person_id,
+                {first_id} + floor(pow({_uniform('i', 12)}, 3) * {n_concepts})::INT AS {concept_col},
+                DATE '{FIRST_DATE}' + (hash(i, 13) % {DAYS_SPAN})::INT AS {date_col},
+                32817 AS {type_col}
+            FROM range(1, {persons * per_person} + 1) t(i)
+            """)
+
+    con.execute(f"""
+        CREATE TABLE {schema}.visit_occurrence AS
+        SELECT
+            i AS visit_occurrence_id,
+            1 + (hash(i, 21) % {persons}) AS person_id,
+            ([9202, 9202, 9202, 9201, 9203])[1 + (hash(i, 22) % 5)::INT] AS visit_concept_id,
+            ([32817, 32827, 44818517])[1 + (hash(i, 23) % 3)::INT] AS visit_type_concept_id,
+            DATE '{FIRST_DATE}' + (hash(i, 24) % {DAYS_SPAN})::INT AS visit_start_date,
+            CAST(DATE '{FIRST_DATE}' + (hash(i, 24) % {DAYS_SPAN})::INT AS TIMESTAMP) AS visit_start_datetime,
+            CAST(DATE '{FIRST_DATE}' + (hash(i, 24) % {DAYS_SPAN})::INT AS TIMESTAMP)
+                + to_hours((hash(i, 25) % 240)::INT) AS visit_end_datetime
+        FROM range(1, {persons * 20} + 1) t(i)
+        """)
+
+    con.execute(f"""
+        CREATE TABLE {schema}.death AS
+        SELECT
+            person_id,
+            DATE '{FIRST_DATE}' + (hash(person_id, 31) % {DAYS_SPAN})::INT AS death_date,
+            32817 AS death_type_concept_id,
+            0 AS cause_concept_id
+        FROM {schema}.person
+        WHERE {_uniform('person_id', 32)} < 0.05
+        """)
+
+    con.execute(f"""
+        CREATE TABLE {schema}.cdm_source AS
+        SELECT 'v5.4' AS cdm_version, DATE '2024-01-01' AS cdm_release_date, 'synthetic-{persons}' AS vocabulary_version
+        """)
+
+    _create_episodes(con, schema)
+
+    counts = {
+        table: con.execute(f"SELECT count(*) FROM {schema}.{table}").fetchone()[0]
+        for (table,) in con.execute(
+            "SELECT table_name FROM information_schema.tables WHERE table_schema = ? ORDER BY 1", [schema]
+        ).fetchall()
+    }
+    con.close()
+    return counts
+
+
+def _create_episodes(con, schema):
+    # Sustituto de la salida de database.pregnancy: un episodio para ~10% de las mujeres
+    con.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}_results")
+    con.execute(f"""
+        CREATE TABLE {schema}_results.pregnancy_episode AS
+        SELECT
+            person_id,
+            1 AS episode_number,
+            episode_end_date - gestational_age_days AS episode_start_date,
+            episode_end_date,
+            outcome,
+            gestational_age_days,
+            'typical' AS gestation_source
+        FROM (
+            SELECT
+                person_id,
+                DATE '{FIRST_DATE}' + (hash(person_id, 41) % {DAYS_SPAN})::INT AS episode_end_date,
+                (['LB', 'LB', 'LB', 'LB', 'SA', 'AB', 'SB', 'ECT', 'PREG'])[1 + (hash(person_id, 42) % 9)::INT] AS outcome,
+                (50 + hash(person_id, 43) % 250)::INT AS gestational_age_days
+            FROM {schema}.person
+            WHERE gender_concept_id = 8532 AND {_uniform('person_id', 44)} < 0.1
+        ) episodes
+        """)
+
+
+def add_episodes(path, schema="cdm"):
+    """
+    Add the synthetic pregnancy episode table to a CDM built before it existed
+    """
+    if duckdb is None:
+        raise RuntimeError("duckdb no está instalado: pip install duckdb duckdb_engine")
+
+    con = duckdb.connect(str(path))
+    try:
+        exists = con.execute(
+            "SELECT count(*) FROM information_schema.tables WHERE table_schema = ? AND table_name = 'pregnancy_episode'",
+            [f"{schema}_results"],
+        ).fetchone()[0]
+        if not exists:
+            _create_episodes(con, schema)
+    finally:
+        con.close()
+
+
+def parse_scale(value):
+    """
+    Return the number of persons for a scale name (10k, 1m, ...) or a plain integer
+    """
+    return SCALES[value.lower()] if value.lower() in SCALES else int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a synthetic OMOP CDM in DuckDB")
+    parser.add_argument("--persons", default="10k", help=f"number of persons or one of {', '.join(SCALES)}")
+    parser.add_argument("--output", help="DuckDB file (default: benchmarks/data/cdm_<persons>.duckdb)")
+    parser.add_argument("--schema", default="cdm")
+    args = parser.parse_args(argv)
+
+    output = args.output or f"benchmarks/data/cdm_{args.persons.lower()}.duckdb"
+    start = time.perf_counter()
+    counts = build(output, parse_scale(args.persons), args.schema)
+    for table, rows in counts.items():
+        print(f"{args.schema}.{table}: {rows:,}")
+    print(f"{output} generado en {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+"""
+Persistent result cache for `DataManager`.
+
+`st.cache_data` only lives in process memory, so every restart pays for the
+heavy CDM queries again. The backends here keep query results on disk,
+keyed by the SQL, the CDM source and the CDM version stamp, so a restarted
+server serves warm results immediately.
+
+Several replicas share results through a second tier (SHARED_CACHE): a
+Redis server, or `MemoryCache`, an in-process stand-in with the same
+behaviour for tests. The Parquet directory can also be shared by pointing
+RESULT_CACHE_DIR at a common volume.
+"""
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+try:
+    import pyarrow  # noqa: F401 - requerido por DataFrame.to_parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+import pandas as pd
+
+logger = logging.getLogger("omop_dashboard")
+
+
+def cache_key(query, source, version):
+    """
+    Return the cache key of a query for a given CDM source and version
+    """
+    payload = "\x1f".join([source, version, " ".join(query.split())])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class NullCache:
+    """
+    Backend that stores nothing; used when persistence is disabled
+    """
+
+    def get(self, key):
+        return None
+
+    def put(self, key, df):
+        pass
+
+    def clear(self):
+        pass
+
+
+class ParquetCache:
+    """
+    One Parquet file per key, with a TTL and a size bound enforced by
+    evicting the least recently used files.
+    """
+
+    def __init__(self, directory, ttl_seconds, max_bytes):
+        self.directory = Path(directory)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.directory / f"{key}.parquet"
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+
+        # mtime marca la escritura (TTL) y atime el último uso (LRU)
+        now = time.time()
+        if self.ttl_seconds and now - stat.st_mtime > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            return None
+
+        try:
+            df = pd.read_parquet(path)
+        except Exception as e:
+            logger.warning(f"Entrada de caché ilegible {path.name}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+
+        os.utime(path, (now, stat.st_mtime))
+        return df
+
+    def put(self, key, df):
+        if df.empty:
+            return
+
+        path = self._path(key)
+        # Un temporal único por escritura: varios hilos pueden guardar la misma clave
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix=f"{key}.", suffix=".tmp", delete=False) as f:
+            tmp = Path(f.name)
+        try:
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"No se pudo guardar en caché {path.name}: {e}")
+            tmp.unlink(missing_ok=True)
+            return
+        self._evict()
+
+    def clear(self):
+        for path in self.directory.glob("*.parquet"):
+            path.unlink(missing_ok=True)
+
+    def _evict(self):
+        entries = []
+        for path in self.directory.glob("*.parquet"):
+            try:
+                entries.append((path.stat(), path))
+            except FileNotFoundError:
+                continue
+
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, path in sorted(entries, key=lambda entry: entry[0].st_atime):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+
+class ServerCache:
+    """
+    Base of the shared backends: results travel as Parquet bytes with a
+    TTL, as they would to a cache server. Subclasses store the bytes.
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key):
+        try:
+            data = self._get(key)
+        except Exception as e:
+            logger.warning(f"Caché compartida no disponible: {e}")
+            return None
+        if data is None:
+            return None
+
+        try:
+            return pd.read_parquet(io.BytesIO(data))
+        except Exception as e:
+            logger.warning(f"Entrada de caché compartida ilegible {key}: {e}")
+            return None
+
+    def put(self, key, df):
+        if df.empty:
+            return
+
+        try:
+            self._set(key, df.to_parquet(index=False))
+        except Exception as e:
+            logger.warning(f"No se pudo guardar en la caché compartida {key}: {e}")
+
+    def clear(self):
+        try:
+            self._clear()
+        except Exception as e:
+            logger.warning(f"No se pudo vaciar la caché compartida: {e}")
+
+
+class RedisCache(ServerCache):
+    """
+    Results kept on a Redis server shared by every replica; Redis expires
+    the entries after the TTL and evicts under its own memory policy
+    """
+
+    def __init__(self, client, ttl_seconds, prefix="omop:result:"):
+        super().__init__(ttl_seconds)
+        self.client = client
+        self.prefix = prefix
+
+    def _get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def _set(self, key, data):
+        self.client.set(self.prefix + key, data, ex=self.ttl_seconds or None)
+
+    def _clear(self):
+        for name in self.client.scan_iter(match=f"{self.prefix}*"):
+            self.client.delete(name)
+
+
+class MemoryCache(ServerCache):
+    """
+    In-process stand-in for a cache server (tests and single-replica
+    deployments): the same bytes, TTL and size bound, without the network
+    """
+
+    def __init__(self, ttl_seconds, max_bytes):
+        super().__init__(ttl_seconds)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            written, data = entry
+            if self.ttl_seconds and time.time() - written > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def _set(self, key, data):
+        with self._lock:
+            self._entries[key] = (time.time(), data)
+            self._entries.move_to_end(key)
+            # Expulsar las entradas menos usadas hasta volver al límite
+            total = sum(len(data) for _, data in self._entries.values())
+            while total > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                total -= len(evicted)
+
+    def _clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TieredCache:
+    """
+    Local backend in front of a shared one: reads try the local tier first
+    and copy shared hits into it; writes go to both tiers
+    """
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        df = self.local.get(key)
+        if df is None:
+            df = self.shared.get(key)
+            if df is not None:
+                self.local.put(key, df)
+        return df
+
+    def put(self, key, df):
+        self.local.put(key, df)
+        self.shared.put(key, df)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+
+def _ttl_from_env():
+    return int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+def _max_bytes_from_env():
+    return int(os.getenv("RESULT_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+
+def parquet_cache_from_env():
+    if pyarrow is None:
+        logger.warning("pyarrow no está instalado: caché persistente desactivada")
+        return NullCache()
+
+    return ParquetCache(
+        directory=os.getenv("RESULT_CACHE_DIR", ".cache/results"),
+        ttl_seconds=_ttl_from_env(),
+        max_bytes=_max_bytes_from_env(),
+    )
+
+
+def redis_cache_from_env():
+    if redis is None or pyarrow is None:
+        logger.warning("redis o pyarrow no están instalados: caché compartida desactivada")
+        return NullCache()
+
+    client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    return RedisCache(client, ttl_seconds=_ttl_from_env())
+
+
+def memory_cache_from_env():
+    if pyarrow is None:
+        logger.warning("pyarrow no está instalado: caché compartida desactivada")
+        return NullCache()
+
+    return MemoryCache(ttl_seconds=_ttl_from_env(), max_bytes=_max_bytes_from_env())
+
+
+# Backends disponibles, seleccionados con las variables RESULT_CACHE y SHARED_CACHE
+CACHE_BACKENDS = {
+    "parquet": parquet_cache_from_env,
+    "redis": redis_cache_from_env,
+    "memory": memory_cache_from_env,
+    "none": NullCache,
+}
+
+
+def _backend(variable, default):
+    name = os.getenv(variable, default)
+    if name not in CACHE_BACKENDS:
+        logger.warning(f"Caché desconocida {name!r} en {variable}, se usa 'none'")
+        name = "none"
+    return name
+
+
+def cache_from_env():
+    """
+    Return the persistent cache backend selected by RESULT_CACHE, in front
+    of the shared tier selected by SHARED_CACHE (none by default)
+    """
+    local = CACHE_BACKENDS[_backend("RESULT_CACHE", "parquet")]()
+    shared = _backend("SHARED_CACHE", "none")
+    if shared == "none":
+        return local
+    return TieredCache(local, CACHE_BACKENDS[shared]())
@@ -0,0 +1,175 @@
+"""
+Cohort filter shared by every `DataManager` getter.
+
+A `Cohort` narrows the dashboard to a date range, an age band and a set of
+sexes. It compiles a query of `database.queries` into the same SQL with a
+`WITH` clause that shadows each CDM table the query reads by its filtered
+rows, so the filter runs inside the database (on person_id, year_of_birth,
+gender_concept_id and the event dates) and every query keeps its text.
+
+A cohort can also keep a deterministic sample of its persons (the "fast"
+mode of the dashboard): every table is filtered by a hash of person_id, so
+the same persons are kept across tables and runs, and `DataManager` scales
+the counts back to the whole cohort.
+"""
+import re
+from dataclasses import asdict, dataclass
+from datetime import date
+
+from database.queries import EVENT_TABLES
+from database.settings import load_section
+
+# Tablas de eventos y su columna de fecha (la que acota el periodo)
+EVENT_DATES = {spec["table"]: spec["date"] for spec in EVENT_TABLES.values()}
+
+# Muestreo de personas: person_id se multiplica por ~0.618 del módulo (hashing de
+# Fibonacci) módulo un primo de 31 bits, lo que reparte ids consecutivos de forma
+# uniforme. El producto cabe en BIGINT y la expresión es la misma en PostgreSQL y DuckDB
+SAMPLE_MODULUS = 2147483647
+SAMPLE_HASH = f"MOD(MOD(CAST(person_id AS BIGINT), {SAMPLE_MODULUS}) * 1327217884, {SAMPLE_MODULUS})"
+
+# Tablas con person_id a las que se aplica la muestra
+SAMPLED_TABLES = {"person", "observation_period", *EVENT_DATES}
+
+# Orden fijo de los CTE: el SQL (y su clave de caché) es el mismo en cada proceso,
+# y person va delante de las tablas que lo referencian
+CTE_ORDER = ["person", "observation_period", *sorted(EVENT_DATES)]
+
+
+@dataclass(frozen=True)
+class Cohort:
+    """
+    Persons and events the dashboard is restricted to. Every field is
+    optional; an empty cohort is the whole CDM.
+
+    The age band is the age reached in the current calendar year, so it
+    compiles to a range on `year_of_birth`. The date range keeps events
+    dated inside it and persons with an observation period overlapping it.
+    `sample` is the fraction of persons kept for approximate results.
+    """
+    start_date: date | None = None
+    end_date: date | None = None
+    min_age: int | None = None
+    max_age: int | None = None
+    gender_concept_ids: tuple = ()
+    sample: float | None = None
+
+    def is_empty(self):
+        """
+        Return True if the cohort does not filter anything
+        """
+        return not any(asdict(self).values())
+
+    def margin_of_error(self, persons):
+        """
+        Return the relative half-width of the 95% interval of a count
+        extrapolated from `persons` sampled persons
+        """
+        if not self.sample or not persons:
+            return 0.0
+        return 1.96 * ((1 - self.sample) / persons) ** 0.5
+
+    def _person_conditions(self, schema, params):
+        conditions = []
+        if self.gender_concept_ids:
+            names = []
+            for i, concept_id in enumerate(self.gender_concept_ids):
+                params[f"gender_{i}"] = int(concept_id)
+                names.append(f":gender_{i}")
+            conditions.append(f"gender_concept_id IN ({', '.join(names)})")
+
+        # Banda de edad como rango de año de nacimiento: aprovecha el índice de person
+        this_year = date.today().year
+        if self.max_age is not None:
+            params["min_year_of_birth"] = this_year - self.max_age
+            conditions.append("year_of_birth >= :min_year_of_birth")
+        if self.min_age is not None:
+            params["max_year_of_birth"] = this_year - self.min_age
+            conditions.append("year_of_birth <= :max_year_of_birth")
+
+        if self.start_date or self.end_date:
+            conditions.append(
+                f"person_id IN (SELECT person_id FROM {schema}.observation_period WHERE "
+                + " AND ".join(self._period_conditions("observation_period_end_date", "observation_period_start_date", params))
+                + ")"
+            )
+        return conditions
+
+    def _period_conditions(self, end_col, start_col, params):
+        conditions = []
+        if self.start_date:
+            params["start_date"] = self.start_date
+            conditions.append(f"{end_col} >= :start_date")
+        if self.end_date:
+            params["end_date"] = self.end_date
+            conditions.append(f"{start_col} <= :end_date")
+        return conditions
+
+    def compile(self, query, schema):
+        """
+        Return the SQL of a query restricted to the cohort and its bind
+        parameters. `query` is a template of `database.queries`.
+        """
+        if self.is_empty():
+            return query.format(cdm=schema), {}
+
+        params = {}
+        person = self._person_conditions(schema, params)
+        demographic = bool(self.gender_concept_ids or self.min_age is not None or self.max_age is not None)
+        tables = set(re.findall(r"\{cdm\}\.(\w+)", query))
+
+        filters = {}
+        if person and ("person" in tables or demographic):
+            filters["person"] = person
+        if "observation_period" in tables:
+            conditions = self._period_conditions("observation_period_end_date", "observation_period_start_date", params)
+            if demographic:
+                conditions.append("person_id IN (SELECT person_id FROM person)")
+            filters["observation_period"] = conditions
+        for table in sorted(tables & set(EVENT_DATES)):
+            conditions = self._period_conditions(EVENT_DATES[table], EVENT_DATES[table], params)
+            if demographic:
+                conditions.append("person_id IN (SELECT person_id FROM person)")
+            filters[table] = conditions
+
+        # La muestra se aplica a cada tabla por su person_id, sin pasar por person
+        if self.sample:
+            params["sample_cut"] = int(self.sample * SAMPLE_MODULUS)
+            for table in sorted((tables & SAMPLED_TABLES) | filters.keys()):
+                filters.setdefault(table, []).append(f"{SAMPLE_HASH} < :sample_cut")
+
+        # Cada tabla filtrada se sustituye por un CTE con su mismo nombre
+        filters = {table: filters[table] for table in CTE_ORDER if filters.get(table)}
+        ctes = [
+            f"{table} AS (SELECT * FROM {schema}.{table} WHERE {' AND '.join(conditions)})"
+            for table, conditions in filters.items()
+        ]
+        sql = query
+        for table in sorted(filters.keys() & tables):
+            sql = re.sub(rf"\{{cdm\}}\.{table}\b", table, sql)
+        sql = sql.format(cdm=schema).strip()
+        if not ctes:
+            return sql, params
+
+        if sql[:4].upper() == "WITH":
+            sql = f"WITH {', '.join(ctes)},{sql[4:]}"
+        else:
+            sql = f"WITH {', '.join(ctes)}\n{sql}"
+        return sql, params
+
+
+def cohort_presets():
+    """
+    Return the predefined cohorts of the [cohorts.*] sections of
+    config.toml: name -> (label, Cohort)
+    """
+    presets = {}
+    for name, cfg in load_section("cohorts").items():
+        presets[name] = (cfg.get("label", name), Cohort(
+            start_date=cfg.get("start_date"),
+            end_date=cfg.get("end_date"),
+            min_age=cfg.get("min_age"),
+            max_age=cfg.get("max_age"),
+            gender_concept_ids=tuple(sorted(cfg.get("gender_concept_ids", []))),
+        ))
+    return presets
@@ -0,0 +1,80 @@
+"""
+Process-wide concept-name dictionary.
+
+The dashboard queries aggregate over concept ids only; names are attached
+afterwards in pandas from this dictionary, so no query plan joins the
+(very large) `concept` table. Names are loaded lazily, only for the ids a
+result references, and the least recently used ones are evicted beyond a
+fixed number of entries.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import bindparam, text
+
+# Máximo de nombres de concepto en memoria (~100 bytes por entrada)
+CONCEPT_CACHE_SIZE = int(os.getenv("CONCEPT_CACHE_SIZE", "200000"))
+
+# Ids por consulta al cargar nombres que faltan
+LOOKUP_BATCH = 1000
+
+# Nombre de los ids sin fila en concept (gráficas y selectores no admiten nombres nulos)
+MISSING_CONCEPT_NAME = "No matching concept"
+
+
+class ConceptNames:
+    """
+    Bounded LRU mapping (schema, concept_id) -> concept_name, shared by
+    every session and thread
+    """
+
+    def __init__(self, max_entries=CONCEPT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
+
+    def lookup(self, ids, schema, connect):
+        """
+        Return a dict concept_id -> concept_name for the given ids (None for
+        ids missing from the vocabulary). `connect` is called to open a
+        connection only if some ids are not cached yet.
+        """
+        ids = {int(concept_id) for concept_id in ids}
+        found, missing = {}, []
+        with self._lock:
+            for concept_id in ids:
+                key = (schema, concept_id)
+                if key in self._names:
+                    self._names.move_to_end(key)
+                    found[concept_id] = self._names[key]
+                else:
+                    missing.append(concept_id)
+
+        if not missing:
+            return found
+
+        query = text(f"SELECT concept_id, concept_name FROM {schema}.concept WHERE concept_id IN :ids").bindparams(
+            bindparam("ids", expanding=True)
+        )
+        loaded = dict.fromkeys(missing)
+        with connect() as conn:
+            for start in range(0, len(missing), LOOKUP_BATCH):
+                rows = conn.execute(query, {"ids": missing[start:start + LOOKUP_BATCH]})
+                loaded.update((int(concept_id), name) for concept_id, name in rows)
+
+        with self._lock:
+            for concept_id, name in loaded.items():
+                self._names[(schema, concept_id)] = name
+            while len(self._names) > self.max_entries:
+                self._names.popitem(last=False)
+
+        found.update(loaded)
+        return found
@@ -1,430 +1,832 @@
+import json
+import logging
 import os
+import threading
+from datetime import date
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
+from pandas.api.types import union_categoricals
+from contextlib import contextmanager
+from sqlalchemy import create_engine, make_url, text
 from dotenv import load_dotenv
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from database.cache import cache_from_env, cache_key
+from database.concepts import MISSING_CONCEPT_NAME, ConceptNames
+from database.incremental import refresh_stamp
+from database.instrumentation import instrumented, report
+from database.parquet_backend import create_duckdb_engine
+from database.pregnancy import OUTCOME_LABELS, episode_stamp
+from database.queries import CDM_VERSION_QUERY, CONCEPT_NAME_COLUMNS, COUNT_COLUMNS, GENDER_CONCEPTS_QUERY, PERSON_TIMELINE, QUERIES, STREAMED, query_template, render, with_limit
+from database.settings import database_settings, get_source
+from database.singleflight import SingleFlight
+from database.summaries import summary_exists, summary_query
+from database.timeline import PersonTimelines, Timeline
 
 # Cargar variables de entorno
 load_dotenv(override=True)
 
+logger = logging.getLogger("omop_dashboard")
+
+# Segundos entre comprobaciones de la versión del CDM (detecta refrescos incrementales)
+VERSION_TTL = int(os.getenv("CDM_VERSION_TTL", "300"))
+
+# Última versión vista de cada fuente, para vaciar la caché en memoria al cambiar
+_seen_versions = {}
+
+# Máximo de valores atípicos por dominio que se envían al box plot
+MAX_BOX_OUTLIERS = 100
+
+# Dominios de la consulta mensual: (dominio, columna de totales, columna de promedios)
+DENSITY_DOMAINS = [
+    ("condition", "condition_total", "avg_conditions"),
+    ("measurement", "measurement_total", "avg_measurements"),
+    ("death", "death_total", "avg_deaths"),
+    ("observation", "observation_total", "avg_observations"),
+    ("visit", "visit_total", "avg_visits"),
+    ("procedure", "procedure_total", "avg_procedures"),
+    ("drug", "drug_total", "avg_drugs"),
+    ("device", "device_total", "avg_devices"),
+]
+
 
 class DataManager:
     def __init__(self):
         pass
 
+    @staticmethod
+    def get_engine(source=None):
+        """
+        Return the pooled engine of a CDM source (one pool per source),
+        configured by the [database] section of config.toml (or its DB_*
+        environment overrides)
+        """
+        return DataManager._create_engine(get_source(source)["name"])
+
     @staticmethod
     @st.cache_resource
-    def get_engine():
-        return create_engine(os.getenv("DATABASE_URL"))
+    def _create_engine(source):
+        return create_source_engine(source)
 
-    @st.cache_data
-    def get_count_patients(_self):
+    @staticmethod
+    def get_pool_status(source=None):
         """
-        Return the name of database and the number of patients
+        Return the usage of the connection pool of a source, to help sizing it
         """
-    
-        engine = _self.get_engine()
-        query = """
-        SELECT count(*) as total
-        FROM cdm_synthea10.person
+        pool = DataManager.get_engine(source).pool
+        if not hasattr(pool, "checkedout"):
+            return {"pool": pool.status()}
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "max_overflow": database_settings()["max_overflow"],
+        }
+
+    @staticmethod
+    @st.cache_resource
+    def get_executor():
+        """
+        Return the thread pool shared by every session for batch fetches,
+        bounded by the connection pool of the engine
+        """
+        pool = DataManager.get_engine().pool
+        workers = pool.size() if hasattr(pool, "size") else 4
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="data_manager")
+
+    @staticmethod
+    @st.cache_resource
+    def get_result_cache():
+        return cache_from_env()
+
+    @staticmethod
+    @st.cache_resource
+    def get_single_flight():
+        """
+        Return the registry of queries in flight shared by every session
+        """
+        return SingleFlight()
+
+    @staticmethod
+    @st.cache_resource
+    def get_concept_names():
         """
+        Return the concept-name dictionary shared by every session
+        """
+        return ConceptNames()
+
+    @staticmethod
+    @st.cache_resource
+    def get_person_timelines():
+        """
+        Return the LRU of recently viewed person timelines shared by every session
+        """
+        return PersonTimelines()
+
+    @staticmethod
+    def get_cdm_version(source=None):
+        """
+        Return the version stamp of a CDM source, part of every persistent
+        cache key: its cdm_source row plus the time of the last summary refresh
+        """
+        return DataManager._read_cdm_version(get_source(source)["name"])
+
+    @staticmethod
+    @st.cache_data(ttl=VERSION_TTL, show_spinner=False)
+    def _read_cdm_version(source):
+        if os.getenv("CDM_VERSION"):
+            return os.getenv("CDM_VERSION")
+        source = get_source(source)
         try:
-            df = pd.read_sql(query, engine)
-            return df
+            engine = DataManager.get_engine(source["name"])
         except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
-    
-    @st.cache_data
-    def get_sex(_self):
+            logger.error(f"No se pudo conectar con {source['name']}: {e}")
+            return "unknown"
+
+        try:
+            df = pd.read_sql(render(CDM_VERSION_QUERY, source["schema"]), engine)
+            version = "|".join(str(value) for value in df.iloc[0]) if not df.empty else "unknown"
+        except Exception as e:
+            logger.warning(f"No se pudo leer cdm_source: {e}")
+            version = "unknown"
+
+        # Sellos del último refresco incremental de los resúmenes y de la última
+        # ejecución del pipeline de embarazos, si los hay (también sin cdm_source)
+        try:
+            with engine.connect() as conn:
+                stamps = [refresh_stamp(conn, source), episode_stamp(conn, source)]
+        except Exception as e:
+            logger.warning(f"No se pudo leer el estado de los resúmenes: {e}")
+            stamps = []
+        return "|".join([version, *(stamp for stamp in stamps if stamp)])
+
+    @staticmethod
+    def check_refresh(source=None):
         """
-        Return data for sex pie
+        Clear the in-memory results when the version of a source changed
+        since the last run (e.g. after an incremental refresh)
         """
-        engine = _self.get_engine()
-        query = """
-        SELECT person.gender_concept_id, concept.concept_name, count(person.gender_concept_id) as total
-        FROM cdm_synthea10.person
-        JOIN cdm_synthea10.concept on concept.concept_id = person.gender_concept_id
-        GROUP BY person.gender_concept_id, concept.concept_name;
+        name = get_source(source)["name"]
+        version = DataManager.get_cdm_version(name)
+        previous = _seen_versions.setdefault(name, version)
+        if previous != version:
+            _seen_versions[name] = version
+            st.cache_data.clear()
+            DataManager.get_concept_names().clear()
+            DataManager.get_person_timelines().clear()
+
+    def _fetch(_self, name, source=None, cohort=None):
         """
-        try:
-            df = pd.read_sql(query, engine)
+        Return the result of a named query on a CDM source from the
+        persistent cache, its precomputed summary table or, as a last
+        resort, the CDM itself. With a non-empty `cohort` the query always
+        runs on the CDM, restricted to the cohort. Concurrent calls for the
+        same query share a single execution.
+        """
+        source = get_source(source)
+        template = query_template(name, source["results_schema"])
+        if cohort is not None and not cohort.is_empty():
+            query, params = cohort.compile(template, source["schema"])
+        else:
+            query, params = render(template, source["schema"]), {}
+        cache = _self.get_result_cache()
+        key = cache_key(
+            f"{query}\n{json.dumps(params, default=str, sort_keys=True)}",
+            f"{source['name']}:{source['schema']}",
+            _self.get_cdm_version(source["name"]),
+        )
+        df = cache.get(key)
+        if df is not None:
+            report("disk")
+            return df
+
+        # Las sesiones que piden la misma consulta a la vez esperan a la primera
+        df, shared = _self.get_single_flight().do(key, lambda: _self._query(name, source, cohort, query, params, key))
+        if shared:
+            report("coalesced")
+            return df.copy()
+        return df
+
+    def _query(_self, name, source, cohort, query, params, key):
+        """
+        Run a named query on the summary table or the CDM and store the
+        result in the persistent cache; called once per key at a time
+        """
+        # Otra llamada pudo terminar entre la consulta a la caché y este punto
+        cache = _self.get_result_cache()
+        df = cache.get(key)
+        if df is not None:
+            report("disk")
             return df
+
+        try:
+            with _self._connect(name, source["name"]) as conn:
+                try:
+                    # Los resúmenes cubren el CDM completo: no sirven para una cohorte
+                    if not params and name in QUERIES and summary_exists(conn, source, name):
+                        df = _read_sql(conn, summary_query(source, name), {}, name)
+                        report("summary")
+                except Exception as e:
+                    conn.rollback()
+                    logger.warning(f"Resumen {name} no disponible, se consulta el CDM: {e}")
+
+                if df is None:
+                    df = _read_sql(conn, with_limit(query, name), params, name)
+                    report("live")
         except Exception as e:
-            print(f"Error al obtener datos: {e}")
+            logger.error(f"Error al obtener datos: {e}")
+            report("error", str(e))
             return pd.DataFrame() # Retornar vacío en caso de error
 
-    @st.cache_data
-    def get_race(_self):
+        # Modo rápido: los conteos de la muestra se extrapolan a la cohorte completa
+        if cohort is not None and cohort.sample:
+            df = _extrapolate(df, COUNT_COLUMNS.get(name, []), cohort.sample)
+        if name in CONCEPT_NAME_COLUMNS:
+            df = _self._with_concept_names(df, CONCEPT_NAME_COLUMNS[name], source["name"], missing=MISSING_CONCEPT_NAME)
+        cache.put(key, df)
+        return df
+
+    @contextmanager
+    def _connect(_self, name, source=None):
         """
-        Return data for race pie
+        Yield a pooled connection of a source tagged with the query name, so
+        each query is identifiable in pg_stat_activity
         """
-        engine = _self.get_engine()
-        query = """
-        SELECT person.race_concept_id, concept.concept_name, count(person.race_concept_id) as total
-        FROM cdm_synthea10.person
-        LEFT JOIN cdm_synthea10.concept on concept.concept_id = person.race_concept_id
-        GROUP BY person.race_concept_id, concept.concept_name;
+        engine = _self.get_engine(source)
+        with engine.connect() as conn:
+            if engine.dialect.name == "postgresql":
+                app_name = f"{database_settings()['application_name']}:{name}"
+                conn.execute(text("SELECT set_config('application_name', :app_name, false)"), {"app_name": app_name})
+            yield conn
+
+    def _with_concept_names(_self, df, id_col, source=None, missing=None):
         """
-        try:
-            df = pd.read_sql(query, engine)
+        Return the DataFrame with a categorical concept_name column right
+        after `id_col`, taken from the concept-name dictionary instead of a
+        join; ids without a concept get `missing`. Raise if the names
+        cannot be read.
+        """
+        if df.empty or "concept_name" in df.columns:
             return df
-        except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
-        
-    @st.cache_data
-    def get_ethnicity(_self):
+
+        source = get_source(source)
+        ids = df[id_col].dropna().unique()
+        # Un error de la consulta se propaga: un resultado sin nombres no debe cachearse
+        names = _self.get_concept_names().lookup(
+            ids, source["schema"], lambda: _self._connect("concept_names", source["name"])
+        )
+
+        concept_names = df[id_col].map(names)
+        if missing is not None:
+            concept_names = concept_names.fillna(missing)
+        df = df.copy()
+        df.insert(df.columns.get_loc(id_col) + 1, "concept_name", concept_names.astype("category"))
+        return df
+
+    def submit(_self, request, source=None, cohort=None):
         """
-        Return data for race pie
+        Run a getter on the shared thread pool and return its future.
+        `request` is a getter name or a tuple (getter name, *args).
         """
-        engine = _self.get_engine()
-        query = """
-        SELECT person.ethnicity_concept_id, concept.concept_name, count(person.ethnicity_concept_id) as total
-        FROM cdm_synthea10.person
-        LEFT JOIN cdm_synthea10.concept on concept.concept_id = person.ethnicity_concept_id
-        GROUP BY person.ethnicity_concept_id, concept.concept_name;
+        ctx = get_script_run_ctx()
+
+        def run():
+            # Hilos del pool: adjuntar el contexto de la sesión para st.cache_data
+            if ctx is not None:
+                add_script_run_ctx(threading.current_thread(), ctx)
+            name, *args = (request,) if isinstance(request, str) else request
+            return getattr(_self, name)(*args, source=source, cohort=cohort)
+
+        return _self.get_executor().submit(run)
+
+    def fetch_as_completed(_self, requests, source=None, cohort=None):
+        """
+        Run several getters on a CDM source (restricted to `cohort`, if
+        given) at the same time on the shared thread pool, and yield
+        (label, DataFrame) for each one as soon as it finishes, so the
+        caller can draw it without waiting for the slowest one.
+
+        `requests` maps a label to a getter name or to a tuple
+        (getter name, *args). The time of each getter is recorded by
+        `instrumented`.
         """
+        labels = {_self.submit(request, source, cohort): label for label, request in requests.items()}
+        for future in as_completed(labels):
+            try:
+                df = future.result()
+            except Exception as e:
+                # El getter no llegó a cachearse: la próxima ejecución lo reintenta
+                logger.error(f"Error al obtener {labels[future]}: {e}")
+                df = pd.DataFrame()
+            yield labels[future], df
+
+    @instrumented
+    def get_person_timeline(_self, person_id, source=None):
+        """
+        Return the Timeline of every event of a person, from the LRU of
+        recently viewed persons or from one UNION ALL query over the event
+        tables. The cohort filter does not apply to a single person.
+        """
+        source = get_source(source)
+        key = (source["name"], int(person_id))
+        timelines = _self.get_person_timelines()
+        timeline = timelines.get(key)
+        if timeline is not None:
+            return timeline
+
         try:
-            df = pd.read_sql(query, engine)
-            return df
+            with _self._connect("person_timeline", source["name"]) as conn:
+                df = pd.read_sql(text(render(PERSON_TIMELINE, source["schema"])), conn, params={"person_id": int(person_id)})
+            report("live")
+            ids = df["concept_id"].dropna().unique()
+            names = _self.get_concept_names().lookup(
+                ids, source["schema"], lambda: _self._connect("concept_names", source["name"])
+            )
         except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
+            logger.error(f"Error al obtener la línea de tiempo de la persona {person_id}: {e}")
+            report("error", str(e))
+            return Timeline(int(person_id)) # Línea de tiempo vacía en caso de error
 
-    @st.cache_data
-    def get_age_at_first_seen(_self):
+        timeline = Timeline.from_frame(person_id, df, names)
+        timelines.put(key, timeline)
+        return timeline
+
+    @instrumented
+    @st.cache_data(show_spinner=False)
+    def get_gender_concepts(_self, source=None):
         """
-        Return data for age at first seem
+        Return the gender concepts of the vocabulary (concept_id,
+        concept_name), for the options of the cohort filter
         """
-        engine = _self.get_engine()
-        query = """
-                SELECT p.person_id, op.observation_period_start_date, p.birth_datetime, EXTRACT(YEAR FROM AGE(p.birth_datetime)) AS age_in_years
-                FROM cdm_synthea10.observation_period op
-                JOIN cdm_synthea10.person p ON p.person_id = op.person_id
-                """
+        source = get_source(source)
         try:
-            df = pd.read_sql(query, engine)
-            return df
+            with _self._connect("gender_concepts", source["name"]) as conn:
+                df = pd.read_sql(text(render(GENDER_CONCEPTS_QUERY, source["schema"])), conn)
+            report("live")
         except Exception as e:
-            print(f"Error al obtener datos: {e}")
+            logger.error(f"No se pudieron leer los conceptos de sexo: {e}")
+            report("error", str(e))
             return pd.DataFrame() # Retornar vacío en caso de error
+        return df
+
+    @instrumented
+    @st.cache_data
+    def get_count_patients(_self, source=None, cohort=None):
+        """
+        Return the name of database and the number of patients
+        """
+        return _self._fetch("count_patients", source, cohort)
+    
+    @instrumented
+    @st.cache_data
+    def get_sex(_self, source=None, cohort=None):
+        """
+        Return data for sex pie
+        """
+        return _self._fetch("sex", source, cohort)
+
+    @instrumented
+    @st.cache_data
+    def get_race(_self, source=None, cohort=None):
+        """
+        Return data for race pie
+        """
+        return _self._fetch("race", source, cohort)
+        
+    @instrumented
+    @st.cache_data
+    def get_ethnicity(_self, source=None, cohort=None):
+        """
+        Return data for race pie
+        """
+        return _self._fetch("ethnicity", source, cohort)
+
+    @instrumented
+    @st.cache_data
+    def get_age_at_first_seen(_self, bin_width=1, source=None, cohort=None):
+        """
+        Return the histogram of age at first seen, in bins of `bin_width` years
+        """
+        return _rebin(_self._fetch("age_at_first_seen", source, cohort), bin_width)
         
+    @instrumented
     @st.cache_data
-    def get_conditions_per_person(_self):
+    def get_conditions_per_person(_self, source=None, cohort=None):
         """
         Return data for conditions per person
         """
-        engine = _self.get_engine()
-        query = """
-                SELECT COUNT(DISTINCT co.person_id) AS cnt , co.condition_concept_id, c.concept_name
-                FROM cdm_synthea10.condition_occurrence co
-                JOIN cdm_synthea10.concept c on c.concept_id = co.condition_concept_id
-                GROUP BY co.condition_concept_id, c.concept_name
-                ORDER BY cnt DESC
-                LIMIT 50;
-                """
-        try:
-            df = pd.read_sql(query, engine)
-            return df
-        except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
+        return _self._fetch("conditions_per_person", source, cohort)
         
+    @instrumented
+    @st.cache_data
+    def get_domain_month_counts(_self, source=None, cohort=None):
+        """
+        Return records and distinct persons per domain per month, the single
+        scan shared by the data density charts
+        """
+        return _self._fetch("domain_month_counts", source, cohort)
+
+    @instrumented
     @st.cache_data
-    def get_data_density_total_rows(_self):
+    def get_data_density_total_rows(_self, source=None, cohort=None):
         """
         Return data density of some tables in OMOP
         """
-        engine = _self.get_engine()
-        query = """WITH condition_counts AS (
-                    SELECT TO_CHAR(condition_start_date, 'YYYY-MM') AS month_year, COUNT(*) AS count_cond
-                    FROM cdm_synthea10.condition_occurrence GROUP BY 1
-                ),
-                measurement_counts AS (
-                    SELECT TO_CHAR(measurement_date, 'YYYY-MM') AS month_year, COUNT(*) AS count_meas
-                    FROM cdm_synthea10.measurement GROUP BY 1
-                ),
-                death_counts AS (
-                    SELECT TO_CHAR(death_date, 'YYYY-MM') AS month_year, COUNT(*) AS count_death
-                    FROM cdm_synthea10.death GROUP BY 1
-                ),
-                observation_counts AS (
-                    SELECT TO_CHAR(observation_date, 'YYYY-MM') AS month_year, COUNT(*) AS count_obs
-                    FROM cdm_synthea10.observation GROUP BY 1
-                ),
-                visit_counts AS (
-                    SELECT TO_CHAR(visit_start_date, 'YYYY-MM') AS month_year, COUNT(*) AS count_visit
-                    FROM cdm_synthea10.visit_occurrence GROUP BY 1
-                ),
-                procedure_counts AS (
-                    SELECT TO_CHAR(procedure_date, 'YYYY-MM') AS month_year, COUNT(*) AS count_proc
-                    FROM cdm_synthea10.procedure_occurrence GROUP BY 1
-                ),
-                drug_counts AS (
-                    SELECT TO_CHAR(drug_exposure_start_date, 'YYYY-MM') AS month_year, COUNT(*) AS count_drug
-                    FROM cdm_synthea10.drug_exposure GROUP BY 1
-                ),
-                device_counts AS (
-                    SELECT TO_CHAR(device_exposure_start_date, 'YYYY-MM') AS month_year, COUNT(*) AS count_device
-                    FROM cdm_synthea10.device_exposure GROUP BY 1
-                ),
-                all_months AS (
-                    SELECT month_year FROM condition_counts
-                    UNION SELECT month_year FROM measurement_counts
-                    UNION SELECT month_year FROM death_counts
-                    UNION SELECT month_year FROM observation_counts
-                    UNION SELECT month_year FROM visit_counts
-                    UNION SELECT month_year FROM procedure_counts
-                    UNION SELECT month_year FROM drug_counts
-                    UNION SELECT month_year FROM device_counts
-                )
-
-                SELECT 
-                    am.month_year,
-                    COALESCE(c.count_cond, 0) AS condition_total,
-                    COALESCE(m.count_meas, 0) AS measurement_total,
-                    COALESCE(d.count_death, 0) AS death_total,
-                    COALESCE(o.count_obs, 0) AS observation_total,
-                    COALESCE(v.count_visit, 0) AS visit_total,
-                    COALESCE(p.count_proc, 0) AS procedure_total,
-                    COALESCE(dr.count_drug, 0) AS drug_total,
-                    COALESCE(dv.count_device, 0) AS device_total
-                FROM all_months am
-                LEFT JOIN condition_counts c   ON am.month_year = c.month_year
-                LEFT JOIN measurement_counts m ON am.month_year = m.month_year
-                LEFT JOIN death_counts d       ON am.month_year = d.month_year
-                LEFT JOIN observation_counts o ON am.month_year = o.month_year
-                LEFT JOIN visit_counts v       ON am.month_year = v.month_year
-                LEFT JOIN procedure_counts p   ON am.month_year = p.month_year
-                LEFT JOIN drug_counts dr       ON am.month_year = dr.month_year
-                LEFT JOIN device_counts dv     ON am.month_year = dv.month_year
-                ORDER BY 1 ASC;
-                """
-        try:
-            df = pd.read_sql(query, engine)
+        df = _self.get_domain_month_counts(source, cohort)
+        if df.empty:
             return df
-        except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
+
+        totals = _pivot_domains(df, "total_recs", 0, "total")
+        totals.insert(0, "month_year", totals.index)
+        return totals.reset_index(drop=True)
         
+    @instrumented
     @st.cache_data
-    def get_avg_records_per_person_per_month(_self):
+    def get_avg_records_per_person_per_month(_self, source=None, cohort=None):
         """
         Return the average of records per person per month
         """
-        engine = _self.get_engine()
-        query = """WITH metrics_per_table AS (
-                    SELECT 
-                        DATE_TRUNC('month', condition_start_date)::DATE as month_date,
-                        'condition' as domain,
-                        COUNT(*) as total_recs,
-                        COUNT(DISTINCT person_id) as unique_ppl
-                    FROM cdm_synthea10.condition_occurrence GROUP BY 1
-                    
-                    UNION ALL
-                    
-                    SELECT DATE_TRUNC('month', measurement_date)::DATE, 'measurement', COUNT(*), COUNT(DISTINCT person_id)
-                    FROM cdm_synthea10.measurement GROUP BY 1
-                    
-                    UNION ALL
-                    
-                    SELECT DATE_TRUNC('month', death_date)::DATE, 'death', COUNT(*), COUNT(DISTINCT person_id)
-                    FROM cdm_synthea10.death GROUP BY 1
-                    
-                    UNION ALL
-                    
-                    SELECT DATE_TRUNC('month', observation_date)::DATE, 'observation', COUNT(*), COUNT(DISTINCT person_id)
-                    FROM cdm_synthea10.observation GROUP BY 1
-                    
-                    UNION ALL
-                    
-                    SELECT DATE_TRUNC('month', visit_start_date)::DATE, 'visit', COUNT(*), COUNT(DISTINCT person_id)
-                    FROM cdm_synthea10.visit_occurrence GROUP BY 1
-                    
-                    UNION ALL
-                    
-                    SELECT DATE_TRUNC('month', procedure_date)::DATE, 'procedure', COUNT(*), COUNT(DISTINCT person_id)
-                    FROM cdm_synthea10.procedure_occurrence GROUP BY 1
-                    
-                    UNION ALL
-                    
-                    SELECT DATE_TRUNC('month', drug_exposure_start_date)::DATE, 'drug', COUNT(*), COUNT(DISTINCT person_id)
-                    FROM cdm_synthea10.drug_exposure GROUP BY 1
-                    
-                    UNION ALL
-                    
-                    SELECT DATE_TRUNC('month', device_exposure_start_date)::DATE, 'device', COUNT(*), COUNT(DISTINCT person_id)
-                    FROM cdm_synthea10.device_exposure GROUP BY 1
-                )
-
-                SELECT 
-                    month_date,
-                    ROUND(MAX(CASE WHEN domain = 'condition'   THEN total_recs::numeric / NULLIF(unique_ppl, 0) END), 2) AS avg_conditions,
-                    ROUND(MAX(CASE WHEN domain = 'measurement' THEN total_recs::numeric / NULLIF(unique_ppl, 0) END), 2) AS avg_measurements,
-                    ROUND(MAX(CASE WHEN domain = 'death'       THEN total_recs::numeric / NULLIF(unique_ppl, 0) END), 2) AS avg_deaths,
-                    ROUND(MAX(CASE WHEN domain = 'observation' THEN total_recs::numeric / NULLIF(unique_ppl, 0) END), 2) AS avg_observations,
-                    ROUND(MAX(CASE WHEN domain = 'visit'       THEN total_recs::numeric / NULLIF(unique_ppl, 0) END), 2) AS avg_visits,
-                    ROUND(MAX(CASE WHEN domain = 'procedure'   THEN total_recs::numeric / NULLIF(unique_ppl, 0) END), 2) AS avg_procedures,
-                    ROUND(MAX(CASE WHEN domain = 'drug'        THEN total_recs::numeric / NULLIF(unique_ppl, 0) END), 2) AS avg_drugs,
-                    ROUND(MAX(CASE WHEN domain = 'device'      THEN total_recs::numeric / NULLIF(unique_ppl, 0) END), 2) AS avg_devices
-                FROM metrics_per_table
-                GROUP BY month_date
-                ORDER BY month_date;
-        """
-
-        try:
-            df = pd.read_sql(query, engine)
+        df = _self.get_domain_month_counts(source, cohort)
+        if df.empty:
             return df
-        except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
+
+        df = df.assign(avg=(df["total_recs"] / df["unique_ppl"].where(df["unique_ppl"] > 0)).round(2).astype("float32"))
+        averages = _pivot_domains(df, "avg", None, "avg")
+        return averages.rename_axis("month_date").reset_index()
         
+    @instrumented
     @st.cache_data
-    def get_records_per_person_per_domain(_self):
-        """
-        Return the number of records per person per domain
-        """
-
-        engine = _self.get_engine()
-        query = """
-                    -- 1. Condition (Diagnósticos)
-                    SELECT 
-                        person_id, 
-                        'Condition' AS domain, 
-                        COUNT(DISTINCT condition_concept_id) AS n_concepts
-                    FROM cdm_synthea10.condition_occurrence
-                    GROUP BY person_id
-
-                    UNION ALL
-
-                    -- 2. Measurement (Laboratorios/Mediciones)
-                    -- Nota: En OMOP estándar la tabla suele llamarse 'measurement', no 'measurement_occurrence'
-                    SELECT 
-                        person_id, 
-                        'Measurement' AS domain, 
-                        COUNT(DISTINCT measurement_concept_id) AS n_concepts
-                    FROM cdm_synthea10.measurement
-                    GROUP BY person_id
-
-                    UNION ALL
-
-                    -- 3. Drug (Medicamentos)
-                    SELECT 
-                        person_id, 
-                        'Drug' AS domain, 
-                        COUNT(DISTINCT drug_concept_id) AS n_concepts
-                    FROM cdm_synthea10.drug_exposure
-                    GROUP BY person_id
-
-                    UNION ALL
-
-                    -- 4. Observation (Historia Social/Otros)
-                    SELECT 
-                        person_id, 
-                        'Observation' AS domain, 
-                        COUNT(DISTINCT observation_concept_id) AS n_concepts
-                    FROM cdm_synthea10.observation
-                    GROUP BY person_id
-
-                    UNION ALL
-
-                    -- 5. Procedure (Procedimientos)
-                    SELECT 
-                        person_id, 
-                        'Procedure' AS domain, 
-                        COUNT(DISTINCT procedure_concept_id) AS n_concepts
-                    FROM cdm_synthea10.procedure_occurrence
-                    GROUP BY person_id;
-                     """
-        try:
-            df = pd.read_sql(query, engine)
-            return df
-        except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
+    def get_records_per_person_per_domain(_self, quantiles=True, source=None, cohort=None):
+        """
+        Return the number of records per person per domain.
+
+        With `quantiles` (the default) return one row of box plot statistics
+        per domain instead of one row per person.
+        """
+        if not quantiles:
+            return _self._fetch("records_per_person_per_domain", source, cohort)
+        return _box_stats(_self._fetch("concepts_per_person_distribution", source, cohort))
         
+    @instrumented
     @st.cache_data
-    def get_year_of_birth_patients(_self):
+    def get_year_of_birth_patients(_self, bin_width=1, source=None, cohort=None):
         """
-        Return the year of birth of patients
+        Return the histogram of year of birth of patients, in bins of `bin_width` years
         """
-        engine = _self.get_engine()
-        query = """SELECT person_id, year_of_birth as age_in_years
-                   FROM cdm_synthea10.person"""
-        
-        try:
-            df = pd.read_sql(query, engine)
-            return df
-        except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
+        return _rebin(_self._fetch("year_of_birth_patients", source, cohort), bin_width)
 
+    @instrumented
     @st.cache_data
-    def get_visits_concepts(_self):
+    def get_visits_concepts(_self, source=None, cohort=None):
         """
         Return the concepts of visits
         """
-        engine = _self.get_engine()
-        query = """SELECT visit_concept_id, concept_name, COUNT(*) as cnt
-                FROM cdm_synthea10.visit_occurrence v
-                JOIN cdm_synthea10.concept c on c.concept_id = v.visit_concept_id
-                GROUP BY visit_concept_id, concept_name
-                ORDER BY cnt DESC
-                LIMIT 50;"""
-        
-        try:
-            df = pd.read_sql(query, engine)
-            return df
-        except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
+        return _self._fetch("visits_concepts", source, cohort)
         
+    @instrumented
     @st.cache_data
-    def get_visits_duration(_self):
+    def get_visits_duration(_self, source=None, cohort=None):
         """
         Return the duration of visits
         """
-        engine = _self.get_engine()
-        query = """WITH visit_duration AS (
-                                        SELECT 
-                                            visit_occurrence_id,
-                                            visit_start_datetime,
-                                            visit_end_datetime,
-                                            (EXTRACT(EPOCH FROM (visit_end_datetime - visit_start_datetime))) / 86400 AS length_of_stay_days
-                                        FROM 
-                                            cdm_synthea10.visit_occurrence
-                                    )
-                                    SELECT 
-                                        AVG (length_of_stay_days)
-                                    FROM 
-                                        visit_duration
-                                    WHERE 
-                                        length_of_stay_days <= 365;"""
-        
-        try:
-            df = pd.read_sql(query, engine)
-            return df
-        except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
+        return _self._fetch("visits_duration", source, cohort)
         
+    @instrumented
     @st.cache_data
-    def get_visit_type_concept_id(_self):
+    def get_visit_type_concept_id(_self, source=None, cohort=None):
         """
         Return the visit type concept id
         """
-        engine = _self.get_engine()
-        query = """ SELECT visit_type_concept_id, concept_name, COUNT(*) as cnt
-                    FROM cdm_synthea10.visit_occurrence v
-                    JOIN cdm_synthea10.concept c on c.concept_id = v.visit_type_concept_id
-                    GROUP BY visit_type_concept_id, concept_name
-                    ORDER BY cnt DESC
-                    LIMIT 50;"""
+        return _self._fetch("visit_type_concept_id", source, cohort)
 
-        try:
-            df = pd.read_sql(query, engine)
+
+    @instrumented
+    @st.cache_data
+    def get_pregnancy_episode_count(_self, source=None, cohort=None):
+        """
+        Return the number of pregnancy episodes (see `database.pregnancy`)
+        """
+        return _self._fetch("pregnancy_episode_count", source, cohort)
+
+    @instrumented
+    @st.cache_data
+    def get_pregnancy_outcomes(_self, source=None, cohort=None):
+        """
+        Return the number of pregnancy episodes per outcome, with the
+        outcome label as concept_name
+        """
+        df = _self._fetch("pregnancy_outcomes", source, cohort)
+        if df.empty:
             return df
-        except Exception as e:
-            print(f"Error al obtener datos: {e}")
-            return pd.DataFrame() # Retornar vacío en caso de error
\ No newline at end of file
+        df = df.copy()
+        df.insert(1, "concept_name", df["outcome"].map(OUTCOME_LABELS).astype("category"))
+        return df
+
+    @instrumented
+    @st.cache_data
+    def get_pregnancy_gestational_age(_self, source=None, cohort=None):
+        """
+        Return the number of pregnancy episodes with a known outcome per
+        completed week of gestation
+        """
+        return _self._fetch("pregnancy_gestational_age", source, cohort)
+
+    @instrumented
+    @st.cache_data
+    def get_pregnancy_episodes_per_month(_self, source=None, cohort=None):
+        """
+        Return the number of pregnancy episodes ending in each month
+        """
+        return _self._fetch("pregnancy_episodes_per_month", source, cohort)
+
+    @instrumented
+    @st.cache_data
+    def get_domain_summary(_self, domain, source=None, cohort=None):
+        """
+        Return the aggregates of an event domain (a key of `EVENT_TABLES`)
+        from a single scan of its table: one row per concept, type concept,
+        month and number of records per person, told apart by `facet`
+        """
+        return _self._fetch(f"domain_summary_{domain}", source, cohort)
+
+    @instrumented
+    @st.cache_data
+    def get_domain_top_concepts(_self, domain, n=50, source=None, cohort=None):
+        """
+        Return the `n` concepts of a domain with most persons
+        """
+        df = _self.get_domain_summary(domain, source, cohort)
+        if df.empty:
+            return df
+
+        concepts = df[df["facet"] == "concept"].sort_values(["persons", "concept_id"], ascending=[False, True]).head(n)
+        concepts = concepts.rename(columns={"persons": "cnt"})[["cnt", "concept_id"]].reset_index(drop=True)
+        return _self._with_concept_names(concepts, "concept_id", source, missing=MISSING_CONCEPT_NAME)
+
+    @instrumented
+    @st.cache_data
+    def get_domain_monthly_trend(_self, domain, source=None, cohort=None):
+        """
+        Return the records and distinct persons of a domain per month
+        """
+        df = _self.get_domain_summary(domain, source, cohort)
+        if df.empty:
+            return df
+
+        months = df[df["facet"] == "month"].dropna(subset=["month_date"]).sort_values("month_date")
+        trend = months[["records", "persons"]].astype("int32")
+        trend.insert(0, "month_year", months["month_date"])
+        return trend.reset_index(drop=True)
+
+    @instrumented
+    @st.cache_data
+    def get_domain_records_per_person(_self, domain, source=None, cohort=None):
+        """
+        Return box plot statistics of the number of records per person of a domain
+        """
+        df = _self.get_domain_summary(domain, source, cohort)
+        if df.empty:
+            return df
+
+        per_person = df[df["facet"] == "per_person"]
+        return _box_stats(pd.DataFrame({
+            "domain": domain.capitalize(),
+            "n_concepts": per_person["n_records"],
+            "persons": per_person["persons"],
+        }))
+
+    @instrumented
+    @st.cache_data
+    def get_domain_type_breakdown(_self, domain, source=None, cohort=None):
+        """
+        Return the records of a domain per type concept (EHR, claim...)
+        """
+        df = _self.get_domain_summary(domain, source, cohort)
+        if df.empty:
+            return df
+
+        types = df[df["facet"] == "type"].sort_values(["records", "concept_id"], ascending=[False, True])
+        types = types.rename(columns={"records": "total"})[["concept_id", "total"]].reset_index(drop=True)
+        if types.empty:
+            return types
+
+        return _self._with_concept_names(types, "concept_id", source, missing=MISSING_CONCEPT_NAME)
+
+
+def create_source_engine(source=None, parquet=True):
+    """
+    Return a pooled engine for a CDM source, configured by the [database]
+    section of config.toml. A source with the duckdb backend reads its
+    Parquet export; with `parquet=False` it connects to its warehouse URL
+    instead (to export it).
+    """
+    settings = database_settings()
+    source = get_source(source)
+    pool_args = {
+        "pool_size": settings["pool_size"],
+        "max_overflow": settings["max_overflow"],
+        "pool_recycle": settings["pool_recycle"],
+        "pool_pre_ping": settings["pool_pre_ping"],
+    }
+
+    # Backend columnar embebido sobre la exportación Parquet de la fuente
+    if parquet and source["backend"] == "duckdb":
+        return create_duckdb_engine(source, **pool_args)
+
+    url = make_url(os.getenv(source["url_env"]))
+
+    # En Postgres el statement_timeout se fija al abrir cada conexión,
+    # así aplica a todas las consultas del pool
+    connect_args = {}
+    if url.get_backend_name() == "postgresql":
+        connect_args = {
+            "application_name": settings["application_name"],
+            "options": f"-c statement_timeout={settings['statement_timeout_ms']}",
+        }
+
+    return create_engine(url, connect_args=connect_args, **pool_args)
+
+
+def _read_sql(conn, sql, params, name):
+    """
+    Run the SQL of a named query and return its result. A STREAMED query is
+    read through a server-side cursor in blocks of `stream_chunksize` rows,
+    each compacted before the next one arrives, so peak memory stays close
+    to the size of the final frame instead of all rows as Python objects.
+    """
+    query = text(sql) if params else sql
+    counts = COUNT_COLUMNS.get(name, [])
+    if name not in STREAMED:
+        return _compact(pd.read_sql(query, conn, params=params or None), counts)
+
+    chunksize = database_settings()["stream_chunksize"]
+    conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+    chunks = pd.read_sql(query, conn, params=params or None, chunksize=chunksize)
+    return _concat_compact(_compact(chunk, counts) for chunk in chunks)
+
+
+def _compact(df, counts=()):
+    """
+    Give a query result compact numeric dtypes straight from the driver:
+    int32 counts and ids, float32 measures (Decimal included), nullable
+    integers for count and id columns (`counts` and *_id) with gaps,
+    datetime dates and categorical text
+    """
+    for col in df.columns:
+        series = df[col]
+        if series.dtype == object:
+            values = series.dropna()
+            first = values.iloc[0] if len(values) else None
+            if isinstance(first, date):
+                df[col] = pd.to_datetime(series)
+                continue
+            if isinstance(first, Decimal):
+                series = pd.to_numeric(series, errors="coerce").astype("float64")
+
+        if pd.api.types.is_bool_dtype(series):
+            pass
+        elif pd.api.types.is_integer_dtype(series):
+            series = _downcast_int(series)
+        elif series.dtype == "float64":
+            values = series.dropna()
+            # Conteos e ids con huecos (NULL) llegan como float64: se pasan a enteros con
+            # nulos. Una media que sale entera sigue siendo una medida decimal
+            if (col in counts or col.endswith("_id")) and len(values) and (values == values.round()).all():
+                series = _downcast_int(series.astype("Int64"))
+            else:
+                series = series.astype("float32")
+        elif pd.api.types.is_string_dtype(series) or series.dtype == object:
+            series = series.astype("category")
+        df[col] = series
+    return df
+
+
+def _downcast_int(series):
+    """
+    Return an integer column as 32 bits when its values fit
+    """
+    info = np.iinfo("int32")
+    if series.empty or (series.min() >= info.min and series.max() <= info.max):
+        return series.astype("Int32" if isinstance(series.dtype, pd.Int64Dtype) else "int32")
+    return series
+
+
+def _extrapolate(df, columns, fraction):
+    """
+    Return a result computed on a sample of persons with its count
+    columns scaled to the whole population
+    """
+    if df.empty:
+        return df
+    df = df.copy()
+    for column in columns:
+        if column in df.columns:
+            scaled = (df[column] / fraction).round()
+            df[column] = _downcast_int(scaled.astype("Int64" if scaled.isna().any() else "int64"))
+    return df
+
+
+def _concat_compact(chunks):
+    """
+    Concatenate compacted blocks, merging the categories of text columns
+    (a plain concat would turn them back into objects)
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame()
+
+    columns = {}
+    for col in chunks[0].columns:
+        parts = [chunk[col] for chunk in chunks]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            columns[col] = pd.Series(union_categoricals(parts), name=col)
+        else:
+            columns[col] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+def _pivot_domains(df, value_col, fill_value, kind):
+    """
+    Pivot the per-domain monthly counts to one column per domain, in the
+    column order of the data density charts
+    """
+    names = {domain: total if kind == "total" else avg for domain, total, avg in DENSITY_DOMAINS}
+    wide = (
+        df.dropna(subset=["month_date"])
+        .pivot_table(index="month_date", columns="domain", values=value_col, aggfunc="sum")
+        .reindex(columns=[domain for domain, _, _ in DENSITY_DOMAINS])
+        .sort_index()
+    )
+    if fill_value is not None:
+        wide = wide.fillna(fill_value).astype("int32")
+    wide.columns = [names[domain] for domain in wide.columns]
+    return wide
+
+
+def _rebin(df, bin_width):
+    """
+    Merge 1-year histogram bins (bin_start, total) into bins of `bin_width` years
+    """
+    if df.empty:
+        return df
+
+    starts = pd.to_numeric(df["bin_start"], errors="coerce")
+    df = df.assign(bin_start=(starts // bin_width) * bin_width).dropna(subset=["bin_start"])
+    binned = df.groupby("bin_start", as_index=False)["total"].sum()
+    binned["bin_start"] = binned["bin_start"].astype("int32")
+    return binned
+
+
+def _weighted_quantile(values, cum_counts, p):
+    """
+    Linear-interpolated quantile of sorted values repeated cum_counts-wise
+    (same method as Plotly's default box quartiles)
+    """
+    position = (cum_counts[-1] - 1) * p
+    lower, upper = int(np.floor(position)), int(np.ceil(position))
+    v_lower = values[np.searchsorted(cum_counts, lower, side="right")]
+    v_upper = values[np.searchsorted(cum_counts, upper, side="right")]
+    return v_lower + (position - lower) * (v_upper - v_lower)
+
+
+def _box_stats(df):
+    """
+    Reduce a (domain, n_concepts, persons) frequency table to box plot
+    statistics per domain: quartiles, Tukey whiskers, mean and a capped
+    sample of outlier values
+    """
+    if df.empty:
+        return df
+
+    rows = []
+    for domain, group in df.groupby("domain", sort=True):
+        group = group.sort_values("n_concepts")
+        values = group["n_concepts"].to_numpy(dtype="float64")
+        counts = group["persons"].to_numpy(dtype="int64")
+        cum_counts = counts.cumsum()
+
+        q1, median, q3 = (_weighted_quantile(values, cum_counts, p) for p in (0.25, 0.5, 0.75))
+        iqr = q3 - q1
+        inside = (values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)
+        outliers = values[~inside]
+        if len(outliers) > MAX_BOX_OUTLIERS:
+            outliers = outliers[np.linspace(0, len(outliers) - 1, MAX_BOX_OUTLIERS).astype(int)]
+
+        rows.append({
+            "domain": domain,
+            "n": int(cum_counts[-1]),
+            "min": values[0],
+            "q1": q1,
+            "median": median,
+            "q3": q3,
+            "max": values[-1],
+            "lowerfence": values[inside].min(),
+            "upperfence": values[inside].max(),
+            "mean": float((values * counts).sum() / cum_counts[-1]),
+            "outliers": outliers.tolist(),
+        })
+    return pd.DataFrame(rows)
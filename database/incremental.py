@@ -0,0 +1,360 @@
+"""
+Incremental refresh of the summary tables driven by CDM change detection.
+
+A state table in each results schema keeps a watermark per CDM table (max
+id, row count and max event date: aggregates the id and date indexes can
+answer, with no pass over the concept columns). On refresh only the
+summaries that read a changed table are touched. When a table only received appended rows, the
+monthly density buckets, per-concept counts and per-person rows those rows
+fall into are recomputed and merged in place, and the per-person
+distribution is recomputed from its per-person summary; any other change
+rebuilds the summary. A reload that rewrites rows in place without
+changing their ids, number or dates is not detected: run it with --full.
+
+    python -m database.incremental [--source NAME] [--full]
+"""
+import argparse
+import re
+import sys
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+from sqlalchemy import inspect, text
+from dotenv import load_dotenv
+
+from database.queries import EVENT_TABLES, QUERIES, render
+from database.settings import cdm_sources, get_source
+from database.summaries import build_summaries, build_summary, summary_exists, summary_table
+
+# Cargar variables de entorno
+load_dotenv(override=True)
+
+STATE_TABLE = "summary_watermark"
+
+# Columna id de las tablas que no son de eventos
+ID_COLUMNS = {
+    "person": "person_id",
+    "observation_period": "observation_period_id",
+    "concept": "concept_id",
+    **{spec["table"]: spec["id"] for spec in EVENT_TABLES.values()},
+}
+
+# Columna de fecha de las tablas de eventos
+DATE_COLUMNS = {spec["table"]: spec["date"] for spec in EVENT_TABLES.values()}
+
+# Columnas del watermark que se comparan para decidir si una tabla cambió
+WATERMARK_COLUMNS = ["row_count", "max_id", "max_date"]
+
+# Dominio de cada tabla de eventos en records_per_person_per_domain
+RECORDS_DOMAINS = {
+    "condition_occurrence": "Condition",
+    "measurement": "Measurement",
+    "drug_exposure": "Drug",
+    "observation": "Observation",
+    "procedure_occurrence": "Procedure",
+}
+
+# Resúmenes que se actualizan por claves: para cada tabla de origen, la expresión
+# que da las claves tocadas por filas nuevas, la columna clave del resumen, un
+# filtro adicional y la columna por la que se acota el rango de claves. La consulta
+# que recalcula solo esas claves se deriva de la de QUERIES (`partial_query`)
+INCREMENTAL = {
+    "domain_month_counts": {
+        spec["table"]: {
+            "key_expr": f"DATE_TRUNC('month', {spec['date']})::DATE",
+            "key": "month_date",
+            "where": f"domain = '{domain}'",
+            "range": spec["date"],
+        }
+        for domain, spec in EVENT_TABLES.items()
+    },
+    "conditions_per_person": {
+        "condition_occurrence": {
+            "key_expr": "condition_concept_id",
+            "key": "condition_concept_id",
+            "where": "TRUE",
+            "range": "condition_concept_id",
+        },
+    },
+    "visits_concepts": {
+        "visit_occurrence": {
+            "key_expr": "visit_concept_id",
+            "key": "visit_concept_id",
+            "where": "TRUE",
+            "range": "visit_concept_id",
+        },
+    },
+    "visit_type_concept_id": {
+        "visit_occurrence": {
+            "key_expr": "visit_type_concept_id",
+            "key": "visit_type_concept_id",
+            "where": "TRUE",
+            "range": "visit_type_concept_id",
+        },
+    },
+    "records_per_person_per_domain": {
+        table: {
+            "key_expr": "person_id",
+            "key": "person_id",
+            "where": f"domain = '{domain}'",
+            "range": "person_id",
+        }
+        for table, domain in RECORDS_DOMAINS.items()
+    },
+}
+
+# Resúmenes que se recalculan desde otro resumen (ya actualizado, antes en QUERIES)
+# en lugar de recorrer el CDM: resumen de origen y consulta sobre él
+DERIVED = {
+    "concepts_per_person_distribution": (
+        "records_per_person_per_domain",
+        "SELECT domain, n_concepts, COUNT(*) AS persons FROM {summary} GROUP BY domain, n_concepts",
+    ),
+}
+
+# Los resúmenes de dominio (domain_summary_*) se reconstruyen siempre: su faceta de
+# tipos de registro tiene pocas claves que cubren casi toda la tabla y sus personas
+# distintas no se pueden sumar, así que recalcular las claves tocadas no ahorra el recorrido
+
+
+def partial_query(name, table):
+    """
+    Return the template of a query of INCREMENTAL restricted to the keys
+    of the rows of `table` with an id above :max_id: the branch of the
+    UNION ALL that reads the table, with the key predicate injected before
+    its GROUP BY and without ORDER BY
+    """
+    spec = INCREMENTAL[name][table]
+    branch = next(
+        branch for branch in re.split(r"\bUNION ALL\b", QUERIES[name])
+        if re.search(rf"\{{cdm\}}\.{table}\b", branch)
+    )
+    branch = re.sub(r"\s+ORDER BY\b.*$", "", branch.strip().rstrip(";"), flags=re.S | re.I)
+    predicate = f"{spec['range']} >= :first_key AND {spec['key_expr']} IN ({new_keys(table, spec['key_expr'])})"
+    if re.search(r"\bWHERE\b", branch, re.I):
+        return re.sub(r"\bWHERE\b", f"WHERE {predicate} AND", branch, count=1, flags=re.I)
+    return re.sub(r"\bGROUP BY\b", f"WHERE {predicate}\n        GROUP BY", branch, count=1, flags=re.I)
+
+
+def new_keys(table, key_expr):
+    """
+    Return the template of the query that selects `key_expr` from the rows
+    of `table` with an id above :max_id (the appended rows)
+    """
+    return f"SELECT {key_expr} FROM {{cdm}}.{table} WHERE {ID_COLUMNS[table]} > :max_id"
+
+
+def query_tables(name):
+    """
+    Return the CDM tables read by a query
+    """
+    return set(re.findall(r"\{cdm\}\.(\w+)", QUERIES[name]))
+
+
+def current_watermarks(conn, source):
+    """
+    Return the current watermark of every CDM table read by the dashboard
+    """
+    tables = set().union(*(query_tables(name) for name in QUERIES))
+    rows = []
+    for table in sorted(tables):
+        date_col = DATE_COLUMNS.get(table)
+        max_date = f"MAX({date_col})" if date_col else "NULL"
+        df = pd.read_sql(
+            f"SELECT MAX({ID_COLUMNS[table]}) AS max_id, COUNT(*) AS row_count, {max_date} AS max_date "
+            f"FROM {source['schema']}.{table}",
+            conn,
+        )
+        rows.append({"table_name": table, **df.iloc[0].to_dict()})
+    return pd.DataFrame(rows).set_index("table_name")
+
+
+def _same(column, old, new):
+    if pd.isna(old) or pd.isna(new):
+        return pd.isna(old) and pd.isna(new)
+    if column == "max_date":
+        return pd.Timestamp(old) == pd.Timestamp(new)
+    return int(old) == int(new)
+
+
+def _changed(old, new):
+    """
+    Return True if the watermark of a table differs from the stored one
+    """
+    return not all(_same(column, old[column], new[column]) for column in WATERMARK_COLUMNS)
+
+
+def stored_watermarks(conn, source):
+    """
+    Return the watermarks saved by the last refresh, or None if there is none
+    """
+    if not inspect(conn).has_table(STATE_TABLE, schema=source["results_schema"]):
+        return None
+    return pd.read_sql(f"SELECT * FROM {source['results_schema']}.{STATE_TABLE}", conn).set_index("table_name")
+
+
+def save_watermarks(engine, source, watermarks):
+    state = f"{source['results_schema']}.{STATE_TABLE}"
+    refreshed_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    with engine.begin() as conn:
+        # Se recrea en cada guardado: así un estado antiguo pierde o gana columnas
+        conn.execute(text(f"DROP TABLE IF EXISTS {state}"))
+        conn.execute(text(
+            f"CREATE TABLE {state} "
+            "(table_name VARCHAR(100), max_id BIGINT, row_count BIGINT, max_date DATE, refreshed_at TIMESTAMP)"
+        ))
+        for table, row in watermarks.iterrows():
+            conn.execute(
+                text(f"INSERT INTO {state} VALUES (:table_name, :max_id, :row_count, :max_date, :refreshed_at)"),
+                {
+                    "table_name": table,
+                    "max_id": None if pd.isna(row["max_id"]) else int(row["max_id"]),
+                    "row_count": int(row["row_count"]),
+                    "max_date": None if pd.isna(row["max_date"]) else row["max_date"],
+                    "refreshed_at": refreshed_at,
+                },
+            )
+
+
+def refresh_stamp(conn, source):
+    """
+    Return when the summaries of a source were last refreshed, or None
+    """
+    if not inspect(conn).has_table(STATE_TABLE, schema=source["results_schema"]):
+        return None
+    df = pd.read_sql(f"SELECT MAX(refreshed_at) AS refreshed_at FROM {source['results_schema']}.{STATE_TABLE}", conn)
+    return str(df.iloc[0, 0])
+
+
+def _appended_only(conn, source, table, old, new):
+    """
+    Return True if the only change to a table since `old` is rows with a
+    higher id, i.e. a plain append: the new row count is the old one plus
+    the rows above the old max id (counted on the id index, not the table)
+    """
+    if pd.isna(old["max_id"]) or new["row_count"] < old["row_count"]:
+        return False
+    added = conn.execute(
+        text(f"SELECT COUNT(*) FROM {source['schema']}.{table} WHERE {ID_COLUMNS[table]} > :max_id"),
+        {"max_id": int(old["max_id"])},
+    ).scalar()
+    return int(old["row_count"]) + added == int(new["row_count"])
+
+
+def merge_summary(engine, source, name, table, max_id):
+    """
+    Recompute the keys of a summary touched by the rows of `table` with an
+    id above `max_id` and replace them in place. Return the number of keys
+    merged, or None if the change cannot be merged (e.g. NULL keys).
+    """
+    spec = INCREMENTAL[name][table]
+    # Las claves se seleccionan con una subconsulta sobre las filas nuevas: con
+    # claves por persona una lista de parámetros sería más lenta que reconstruir
+    keys = render(new_keys(table, spec["key_expr"]), source["schema"])
+    with engine.begin() as conn:
+        count, nulls, first_key = conn.execute(
+            text(f"SELECT COUNT(DISTINCT k), COUNT(*) - COUNT(k), MIN(k) FROM ({keys}) new_keys(k)"),
+            {"max_id": max_id},
+        ).one()
+        if nulls:
+            return None
+        if not count:
+            return 0
+
+        params = {"max_id": max_id, "first_key": first_key}
+        conn.execute(
+            text(f"DELETE FROM {summary_table(source, name)} WHERE {spec['where']} AND {spec['key']} IN ({keys})"),
+            params,
+        )
+        partial = render(partial_query(name, table), source["schema"])
+        conn.execute(text(f"INSERT INTO {summary_table(source, name)} {partial}"), params)
+    return count
+
+
+def refresh(engine, source, full=False):
+    """
+    Bring the summaries of a source up to date with its CDM and return a
+    log line per summary that was merged or rebuilt
+    """
+    with engine.connect() as conn:
+        new = current_watermarks(conn, source)
+        old = None if full else stored_watermarks(conn, source)
+
+    if old is None:
+        timings = build_summaries(engine, source)
+        save_watermarks(engine, source, new)
+        return [f"{name}: reconstruido ({seconds:.1f}s)" for name, seconds in timings.items()]
+
+    changed = {
+        table for table in new.index
+        if table not in old.index or _changed(old.loc[table], new.loc[table])
+    }
+    with engine.connect() as conn:
+        appended = {
+            table for table in changed
+            if table in old.index and _appended_only(conn, source, table, old.loc[table], new.loc[table])
+        }
+
+    log = []
+    for name in QUERIES:
+        touched = query_tables(name) & changed
+        with engine.connect() as conn:
+            exists = summary_exists(conn, source, name)
+        # Sin cambios en sus tablas solo se construyen los resúmenes que aún no existen
+        if not touched and exists:
+            continue
+
+        start = time.perf_counter()
+        if name in DERIVED:
+            base, sql = DERIVED[name]
+            with engine.connect() as conn:
+                derivable = summary_exists(conn, source, base)
+            if derivable:
+                build_summary(engine, source, name, sql.format(summary=summary_table(source, base)))
+                log.append(f"{name}: recalculado desde {base} ({time.perf_counter() - start:.1f}s)")
+                continue
+
+        merged = None
+        if exists and name in INCREMENTAL and touched <= appended and touched <= set(INCREMENTAL[name]):
+            merged = 0
+            for table in touched:
+                keys = merge_summary(engine, source, name, table, int(old.loc[table, "max_id"]))
+                if keys is None:
+                    merged = None
+                    break
+                merged += keys
+
+        if merged is None:
+            build_summary(engine, source, name)
+            log.append(f"{name}: reconstruido ({time.perf_counter() - start:.1f}s)")
+        else:
+            log.append(f"{name}: {merged} claves actualizadas ({time.perf_counter() - start:.1f}s)")
+
+    save_watermarks(engine, source, new)
+    return log
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Refresh the dashboard summary tables incrementally")
+    parser.add_argument("--source", action="append", help="CDM source to refresh (all by default)")
+    parser.add_argument("--full", action="store_true", help="rebuild every summary and reset the watermarks")
+    args = parser.parse_args(argv)
+
+    # Importado aquí: database.db_manager depende de este módulo
+    from database.db_manager import create_source_engine
+
+    for source_name in args.source or cdm_sources():
+        source = get_source(source_name)
+        if source["backend"] == "duckdb":
+            print(f"[{source_name}] backend duckdb: lee Parquet, no usa tablas de resumen")
+            continue
+        engine = create_source_engine(source_name)
+        lines = refresh(engine, source, args.full)
+        for line in lines or ["sin cambios"]:
+            print(f"[{source_name}] {line}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
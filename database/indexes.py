@@ -0,0 +1,206 @@
+"""
+Index advisor for the access paths of the dashboard queries.
+
+Lists the columns the `DataManager` queries group, join or filter by (the
+concept, type and date columns of each event table, person_id, and the
+person columns of the cohort filter), compares them with the indexes of
+the CDM schema and reports the missing ones. On PostgreSQL each missing
+index comes with an EXPLAIN estimate of the queries that read its table:
+their current cost and, when the hypopg extension is installed, their
+cost with a hypothetical index. With --create the missing indexes are
+built with CREATE INDEX CONCURRENTLY, so the CDM stays readable.
+
+    python -m database.indexes [--source NAME] [--create]
+"""
+import argparse
+import sys
+import time
+from datetime import date
+
+from sqlalchemy import inspect, text
+from dotenv import load_dotenv
+
+from database.cohort import Cohort
+from database.db_manager import create_source_engine
+from database.incremental import query_tables
+from database.queries import EVENT_TABLES, QUERIES
+from database.settings import cdm_sources, get_source
+
+# Cargar variables de entorno
+load_dotenv(override=True)
+
+# Columnas que necesitan índice: las de agrupación y filtro de cada tabla de eventos,
+# las del filtro de cohorte en person y las de las búsquedas por id
+INDEX_COLUMNS = {
+    "person": ["gender_concept_id", "year_of_birth"],
+    "observation_period": ["person_id", "observation_period_end_date"],
+    "concept": ["concept_id"],
+    **{
+        spec["table"]: list(dict.fromkeys(["person_id", spec["concept"], spec["type"], spec["date"]]))
+        for spec in EVENT_TABLES.values()
+    },
+}
+
+# Cohorte de ejemplo para estimar el efecto de los índices sobre las consultas filtradas
+SAMPLE_COHORT = Cohort(start_date=date(date.today().year - 1, 1, 1), gender_concept_ids=(8532,))
+
+
+def index_name(table, column):
+    return f"idx_{table}_{column}"[:63]
+
+
+def indexed_columns(conn, schema, table):
+    """
+    Return the columns that lead an index (or the primary key) of a table
+    """
+    # duckdb_engine no refleja índices: se leen del catálogo de DuckDB
+    if conn.dialect.name == "duckdb":
+        leading = {
+            expressions.strip("[]").split(",")[0].strip().strip('"')
+            for (expressions,) in conn.execute(
+                text("SELECT expressions FROM duckdb_indexes() WHERE schema_name = :schema AND table_name = :table"),
+                {"schema": schema, "table": table},
+            )
+        }
+        leading.update(
+            columns[0]
+            for (columns,) in conn.execute(
+                text(
+                    "SELECT constraint_column_names FROM duckdb_constraints() "
+                    "WHERE schema_name = :schema AND table_name = :table AND constraint_type IN ('PRIMARY KEY', 'UNIQUE')"
+                ),
+                {"schema": schema, "table": table},
+            )
+        )
+        return leading
+
+    inspector = inspect(conn)
+    leading = {index["column_names"][0] for index in inspector.get_indexes(table, schema=schema) if index["column_names"]}
+    primary_key = inspector.get_pk_constraint(table, schema=schema).get("constrained_columns") or []
+    if primary_key:
+        leading.add(primary_key[0])
+    return leading
+
+
+def missing_indexes(conn, source):
+    """
+    Return the (table, column) pairs used by the dashboard queries that no
+    index of the CDM schema starts with
+    """
+    schema = source["schema"]
+    tables = set().union(*(query_tables(name) for name in QUERIES)) | {"concept"}
+    inspector = inspect(conn)
+    missing = []
+    for table in sorted(tables & set(INDEX_COLUMNS)):
+        if not inspector.has_table(table, schema=schema):
+            continue
+        indexed = indexed_columns(conn, schema, table)
+        missing.extend((table, column) for column in INDEX_COLUMNS[table] if column not in indexed)
+    return missing
+
+
+def probe_queries(source, table):
+    """
+    Return the SQL and parameters of the dashboard queries that read a
+    table, as run for the whole CDM and for a sample cohort
+    """
+    probes = []
+    for name, query in QUERIES.items():
+        if table not in query_tables(name):
+            continue
+        probes.append(Cohort().compile(query, source["schema"]))
+        probes.append(SAMPLE_COHORT.compile(query, source["schema"]))
+    return probes
+
+
+def explain_cost(conn, sql, params):
+    """
+    Return the total cost estimated by the PostgreSQL planner for a query
+    """
+    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql.strip().rstrip(';')}"), params).scalar()
+    return plan[0]["Plan"]["Total Cost"]
+
+
+def estimate(conn, source, table, column, hypothetical):
+    """
+    Return the estimated cost of the queries reading a table, without and
+    (with hypopg) with an index on `column`
+    """
+    probes = probe_queries(source, table)
+    before = sum(explain_cost(conn, sql, params) for sql, params in probes)
+    if not hypothetical:
+        return before, None
+
+    conn.execute(text("SELECT * FROM hypopg_create_index(:ddl)"), {"ddl": f"CREATE INDEX ON {source['schema']}.{table} ({column})"})
+    try:
+        after = sum(explain_cost(conn, sql, params) for sql, params in probes)
+    finally:
+        conn.execute(text("SELECT hypopg_reset()"))
+    return before, after
+
+
+def create_index(engine, source, table, column):
+    """
+    Build an index without blocking writes (CREATE INDEX CONCURRENTLY
+    cannot run inside a transaction)
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name(table, column)} "
+            f"ON {source['schema']}.{table} ({column})"
+        ))
+
+
+def advise(engine, source, create=False):
+    """
+    Return one report line per missing index of a source, building them if `create`
+    """
+    postgres = engine.dialect.name == "postgresql"
+    with engine.connect() as conn:
+        missing = missing_indexes(conn, source)
+        hypothetical = postgres and conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'hypopg'")).first() is not None
+
+        lines = []
+        for table, column in missing:
+            line = f"{source['schema']}.{table} ({column}): falta"
+            if postgres:
+                rows = conn.execute(
+                    text("SELECT reltuples::BIGINT FROM pg_class WHERE oid = to_regclass(:table)"),
+                    {"table": f"{source['schema']}.{table}"},
+                ).scalar()
+                before, after = estimate(conn, source, table, column, hypothetical)
+                line += f", ~{rows or 0:,} filas, coste EXPLAIN {before:,.0f}"
+                if after is not None and before:
+                    line += f" -> {after:,.0f} con el índice ({(before - after) / before:.0%} menos)"
+            lines.append(line)
+
+    if create:
+        if not postgres:
+            return lines + [f"--create solo está soportado en PostgreSQL (motor: {engine.dialect.name})"]
+        for i, (table, column) in enumerate(missing):
+            start = time.perf_counter()
+            create_index(engine, source, table, column)
+            lines[i] += f" -> creado {index_name(table, column)} ({time.perf_counter() - start:.1f}s)"
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report (and optionally create) the indexes the dashboard queries need")
+    parser.add_argument("--source", action="append", help="CDM source to inspect (all by default)")
+    parser.add_argument("--create", action="store_true", help="create the missing indexes concurrently (PostgreSQL)")
+    args = parser.parse_args(argv)
+
+    for source_name in args.source or cdm_sources():
+        source = get_source(source_name)
+        if source["backend"] == "duckdb":
+            print(f"[{source_name}] backend duckdb: lee Parquet, no usa índices")
+            continue
+        engine = create_source_engine(source_name)
+        lines = advise(engine, source, args.create)
+        for line in lines or ["todos los índices necesarios existen"]:
+            print(f"[{source_name}] {line}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Execution timing for the `DataManager` getters.
+
+Every getter is wrapped with `instrumented`, which records its wall time,
+rows and bytes returned, where the data came from (memory, persistent
+cache, summary table or live CDM query) and any error. Records are kept in
+a bounded in-process buffer for the Performance page and emitted as JSON
+log lines on the `omop_dashboard.queries` logger.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+import pandas as pd
+
+logger = logging.getLogger("omop_dashboard.queries")
+
+# Registros que se conservan en memoria para la página de rendimiento
+MAX_RECORDS = 10000
+
+_records = deque(maxlen=MAX_RECORDS)
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def report(source, error=None):
+    """
+    Tell the getter running on this thread where its data came from:
+    "disk" (persistent cache), "summary", "live", "coalesced" (waited
+    for the same query run by another session) or "error"
+    """
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1]["source"] = source
+        stack[-1]["error"] = error
+
+
+def instrumented(getter):
+    """
+    Record timing, size and data source of every call to a getter
+    """
+    @wraps(getter)
+    def wrapper(*args, **kwargs):
+        stack = _local.__dict__.setdefault("stack", [])
+        # Si el cuerpo del getter no llega a ejecutarse, el dato vino de st.cache_data
+        frame = {"source": "memory", "error": None}
+        stack.append(frame)
+        start = time.perf_counter()
+        df = None
+        try:
+            df = getter(*args, **kwargs)
+            return df
+        except Exception as e:
+            frame.update(source="error", error=str(e))
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            # Un getter que llama a otro getter no salió de la caché en memoria
+            if stack and stack[-1]["source"] == "memory":
+                stack[-1]["source"] = "derived"
+            _record(getter.__name__, args[1:], kwargs, seconds, df, frame)
+
+    return wrapper
+
+
+def _record(name, args, kwargs, seconds, df, frame):
+    is_frame = isinstance(df, pd.DataFrame)
+    entry = {
+        "ts": time.time(),
+        "query": name,
+        "params": ", ".join([repr(a) for a in args] + [f"{k}={v!r}" for k, v in kwargs.items()]),
+        "seconds": round(seconds, 6),
+        "rows": len(df) if is_frame else 0,
+        "bytes": int(df.memory_usage(deep=True).sum()) if is_frame else 0,
+        "source": frame["source"],
+        "error": frame["error"],
+    }
+    with _lock:
+        _records.append(entry)
+
+    if entry["error"]:
+        logger.error(json.dumps(entry))
+    else:
+        logger.info(json.dumps(entry))
+
+
+def get_records():
+    """
+    Return the recorded getter calls as a DataFrame, oldest first
+    """
+    with _lock:
+        return pd.DataFrame(list(_records), columns=["ts", "query", "params", "seconds", "rows", "bytes", "source", "error"])
+
+
+def summarize(records):
+    """
+    Return one row per getter with call count, latency percentiles, size,
+    memory/disk cache hit rate and error count
+    """
+    if records.empty:
+        return records
+
+    grouped = records.groupby("query")
+    return pd.DataFrame({
+        "calls": grouped.size(),
+        "p50_s": grouped["seconds"].median(),
+        "p95_s": grouped["seconds"].quantile(0.95),
+        "max_s": grouped["seconds"].max(),
+        "avg_rows": grouped["rows"].mean(),
+        "avg_bytes": grouped["bytes"].mean(),
+        "cache_hit_rate": grouped["source"].apply(lambda s: s.isin(["memory", "disk", "coalesced"]).mean()),
+        "errors": grouped["error"].count(),
+    }).sort_values("p95_s", ascending=False).reset_index()
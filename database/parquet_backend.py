@@ -0,0 +1,149 @@
+"""
+Embedded DuckDB/Parquet backend for a CDM source.
+
+The CDM tables the dashboard reads are exported once from the warehouse to
+Parquet files (event tables partitioned by year of their event date). A
+source with `backend = "duckdb"` then runs the same SQL through an
+in-process DuckDB that exposes those files as views under the CDM schema,
+so the getters return the same DataFrames without touching the warehouse.
+
+    python -m database.parquet_backend --source synthea10 [--chunksize 500000]
+
+Requires pyarrow for the export and duckdb plus duckdb_engine for queries.
+"""
+import argparse
+import shutil
+import sys
+import time
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = ds = None
+
+import pandas as pd
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from dotenv import load_dotenv
+
+from database.queries import EVENT_TABLES
+from database.settings import cdm_sources, get_source
+
+# Cargar variables de entorno
+load_dotenv(override=True)
+
+# Tablas de eventos y fecha usada para particionar por año
+PARTITION_COLUMNS = {spec["table"]: spec["date"] for spec in EVENT_TABLES.values()}
+
+# Tablas exportadas: las de eventos más las de personas y vocabulario
+CDM_TABLES = ["person", "observation_period", "concept", "cdm_source", *PARTITION_COLUMNS]
+
+# Columna de partición añadida a las tablas de eventos
+PARTITION_KEY = "event_year"
+
+
+def export_table(conn, source, table, chunksize):
+    """
+    Stream one CDM table into Parquet files under the source's parquet_dir
+    and return the number of rows written
+    """
+    target = Path(source["parquet_dir"]) / table
+    staging = target.with_name(f"{table}__staging")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+
+    date_col = PARTITION_COLUMNS.get(table)
+    chunks = pd.read_sql(f"SELECT * FROM {source['schema']}.{table}", conn, chunksize=chunksize)
+    rows = 0
+    for i, chunk in enumerate(chunks):
+        if date_col:
+            chunk[PARTITION_KEY] = pd.to_datetime(chunk[date_col]).dt.year.fillna(0).astype("int32")
+        ds.write_dataset(
+            pa.Table.from_pandas(chunk, preserve_index=False),
+            staging,
+            format="parquet",
+            partitioning=[PARTITION_KEY] if date_col else None,
+            partitioning_flavor="hive" if date_col else None,
+            basename_template=f"chunk{i:05d}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        rows += len(chunk)
+
+    # Tabla vacía: un fichero sin filas conserva las columnas para la vista
+    if rows == 0:
+        empty = pd.read_sql(f"SELECT * FROM {source['schema']}.{table} LIMIT 0", conn)
+        empty.to_parquet(staging / "chunk00000-0.parquet", index=False)
+
+    # Reemplazo de la exportación anterior solo cuando la nueva está completa
+    shutil.rmtree(target, ignore_errors=True)
+    staging.rename(target)
+    return rows
+
+
+def export_source(source_name=None, tables=None, chunksize=500_000):
+    """
+    Export the CDM tables of a source to Parquet and return the rows and
+    seconds spent on each table
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow no está instalado: pip install pyarrow")
+
+    # Importado aquí: database.db_manager usa este módulo para el backend duckdb
+    from database.db_manager import create_source_engine
+
+    source = get_source(source_name)
+    engine = create_source_engine(source["name"], parquet=False)
+    report = {}
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for table in tables or CDM_TABLES:
+            start = time.perf_counter()
+            rows = export_table(conn, source, table, chunksize)
+            report[table] = (rows, time.perf_counter() - start)
+    return report
+
+
+def create_duckdb_engine(source, **engine_kwargs):
+    """
+    Return a SQLAlchemy engine over an in-process DuckDB where every
+    exported table is a view `<cdm schema>.<table>` over its Parquet files
+    """
+    directory = Path(source["parquet_dir"]).resolve()
+    # QueuePool explícito: por defecto una base en memoria usaría un pool de un solo hilo
+    engine = create_engine("duckdb:///:memory:", poolclass=QueuePool, **engine_kwargs)
+
+    @event.listens_for(engine, "connect")
+    def create_views(dbapi_connection, connection_record):
+        # Cada conexión del pool es una base en memoria: las vistas se crean al conectar
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {source['schema']}")
+        for table in CDM_TABLES:
+            if not (directory / table).is_dir():
+                continue
+            files = (directory / table / "**" / "*.parquet").as_posix()
+            cursor.execute(
+                f"CREATE OR REPLACE VIEW {source['schema']}.{table} AS "
+                f"SELECT * FROM read_parquet('{files}', hive_partitioning = true, union_by_name = true)"
+            )
+        cursor.close()
+
+    return engine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export CDM tables to Parquet for the DuckDB backend")
+    parser.add_argument("--source", action="append", help="CDM source to export (all by default)")
+    parser.add_argument("--table", action="append", choices=CDM_TABLES, help="tables to export (all by default)")
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    args = parser.parse_args(argv)
+
+    for source_name in args.source or cdm_sources():
+        for table, (rows, seconds) in export_source(source_name, args.table, args.chunksize).items():
+            print(f"[{source_name}] {table}: {rows:,} filas en {seconds:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
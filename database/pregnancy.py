@@ -0,0 +1,347 @@
+"""
+Pregnancy episode pipeline.
+
+Derives one row per pregnancy episode (start, end, outcome and gestational
+age) from the condition, procedure, measurement and observation records of
+female persons, and stores them in `<results_schema>.pregnancy_episode`,
+the table the pregnancy page of the dashboard reads.
+
+The concepts are found by name in the vocabulary (see `OUTCOMES`,
+`GESTATION_PATTERNS` and `MARKER_PATTERNS`):
+
+- outcome records (live birth, stillbirth, abortion...) closer than
+  `MIN_OUTCOME_GAP` days belong to the same episode, which ends at the
+  first of them;
+- the start comes from the last gestational-age record of the pregnancy
+  (date minus the recorded weeks) or, without one, from the typical
+  length of the outcome;
+- pregnancy markers outside every outcome episode form episodes with an
+  unknown outcome.
+
+Persons are split into person_id ranges. Each range is read with one query
+and processed with vectorized pandas operations in a worker process, so
+the run time grows linearly with the number of persons and the pool uses
+every core. Run it after each CDM load, like the summaries:
+
+    python -m database.pregnancy [--source NAME] [--workers N] [--chunk-persons N]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import bindparam, create_engine, inspect, make_url, text
+from sqlalchemy.types import Date
+from dotenv import load_dotenv
+
+from database.queries import EVENT_TABLES
+from database.settings import cdm_sources, get_source
+
+# Cargar variables de entorno
+load_dotenv(override=True)
+
+EPISODE_TABLE = "pregnancy_episode"
+
+# Una fila por ejecución del pipeline; su fecha forma parte de la versión del CDM
+RUN_TABLE = "pregnancy_episode_run"
+
+FEMALE_CONCEPT_ID = 8532
+
+# Desenlaces en orden de prioridad: un concepto que encaja en varios patrones, o un
+# episodio con varios desenlaces, se queda con el primero.
+# código -> (etiqueta, patrones del nombre del concepto, duración típica en días)
+OUTCOMES = {
+    "SB": ("Stillbirth", ["stillbirth", "stillborn", "fetal death"], 196),
+    "ECT": ("Ectopic pregnancy", ["ectopic pregnancy"], 56),
+    "SA": ("Spontaneous abortion", ["miscarriage", "spontaneous abortion"], 70),
+    "AB": ("Induced abortion", ["induced abortion", "termination of pregnancy", "abortion"], 70),
+    "LB": ("Live birth", ["live birth", "livebirth", "liveborn", "delivery"], 280),
+}
+
+# Episodios con marcadores de embarazo pero sin desenlace registrado
+UNKNOWN_OUTCOME = "PREG"
+OUTCOME_LABELS = {code: label for code, (label, _, _) in OUTCOMES.items()} | {UNKNOWN_OUTCOME: "Outcome unknown"}
+
+# Registros de edad gestacional: semanas en value_as_number o en el nombre ("32 weeks gestation")
+GESTATION_PATTERNS = ["gestational age", "weeks gestation"]
+WEEKS_IN_NAME = r"(\d+) weeks? gestation"
+
+# Otros registros que indican un embarazo en curso
+MARKER_PATTERNS = ["pregnan", "prenatal", "antenatal"]
+
+# Dominios leídos; measurement y observation traen además value_as_number
+SOURCE_DOMAINS = {"condition": False, "procedure": False, "measurement": True, "observation": True}
+
+# Días entre desenlaces de embarazos distintos
+MIN_OUTCOME_GAP = 168
+
+# Duración máxima de un embarazo (43 semanas): ventana para buscar la edad gestacional
+MAX_TERM = 301
+
+# Márgenes alrededor de un episodio en los que un marcador pertenece a él
+PRENATAL_MARGIN = 30
+POSTPARTUM_MARGIN = 42
+
+MIN_WEEKS, MAX_WEEKS = 1, 44
+
+# Personas por bloque del pool
+CHUNK_PERSONS = 100_000
+
+EPISODE_COLUMNS = [
+    "person_id", "episode_number", "episode_start_date", "episode_end_date",
+    "outcome", "gestational_age_days", "gestation_source",
+]
+
+
+def concept_sets(conn, schema):
+    """
+    Return the pregnancy concepts of the vocabulary: concept_id, kind
+    ("outcome", "gestation" or "marker"), outcome code and the gestational
+    weeks written in the name, if any
+    """
+    patterns = [pattern for _, patterns, _ in OUTCOMES.values() for pattern in patterns] + GESTATION_PATTERNS + MARKER_PATTERNS
+    params = {f"p{i}": f"%{pattern}%" for i, pattern in enumerate(patterns)}
+    where = " OR ".join(f"LOWER(concept_name) LIKE :{name}" for name in params)
+    df = pd.read_sql(text(f"SELECT concept_id, LOWER(concept_name) AS name FROM {schema}.concept WHERE {where}"), conn, params=params)
+
+    df["outcome"] = None
+    for code, (_, patterns, _) in reversed(OUTCOMES.items()):
+        df.loc[df["name"].str.contains("|".join(patterns), regex=True), "outcome"] = code
+    gestation = df["name"].str.contains("|".join(GESTATION_PATTERNS), regex=True)
+    df["kind"] = np.where(df["outcome"].notna(), "outcome", np.where(gestation, "gestation", "marker"))
+    df["weeks"] = df["name"].str.extract(WEEKS_IN_NAME)[0].astype("float64")
+    return df[["concept_id", "kind", "outcome", "weeks"]]
+
+
+def person_ranges(conn, schema, chunk_persons=CHUNK_PERSONS):
+    """
+    Return (first, last) person_id ranges of about `chunk_persons` persons each
+    """
+    first, last, persons = conn.execute(text(f"SELECT MIN(person_id), MAX(person_id), COUNT(*) FROM {schema}.person")).one()
+    if not persons:
+        return []
+    step = math.ceil((last - first + 1) / math.ceil(persons / chunk_persons))
+    return [(start, min(start + step - 1, last)) for start in range(first, last + 1, step)]
+
+
+def events_query(schema):
+    """
+    Return the SQL reading the pregnancy records of the female persons of
+    a person_id range from every source table, in one round trip
+    """
+    selects = []
+    for domain, has_value in SOURCE_DOMAINS.items():
+        spec = EVENT_TABLES[domain]
+        selects.append(
+            f"SELECT e.person_id, e.{spec['date']} AS event_date, e.{spec['concept']} AS concept_id, "
+            f"{'e.value_as_number' if has_value else 'CAST(NULL AS FLOAT)'} AS value_as_number "
+            f"FROM {schema}.{spec['table']} e "
+            f"WHERE e.person_id BETWEEN :first AND :last AND e.{spec['concept']} IN :concept_ids"
+        )
+    return text(
+        f"SELECT * FROM ({' UNION ALL '.join(selects)}) events "
+        f"WHERE person_id IN (SELECT person_id FROM {schema}.person "
+        f"WHERE gender_concept_id = {FEMALE_CONCEPT_ID} AND person_id BETWEEN :first AND :last)"
+    ).bindparams(bindparam("concept_ids", expanding=True))
+
+
+def detect_episodes(events, concepts):
+    """
+    Return the pregnancy episodes found in the records of a set of persons
+    (person_id, event_date, concept_id, value_as_number), without a loop
+    over persons: every step is a sort, a shift, a group-by or an as-of merge
+    """
+    ev = events.merge(concepts, on="concept_id")
+    if ev.empty:
+        return pd.DataFrame(columns=EPISODE_COLUMNS)
+    ev["event_date"] = pd.to_datetime(ev["event_date"]).astype("datetime64[ns]")
+    ev = ev.sort_values(["person_id", "event_date"], kind="stable").reset_index(drop=True)
+
+    # Edad gestacional: semanas registradas como valor o, si no, escritas en el nombre del concepto
+    weeks = ev["value_as_number"].astype("float64").fillna(ev["weeks"])
+    valid = (ev["kind"] == "gestation") & weeks.between(MIN_WEEKS, MAX_WEEKS)
+    ev["estimated_start"] = (ev["event_date"] - pd.to_timedelta(weeks * 7, unit="D")).where(valid).dt.floor("D")
+
+    # 1. Desenlaces: los separados por menos de MIN_OUTCOME_GAP días son del mismo embarazo
+    rank = {code: i for i, code in enumerate(OUTCOMES)}
+    out = ev[ev["kind"] == "outcome"]
+    new = out["person_id"].ne(out["person_id"].shift()) | (out["event_date"].diff().dt.days > MIN_OUTCOME_GAP)
+    episodes = (
+        out.assign(rank=out["outcome"].map(rank), episode=new.cumsum())
+        .groupby("episode")
+        .agg(person_id=("person_id", "first"), episode_end_date=("event_date", "min"), rank=("rank", "min"))
+    )
+    episodes["outcome"] = np.array(list(OUTCOMES), dtype=object)[episodes["rank"].to_numpy(dtype=int)]
+
+    # 2. Inicio: último registro de edad gestacional de la ventana del embarazo o duración típica
+    gestation = ev.loc[valid, ["person_id", "event_date", "estimated_start"]]
+    episodes = pd.merge_asof(
+        episodes.sort_values("episode_end_date"), gestation.sort_values("event_date"),
+        left_on="episode_end_date", right_on="event_date", by="person_id",
+        direction="backward", tolerance=pd.Timedelta(days=MAX_TERM),
+    )
+    typical = pd.to_timedelta(episodes["outcome"].map({code: days for code, (_, _, days) in OUTCOMES.items()}), unit="D")
+    episodes["gestation_source"] = np.where(episodes["estimated_start"].notna(), "recorded", "typical")
+    episodes["episode_start_date"] = episodes["estimated_start"].fillna(episodes["episode_end_date"] - typical)
+
+    # Un embarazo no empieza antes de que termine el anterior de la misma persona
+    episodes = episodes.sort_values(["person_id", "episode_end_date"])
+    previous_end = episodes.groupby("person_id")["episode_end_date"].shift()
+    episodes["episode_start_date"] = episodes["episode_start_date"].where(
+        previous_end.isna() | (episodes["episode_start_date"] > previous_end), previous_end + pd.Timedelta(days=1)
+    )
+
+    # 3. Marcadores fuera de todo episodio con desenlace: embarazos de desenlace desconocido
+    markers = ev.loc[ev["kind"] != "outcome", ["person_id", "event_date", "estimated_start"]]
+    windows = episodes[["person_id", "episode_start_date", "episode_end_date"]].assign(
+        window_start=episodes["episode_start_date"] - pd.Timedelta(days=PRENATAL_MARGIN)
+    )
+    matched = pd.merge_asof(
+        markers.sort_values("event_date"), windows.sort_values("window_start"),
+        left_on="event_date", right_on="window_start", by="person_id", direction="backward",
+    )
+    covered = matched["event_date"] <= matched["episode_end_date"] + pd.Timedelta(days=POSTPARTUM_MARGIN)
+    loose = matched.loc[~covered, ["person_id", "event_date", "estimated_start"]].sort_values(["person_id", "event_date"])
+    new = loose["person_id"].ne(loose["person_id"].shift()) | (loose["event_date"].diff().dt.days > MAX_TERM)
+    # Una cadena de marcadores más larga que un embarazo se parte en tramos de MAX_TERM días
+    chain = new.cumsum()
+    elapsed = (loose["event_date"] - loose.groupby(chain)["event_date"].transform("min")).dt.days
+    unknown = (
+        loose.assign(chain=chain, part=elapsed // (MAX_TERM + 1), start=loose["estimated_start"].fillna(loose["event_date"]))
+        .groupby(["chain", "part"])
+        .agg(
+            person_id=("person_id", "first"),
+            episode_start_date=("start", "min"),
+            episode_end_date=("event_date", "max"),
+            recorded=("estimated_start", "count"),
+        )
+    )
+    unknown["outcome"] = UNKNOWN_OUTCOME
+    unknown["gestation_source"] = np.where(unknown["recorded"] > 0, "recorded", "markers")
+
+    # 4. Unir, numerar los episodios de cada persona y calcular la edad gestacional
+    episodes = pd.concat([episodes, unknown], ignore_index=True).sort_values(["person_id", "episode_start_date"], kind="stable")
+    episodes["episode_number"] = episodes.groupby("person_id").cumcount() + 1
+    episodes["episode_start_date"] = episodes["episode_start_date"].clip(lower=episodes["episode_end_date"] - pd.Timedelta(days=MAX_TERM))
+    episodes["gestational_age_days"] = (episodes["episode_end_date"] - episodes["episode_start_date"]).dt.days.clip(lower=0)
+    return episodes[EPISODE_COLUMNS].reset_index(drop=True)
+
+
+# Motor de cada proceso del pool (no se puede enviar entre procesos)
+_worker_engine = None
+
+
+def _init_worker(url):
+    global _worker_engine
+    # DuckDB no admite varios procesos escribiendo el mismo fichero: los workers solo leen
+    connect_args = {"read_only": True} if make_url(url).get_backend_name() == "duckdb" else {}
+    _worker_engine = create_engine(url, connect_args=connect_args)
+
+
+def process_chunk(schema, concepts, first, last):
+    """
+    Return the episodes of the persons of a person_id range and the
+    number of records read (runs in a worker process)
+    """
+    with _worker_engine.connect() as conn:
+        events = pd.read_sql(
+            events_query(schema), conn,
+            params={"first": int(first), "last": int(last), "concept_ids": concepts["concept_id"].astype(int).tolist()},
+        )
+    return detect_episodes(events, concepts), len(events)
+
+
+def save_episodes(engine, source, episodes, seconds):
+    """
+    Replace the episode table of a source (built under a staging name and
+    swapped in one transaction) and record the run
+    """
+    results = source["results_schema"]
+    staging = f"{EPISODE_TABLE}__staging"
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {results}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {results}.{staging}"))
+    episodes.to_sql(
+        staging, engine, schema=results, index=False, chunksize=10_000,
+        dtype={"episode_start_date": Date(), "episode_end_date": Date()},
+    )
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {results}.{EPISODE_TABLE}"))
+        conn.execute(text(f"ALTER TABLE {results}.{staging} RENAME TO {EPISODE_TABLE}"))
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {results}.{RUN_TABLE} "
+            "(built_at TIMESTAMP, persons BIGINT, episodes BIGINT, seconds FLOAT)"
+        ))
+        conn.execute(
+            text(f"INSERT INTO {results}.{RUN_TABLE} VALUES (:built_at, :persons, :episodes, :seconds)"),
+            {
+                "built_at": datetime.now(timezone.utc).replace(tzinfo=None),
+                "persons": int(episodes["person_id"].nunique()),
+                "episodes": len(episodes),
+                "seconds": seconds,
+            },
+        )
+
+
+def episode_stamp(conn, source):
+    """
+    Return when the episode table of a source was last built, or None
+    """
+    if not inspect(conn).has_table(RUN_TABLE, schema=source["results_schema"]):
+        return None
+    df = pd.read_sql(f"SELECT MAX(built_at) AS built_at FROM {source['results_schema']}.{RUN_TABLE}", conn)
+    return str(df.iloc[0, 0])
+
+
+def build_episodes(url, source, workers=None, chunk_persons=CHUNK_PERSONS):
+    """
+    Run the pipeline on a CDM source and return the episodes found
+    """
+    start = time.perf_counter()
+    engine = create_engine(url)
+    with engine.connect() as conn:
+        concepts = concept_sets(conn, source["schema"])
+        ranges = person_ranges(conn, source["schema"], chunk_persons)
+    # Cerrar las conexiones del proceso principal antes de que los workers abran las suyas
+    engine.dispose()
+    print(f"[{source['name']}] {len(concepts):,} conceptos de embarazo, {len(ranges)} bloques de personas")
+
+    chunks = []
+    if not concepts.empty:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(url,)) as pool:
+            futures = [pool.submit(process_chunk, source["schema"], concepts, first, last) for first, last in ranges]
+            for done, future in enumerate(as_completed(futures), 1):
+                episodes, records = future.result()
+                chunks.append(episodes)
+                print(f"[{source['name']}] bloque {done}/{len(futures)}: {records:,} registros, {len(episodes):,} episodios")
+
+    episodes = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=EPISODE_COLUMNS)
+    save_episodes(create_engine(url), source, episodes, time.perf_counter() - start)
+    return episodes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Derive the pregnancy episodes of a CDM into the results schema")
+    parser.add_argument("--source", action="append", help="CDM source to process (all by default)")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--chunk-persons", type=int, default=CHUNK_PERSONS, help="persons per chunk")
+    args = parser.parse_args(argv)
+
+    for source_name in args.source or cdm_sources():
+        source = get_source(source_name)
+        start = time.perf_counter()
+        episodes = build_episodes(os.getenv(source["url_env"]), source, args.workers, args.chunk_persons)
+        print(
+            f"[{source_name}] {source['results_schema']}.{EPISODE_TABLE}: {len(episodes):,} episodios de "
+            f"{episodes['person_id'].nunique():,} personas en {time.perf_counter() - start:.1f}s"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,389 @@
+"""
+SQL de las consultas del dashboard sobre el CDM OMOP.
+
+Cada consulta tiene un nombre que la identifica en `DataManager` y en las
+tablas de resumen precalculadas (ver `database.summaries`). El esquema del
+CDM se escribe `{cdm}` y se sustituye con `render` según la fuente activa.
+"""
+
+# Tablas de eventos del CDM por dominio, con sus columnas de id, fecha, concepto y tipo
+EVENT_TABLES = {
+    "condition": {"table": "condition_occurrence", "id": "condition_occurrence_id", "date": "condition_start_date", "concept": "condition_concept_id", "type": "condition_type_concept_id"},
+    "measurement": {"table": "measurement", "id": "measurement_id", "date": "measurement_date", "concept": "measurement_concept_id", "type": "measurement_type_concept_id"},
+    "death": {"table": "death", "id": "person_id", "date": "death_date", "concept": "cause_concept_id", "type": "death_type_concept_id"},
+    "observation": {"table": "observation", "id": "observation_id", "date": "observation_date", "concept": "observation_concept_id", "type": "observation_type_concept_id"},
+    "visit": {"table": "visit_occurrence", "id": "visit_occurrence_id", "date": "visit_start_date", "concept": "visit_concept_id", "type": "visit_type_concept_id"},
+    "procedure": {"table": "procedure_occurrence", "id": "procedure_occurrence_id", "date": "procedure_date", "concept": "procedure_concept_id", "type": "procedure_type_concept_id"},
+    "drug": {"table": "drug_exposure", "id": "drug_exposure_id", "date": "drug_exposure_start_date", "concept": "drug_concept_id", "type": "drug_type_concept_id"},
+    "device": {"table": "device_exposure", "id": "device_exposure_id", "date": "device_exposure_start_date", "concept": "device_concept_id", "type": "device_type_concept_id"},
+}
+
+# Sello de versión del CDM, parte de la clave de la caché persistente
+CDM_VERSION_QUERY = """
+    SELECT cdm_version, cdm_release_date, vocabulary_version
+    FROM {cdm}.cdm_source
+    """
+
+# Conceptos de sexo del vocabulario, opciones del filtro de cohorte. domain_id tiene
+# índice en el DDL del CDM: no hace falta recorrer person ni la tabla concept entera
+GENDER_CONCEPTS_QUERY = """
+    SELECT concept_id, concept_name
+    FROM {cdm}.concept
+    WHERE domain_id = 'Gender'
+    ORDER BY concept_name
+    """
+
+# Conceptos distintos por persona y dominio (una fila por persona)
+RECORDS_PER_PERSON_PER_DOMAIN = """
+        -- 1. Condition (Diagnósticos)
+        SELECT
+            person_id,
+            'Condition' AS domain,
+            COUNT(DISTINCT condition_concept_id) AS n_concepts
+        FROM {cdm}.condition_occurrence
+        GROUP BY person_id
+
+        UNION ALL
+
+        -- 2. Measurement (Laboratorios/Mediciones)
+        -- Nota: En OMOP estándar la tabla suele llamarse 'measurement', no 'measurement_occurrence'
+        SELECT
+            person_id,
+            'Measurement' AS domain,
+            COUNT(DISTINCT measurement_concept_id) AS n_concepts
+        FROM {cdm}.measurement
+        GROUP BY person_id
+
+        UNION ALL
+
+        -- 3. Drug (Medicamentos)
+        SELECT
+            person_id,
+            'Drug' AS domain,
+            COUNT(DISTINCT drug_concept_id) AS n_concepts
+        FROM {cdm}.drug_exposure
+        GROUP BY person_id
+
+        UNION ALL
+
+        -- 4. Observation (Historia Social/Otros)
+        SELECT
+            person_id,
+            'Observation' AS domain,
+            COUNT(DISTINCT observation_concept_id) AS n_concepts
+        FROM {cdm}.observation
+        GROUP BY person_id
+
+        UNION ALL
+
+        -- 5. Procedure (Procedimientos)
+        SELECT
+            person_id,
+            'Procedure' AS domain,
+            COUNT(DISTINCT procedure_concept_id) AS n_concepts
+        FROM {cdm}.procedure_occurrence
+        GROUP BY person_id
+        """
+
+# Resumen genérico de un dominio de eventos en un solo recorrido de su tabla:
+# conceptos, tipos de registro y meses (con registros y personas distintas) y la
+# distribución de registros por persona, distinguidos por la columna facet
+DOMAIN_SUMMARY = """
+        WITH events AS (
+            SELECT person_id, {concept} AS concept_id, {type} AS type_concept_id, DATE_TRUNC('month', {date})::DATE AS month_date
+            FROM {{cdm}}.{table}
+        ),
+        grouped AS (
+            SELECT
+                concept_id, type_concept_id, month_date, person_id,
+                GROUPING(concept_id) AS no_concept,
+                GROUPING(type_concept_id) AS no_type,
+                GROUPING(person_id) AS no_person,
+                COUNT(*) AS records,
+                COUNT(DISTINCT person_id) AS persons
+            FROM events
+            GROUP BY GROUPING SETS ((concept_id), (type_concept_id), (month_date), (person_id))
+        )
+        SELECT
+            CASE WHEN no_concept = 0 THEN 'concept' WHEN no_type = 0 THEN 'type' ELSE 'month' END AS facet,
+            COALESCE(concept_id, type_concept_id) AS concept_id,
+            month_date,
+            CAST(NULL AS BIGINT) AS n_records,
+            records,
+            persons
+        FROM grouped
+        WHERE no_person = 1
+
+        UNION ALL
+
+        SELECT 'per_person', NULL, NULL, records, SUM(records), COUNT(*)
+        FROM grouped
+        WHERE no_person = 0
+        GROUP BY records
+        """
+
+# Dominios de la línea de tiempo de una persona, en el orden en que se muestran
+TIMELINE_DOMAINS = ["visit", "condition", "procedure", "drug", "measurement", "observation"]
+
+# Todos los eventos de una persona en un solo viaje a la base de datos: una fila
+# 'person' (año de nacimiento y sexo) y una fila por evento de cada dominio
+PERSON_TIMELINE = "\n        UNION ALL\n".join([
+    """
+        SELECT 'person' AS domain, MAKE_DATE(year_of_birth, 1, 1) AS event_date, gender_concept_id AS concept_id
+        FROM {cdm}.person WHERE person_id = :person_id
+    """,
+    *(
+        f"""
+        SELECT '{domain}', {EVENT_TABLES[domain]['date']}, {EVENT_TABLES[domain]['concept']}
+        FROM {{cdm}}.{EVENT_TABLES[domain]['table']} WHERE person_id = :person_id
+        """
+        for domain in TIMELINE_DOMAINS
+    ),
+])
+
+QUERIES = {
+    "count_patients": """
+        SELECT count(*) as total
+        FROM {cdm}.person
+        """,
+
+    "sex": """
+        SELECT person.gender_concept_id, count(person.gender_concept_id) as total
+        FROM {cdm}.person
+        GROUP BY person.gender_concept_id;
+        """,
+
+    "race": """
+        SELECT person.race_concept_id, count(person.race_concept_id) as total
+        FROM {cdm}.person
+        GROUP BY person.race_concept_id;
+        """,
+
+    "ethnicity": """
+        SELECT person.ethnicity_concept_id, count(person.ethnicity_concept_id) as total
+        FROM {cdm}.person
+        GROUP BY person.ethnicity_concept_id;
+        """,
+
+    # Histogramas binados en la base de datos a 1 año; DataManager reagrupa a otros anchos
+    "age_at_first_seen": """
+        SELECT EXTRACT(YEAR FROM AGE(p.birth_datetime)) AS bin_start, COUNT(*) AS total
+        FROM {cdm}.observation_period op
+        JOIN {cdm}.person p ON p.person_id = op.person_id
+        GROUP BY 1
+        """,
+
+    "conditions_per_person": """
+        SELECT COUNT(DISTINCT co.person_id) AS cnt , co.condition_concept_id
+        FROM {cdm}.condition_occurrence co
+        GROUP BY co.condition_concept_id
+        ORDER BY cnt DESC, co.condition_concept_id;
+        """,
+
+    "domain_month_counts": """
+        SELECT DATE_TRUNC('month', condition_start_date)::DATE AS month_date, 'condition' AS domain, COUNT(*) AS total_recs, COUNT(DISTINCT person_id) AS unique_ppl
+        FROM {cdm}.condition_occurrence GROUP BY 1
+
+        UNION ALL
+
+        SELECT DATE_TRUNC('month', measurement_date)::DATE, 'measurement', COUNT(*), COUNT(DISTINCT person_id)
+        FROM {cdm}.measurement GROUP BY 1
+
+        UNION ALL
+
+        SELECT DATE_TRUNC('month', death_date)::DATE, 'death', COUNT(*), COUNT(DISTINCT person_id)
+        FROM {cdm}.death GROUP BY 1
+
+        UNION ALL
+
+        SELECT DATE_TRUNC('month', observation_date)::DATE, 'observation', COUNT(*), COUNT(DISTINCT person_id)
+        FROM {cdm}.observation GROUP BY 1
+
+        UNION ALL
+
+        SELECT DATE_TRUNC('month', visit_start_date)::DATE, 'visit', COUNT(*), COUNT(DISTINCT person_id)
+        FROM {cdm}.visit_occurrence GROUP BY 1
+
+        UNION ALL
+
+        SELECT DATE_TRUNC('month', procedure_date)::DATE, 'procedure', COUNT(*), COUNT(DISTINCT person_id)
+        FROM {cdm}.procedure_occurrence GROUP BY 1
+
+        UNION ALL
+
+        SELECT DATE_TRUNC('month', drug_exposure_start_date)::DATE, 'drug', COUNT(*), COUNT(DISTINCT person_id)
+        FROM {cdm}.drug_exposure GROUP BY 1
+
+        UNION ALL
+
+        SELECT DATE_TRUNC('month', device_exposure_start_date)::DATE, 'device', COUNT(*), COUNT(DISTINCT person_id)
+        FROM {cdm}.device_exposure GROUP BY 1;
+        """,
+
+    "records_per_person_per_domain": RECORDS_PER_PERSON_PER_DOMAIN,
+
+    # Distribución de conceptos distintos por persona: una fila por (dominio, valor),
+    # suficiente para calcular cuartiles y bigotes exactos sin traer una fila por persona
+    "concepts_per_person_distribution": f"""
+        SELECT domain, n_concepts, COUNT(*) AS persons
+        FROM ({RECORDS_PER_PERSON_PER_DOMAIN}) per_person
+        GROUP BY domain, n_concepts
+        """,
+
+    "year_of_birth_patients": """
+        SELECT year_of_birth AS bin_start, COUNT(*) AS total
+        FROM {cdm}.person
+        GROUP BY 1
+        """,
+
+    "visits_concepts": """
+        SELECT visit_concept_id, COUNT(*) as cnt
+        FROM {cdm}.visit_occurrence v
+        GROUP BY visit_concept_id
+        ORDER BY cnt DESC, visit_concept_id;
+        """,
+
+    "visits_duration": """
+        WITH visit_duration AS (
+            SELECT
+                visit_occurrence_id,
+                visit_start_datetime,
+                visit_end_datetime,
+                (EXTRACT(EPOCH FROM (visit_end_datetime - visit_start_datetime))) / 86400 AS length_of_stay_days
+            FROM
+                {cdm}.visit_occurrence
+        )
+        SELECT
+            AVG (length_of_stay_days)
+        FROM
+            visit_duration
+        WHERE
+            length_of_stay_days <= 365;
+        """,
+
+    "visit_type_concept_id": """
+        SELECT visit_type_concept_id, COUNT(*) as cnt
+        FROM {cdm}.visit_occurrence v
+        GROUP BY visit_type_concept_id
+        ORDER BY cnt DESC, visit_type_concept_id;
+        """,
+
+    # Un resumen por dominio de eventos: domain_summary_condition, domain_summary_drug...
+    **{f"domain_summary_{domain}": DOMAIN_SUMMARY.format(**spec) for domain, spec in EVENT_TABLES.items()},
+}
+
+# Consultas sobre la tabla de episodios de embarazo que construye `database.pregnancy`
+# en el esquema de resultados ({results}); el JOIN con person aplica el filtro de cohorte
+EPISODE_QUERIES = {
+    "pregnancy_episode_count": """
+        SELECT COUNT(*) AS total
+        FROM {results}.pregnancy_episode e
+        JOIN {cdm}.person p ON p.person_id = e.person_id
+        """,
+
+    "pregnancy_outcomes": """
+        SELECT e.outcome, COUNT(*) AS total
+        FROM {results}.pregnancy_episode e
+        JOIN {cdm}.person p ON p.person_id = e.person_id
+        GROUP BY e.outcome
+        ORDER BY total DESC, e.outcome
+        """,
+
+    # Sin los episodios de desenlace desconocido: su duración es solo la de sus marcadores
+    "pregnancy_gestational_age": """
+        SELECT CAST(FLOOR(e.gestational_age_days / 7.0) AS INTEGER) AS gestational_weeks, COUNT(*) AS total
+        FROM {results}.pregnancy_episode e
+        JOIN {cdm}.person p ON p.person_id = e.person_id
+        WHERE e.outcome <> 'PREG'
+        GROUP BY 1
+        ORDER BY 1
+        """,
+
+    "pregnancy_episodes_per_month": """
+        SELECT DATE_TRUNC('month', e.episode_end_date)::DATE AS month_date, COUNT(*) AS episodes
+        FROM {results}.pregnancy_episode e
+        JOIN {cdm}.person p ON p.person_id = e.person_id
+        GROUP BY 1
+        ORDER BY 1
+        """,
+}
+
+# Columna de concept_id de las consultas cuyo resultado lleva concept_name: el
+# nombre no se une en SQL sino después, desde el diccionario de conceptos del proceso
+CONCEPT_NAME_COLUMNS = {
+    "sex": "gender_concept_id",
+    "race": "race_concept_id",
+    "ethnicity": "ethnicity_concept_id",
+    "conditions_per_person": "condition_concept_id",
+    "visits_concepts": "visit_concept_id",
+    "visit_type_concept_id": "visit_type_concept_id",
+}
+
+# Consultas que el dashboard muestra limitadas a los N primeros conceptos. El
+# resumen guarda todos los conceptos (así se puede actualizar por concepto) y el
+# límite se aplica al leer
+TOP_N = {
+    "conditions_per_person": 50,
+    "visits_concepts": 50,
+    "visit_type_concept_id": 50,
+}
+
+# Columnas de conteo (registros o personas) de cada consulta. Con una cohorte
+# muestreada se extrapolan a la cohorte completa dividiendo por la fracción de la
+# muestra; promedios, distribuciones por persona e ids no se tocan
+COUNT_COLUMNS = {
+    "count_patients": ["total"],
+    "sex": ["total"],
+    "race": ["total"],
+    "ethnicity": ["total"],
+    "age_at_first_seen": ["total"],
+    "conditions_per_person": ["cnt"],
+    "domain_month_counts": ["total_recs", "unique_ppl"],
+    "concepts_per_person_distribution": ["persons"],
+    "year_of_birth_patients": ["total"],
+    "visits_concepts": ["cnt"],
+    "visit_type_concept_id": ["cnt"],
+    **{f"domain_summary_{domain}": ["records", "persons"] for domain in EVENT_TABLES},
+    "pregnancy_episode_count": ["total"],
+    "pregnancy_outcomes": ["total"],
+    "pregnancy_gestational_age": ["total"],
+    "pregnancy_episodes_per_month": ["episodes"],
+}
+
+# Consultas que devuelven una fila por persona: se leen por bloques con cursor de
+# servidor y cada bloque se compacta antes de acumularlo
+STREAMED = {"records_per_person_per_domain"}
+
+# Orden de lectura de las tablas de resumen (CREATE TABLE AS no conserva el ORDER BY).
+# Los empates se desempatan por concept_id para que todos los backends devuelvan lo mismo
+SUMMARY_ORDER = {
+    "conditions_per_person": "cnt DESC, condition_concept_id",
+    "domain_month_counts": "month_date ASC, domain ASC",
+    "visits_concepts": "cnt DESC, visit_concept_id",
+    "visit_type_concept_id": "cnt DESC, visit_type_concept_id",
+}
+
+
+def query_template(name, results_schema):
+    """
+    Return the template of a named query, with the results schema of the
+    episode queries filled in
+    """
+    if name in QUERIES:
+        return QUERIES[name]
+    return EPISODE_QUERIES[name].replace("{results}", results_schema)
+
+
+def render(query, schema):
+    """
+    Return the SQL of a query for the given CDM schema
+    """
+    return query.format(cdm=schema)
+
+
+def with_limit(sql, name):
+    """
+    Return the SQL with the top-N limit of the query appended, if it has one
+    """
+    sql = sql.strip().rstrip(";")
+    return f"{sql}\nLIMIT {TOP_N[name]}" if name in TOP_N else sql
@@ -0,0 +1,112 @@
+"""
+Dashboard settings read from `config.toml`, overridable by environment
+variables. The file is parsed once per process; the environment overrides
+are applied on every call.
+"""
+import functools
+import os
+import re
+import tomllib
+from pathlib import Path
+
+CONFIG_PATH = Path(os.getenv("DASHBOARD_CONFIG", Path(__file__).resolve().parent.parent / "config.toml"))
+
+# Valores por defecto de la sección [database] y variable de entorno que los sobrescribe
+DATABASE_DEFAULTS = {
+    "pool_size": (5, "DB_POOL_SIZE"),
+    "max_overflow": (10, "DB_MAX_OVERFLOW"),
+    "pool_recycle": (1800, "DB_POOL_RECYCLE"),
+    "pool_pre_ping": (True, "DB_POOL_PRE_PING"),
+    "statement_timeout_ms": (300000, "DB_STATEMENT_TIMEOUT_MS"),
+    "application_name": ("omop_dashboard", "DB_APPLICATION_NAME"),
+    "stream_chunksize": (50000, "DB_STREAM_CHUNKSIZE"),
+}
+
+# Motores de consulta disponibles para una fuente CDM
+BACKENDS = ("postgres", "duckdb")
+
+
+@functools.lru_cache(maxsize=1)
+def _load_config():
+    try:
+        with open(CONFIG_PATH, "rb") as f:
+            return tomllib.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def load_section(name):
+    """
+    Return one section of config.toml as a dict (empty if missing); it is
+    shared by every caller and must not be modified
+    """
+    return _load_config().get(name, {})
+
+
+def _coerce(value, default):
+    if isinstance(default, bool):
+        return str(value).strip().lower() in ("1", "true", "yes", "on")
+    return type(default)(value)
+
+
+def database_settings():
+    """
+    Return the connection pool and query limits for the SQLAlchemy engine
+    """
+    section = load_section("database")
+    settings = {}
+    for key, (default, env_var) in DATABASE_DEFAULTS.items():
+        value = os.getenv(env_var, section.get(key, default))
+        settings[key] = _coerce(value, default)
+    return settings
+
+
+def _identifier(value, what):
+    # Los esquemas se interpolan en el SQL: solo se aceptan identificadores simples
+    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", value):
+        raise ValueError(f"{what} no válido: {value!r}")
+    return value
+
+
+def cdm_sources():
+    """
+    Return the CDM instances served by the dashboard, from the [sources.*]
+    sections of config.toml: name -> label, schema, url_env, results_schema,
+    backend ("postgres" or "duckdb") and parquet_dir (used by "duckdb").
+
+    Without any configured source, a single "default" source is built from
+    DATABASE_URL, CDM_SCHEMA and RESULTS_SCHEMA.
+    """
+    section = load_section("sources")
+    if not section:
+        section = {"default": {
+            "schema": os.getenv("CDM_SCHEMA", "cdm_synthea10"),
+            "results_schema": os.getenv("RESULTS_SCHEMA", "dashboard_results"),
+        }}
+
+    sources = {}
+    for name, cfg in section.items():
+        schema = _identifier(cfg.get("schema", "cdm_synthea10"), "Esquema CDM")
+        sources[name] = {
+            "label": cfg.get("label", name),
+            "schema": schema,
+            "url_env": cfg.get("url_env", "DATABASE_URL"),
+            "results_schema": _identifier(cfg.get("results_schema", f"{schema}_results"), "Esquema de resultados"),
+            "backend": cfg.get("backend", "postgres"),
+            "parquet_dir": cfg.get("parquet_dir", f"data/parquet/{name}"),
+        }
+        if sources[name]["backend"] not in BACKENDS:
+            raise ValueError(f"Backend desconocido para {name}: {sources[name]['backend']!r}")
+    return sources
+
+
+def get_source(name=None):
+    """
+    Return one CDM source by name (the first configured one by default)
+    """
+    sources = cdm_sources()
+    if name is None:
+        name = next(iter(sources))
+    if name not in sources:
+        raise KeyError(f"Fuente CDM desconocida: {name}")
+    return {"name": name, **sources[name]}
@@ -0,0 +1,51 @@
+"""
+Request coalescing for `DataManager`.
+
+When several sessions open the same page on a cold cache they all miss at
+once and, without coordination, each runs the same heavy aggregate.
+`SingleFlight` lets the first caller of a key run the query while the
+others wait for its result, so the database sees one query per key.
+"""
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Run at most one call per key at a time; concurrent callers of the same
+    key share the result (or the exception) of the call in flight
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, fn):
+        """
+        Return (result of fn(), shared), where `shared` is True when the
+        result came from another caller's call
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            # Las llamadas posteriores vuelven a la caché, no a este resultado
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,117 @@
+"""
+Precomputed summary tables for the dashboard (Achilles-style).
+
+Every query in `database.queries` is materialized once per CDM refresh into
+the results schema of its source, so `DataManager` can read small tables
+instead of scanning the CDM. Run it after each CDM load:
+
+    python -m database.summaries [--source NAME] [query_name ...]
+"""
+import argparse
+import sys
+import time
+
+from sqlalchemy import inspect, text
+from dotenv import load_dotenv
+
+from database.queries import QUERIES, SUMMARY_ORDER, render, with_limit
+from database.settings import cdm_sources, get_source
+
+# Cargar variables de entorno
+load_dotenv(override=True)
+
+
+def summary_table(source, name):
+    """
+    Return the qualified name of the summary table for a query
+    """
+    return f"{source['results_schema']}.{name}"
+
+
+def summary_exists(conn, source, name):
+    """
+    Return True if the summary table for a query has been built
+    """
+    return inspect(conn).has_table(name, schema=source["results_schema"])
+
+
+def summary_query(source, name):
+    """
+    Return the SQL that reads a summary table in the order (and with the
+    top-N limit) of the live query
+    """
+    query = f"SELECT * FROM {summary_table(source, name)}"
+    if name in SUMMARY_ORDER:
+        query += f" ORDER BY {SUMMARY_ORDER[name]}"
+    return with_limit(query, name)
+
+
+def build_summary(engine, source, name, sql=None):
+    """
+    Materialize one query (or the given `sql` in its place) into its
+    summary table.
+
+    The table is built under a staging name and swapped in the same
+    transaction, so readers never see it missing or half-built.
+    """
+    sql = (sql or render(QUERIES[name], source["schema"])).strip().rstrip(";")
+    results = source["results_schema"]
+    staging = f"{name}__staging"
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {results}.{staging}"))
+        conn.execute(text(f"CREATE TABLE {results}.{staging} AS {sql}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {summary_table(source, name)}"))
+        conn.execute(text(f"ALTER TABLE {results}.{staging} RENAME TO {name}"))
+
+
+def build_summaries(engine, source, names=None):
+    """
+    Materialize the given queries (all by default) and return the seconds spent on each
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {source['results_schema']}"))
+
+    timings = {}
+    for name in names or QUERIES:
+        start = time.perf_counter()
+        build_summary(engine, source, name)
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the dashboard summary tables")
+    parser.add_argument("--source", action="append", help="CDM source to build (all by default)")
+    parser.add_argument("queries", nargs="*", help="queries to build (all by default)")
+    args = parser.parse_args(argv)
+
+    unknown = set(args.queries) - set(QUERIES)
+    if unknown:
+        print(f"Consultas desconocidas: {', '.join(sorted(unknown))}")
+        return 1
+
+    # Importados aquí: database.incremental y database.db_manager dependen de este módulo
+    from database.db_manager import create_source_engine
+    from database.incremental import current_watermarks, save_watermarks, stored_watermarks
+
+    for source_name in args.source or cdm_sources():
+        source = get_source(source_name)
+        if source["backend"] == "duckdb":
+            print(f"[{source_name}] backend duckdb: lee Parquet, no usa tablas de resumen")
+            continue
+        engine = create_source_engine(source_name)
+        for name, seconds in build_summaries(engine, source, args.queries or None).items():
+            print(f"[{source_name}] {summary_table(source, name)}: {seconds:.1f}s")
+
+        # Nuevo sello de refresco, para que el dashboard descarte los resultados anteriores.
+        # Una reconstrucción parcial conserva los watermarks de las demás tablas
+        with engine.connect() as conn:
+            watermarks = stored_watermarks(conn, source) if args.queries else None
+            if watermarks is None:
+                watermarks = current_watermarks(conn, source)
+        save_watermarks(engine, source, watermarks)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Longitudinal timeline of a single person.
+
+Every event of a person is read in one round trip (`PERSON_TIMELINE`, a
+UNION ALL over the event tables) and kept as a `Timeline`: parallel numpy
+arrays sorted by date, 17 bytes per event, instead of a DataFrame of
+Python objects. `PersonTimelines` keeps the most recently viewed persons,
+so stepping back and forth through patients does not query the CDM again.
+"""
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from database.concepts import MISSING_CONCEPT_NAME
+from database.queries import TIMELINE_DOMAINS
+
+# Máximo de personas en memoria (las más recientes)
+PERSON_CACHE_SIZE = int(os.getenv("PERSON_CACHE_SIZE", "64"))
+
+
+@dataclass(frozen=True, eq=False)
+class Timeline:
+    """
+    Events of a person sorted by date: `domains` (int8 codes into
+    TIMELINE_DOMAINS), `dates` (datetime64[D]) and `concept_ids` (int64)
+    are parallel arrays; `names` maps each concept id to its name
+    """
+    person_id: int
+    gender_concept_id: int | None = None
+    year_of_birth: int | None = None
+    domains: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int8))
+    dates: np.ndarray = field(default_factory=lambda: np.empty(0, dtype="datetime64[D]"))
+    concept_ids: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+    names: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_frame(cls, person_id, df, names):
+        """
+        Build the timeline from the rows of `PERSON_TIMELINE`
+        """
+        person = df[df["domain"] == "person"]
+        events = df[df["domain"] != "person"].sort_values("event_date", kind="stable")
+        gender, birth = (person.iloc[0]["concept_id"], person.iloc[0]["event_date"]) if not person.empty else (None, None)
+        return cls(
+            person_id=int(person_id),
+            gender_concept_id=None if pd.isna(gender) else int(gender),
+            year_of_birth=None if pd.isna(birth) else pd.Timestamp(birth).year,
+            domains=pd.Categorical(events["domain"], categories=TIMELINE_DOMAINS).codes.astype(np.int8),
+            dates=pd.to_datetime(events["event_date"]).to_numpy().astype("datetime64[D]"),
+            concept_ids=events["concept_id"].fillna(0).to_numpy(dtype=np.int64),
+            names=names,
+        )
+
+    def __len__(self):
+        return len(self.dates)
+
+    def exists(self):
+        """
+        Return True if the person is in the CDM
+        """
+        return self.year_of_birth is not None or len(self) > 0
+
+    def counts(self):
+        """
+        Return the number of events of each domain
+        """
+        return dict(zip(TIMELINE_DOMAINS, np.bincount(self.domains, minlength=len(TIMELINE_DOMAINS)).tolist()))
+
+    def to_frame(self):
+        """
+        Return the events as a DataFrame (domain, event_date, concept_id,
+        concept_name) for the charts; ids without a concept get
+        MISSING_CONCEPT_NAME
+        """
+        names = pd.Series(self.names, dtype=object)
+        return pd.DataFrame({
+            "domain": pd.Categorical.from_codes(self.domains, categories=TIMELINE_DOMAINS),
+            "event_date": self.dates.astype("datetime64[s]"),
+            "concept_id": self.concept_ids,
+            "concept_name": pd.Categorical(names.reindex(self.concept_ids).fillna(MISSING_CONCEPT_NAME).to_numpy()),
+        })
+
+
+class PersonTimelines:
+    """
+    Bounded LRU mapping (source, person_id) -> Timeline, shared by every
+    session and thread
+    """
+
+    def __init__(self, max_entries=PERSON_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._timelines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._timelines)
+
+    def clear(self):
+        with self._lock:
+            self._timelines.clear()
+
+    def get(self, key):
+        with self._lock:
+            timeline = self._timelines.get(key)
+            if timeline is not None:
+                self._timelines.move_to_end(key)
+            return timeline
+
+    def put(self, key, timeline):
+        with self._lock:
+            self._timelines[key] = timeline
+            self._timelines.move_to_end(key)
+            while len(self._timelines) > self.max_entries:
+                self._timelines.popitem(last=False)
@@ -0,0 +1,150 @@
+"""
+Cache warm-up job.
+
+Runs every dashboard query but the per-person ones for every configured
+CDM source, for the whole CDM and for each cohort preset of config.toml, on
+a thread pool, so the persistent result cache (see `database.cache`) is
+full before the first visitor arrives. Progress is written to a status file that the app reads
+to show a "warming" notice. Run it at container start or on a schedule:
+
+    python -m database.warmup [--source NAME] [--workers N]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from dotenv import load_dotenv
+from sqlalchemy import inspect
+
+from database.cohort import Cohort, cohort_presets
+from database.pregnancy import EPISODE_TABLE
+from database.queries import EPISODE_QUERIES, QUERIES, STREAMED
+from database.settings import cdm_sources, database_settings, get_source
+
+# Cargar variables de entorno
+load_dotenv(override=True)
+
+logger = logging.getLogger("omop_dashboard")
+
+STATUS_PATH = Path(os.getenv("WARMUP_STATUS_FILE", ".cache/warmup.json"))
+
+# Un estado "running" sin actualizar en este tiempo es de un proceso que murió
+STALE_SECONDS = 15 * 60
+
+
+def write_status(status, path=STATUS_PATH):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps({**status, "updated_at": time.time()}))
+    os.replace(tmp, path)
+
+
+def read_status(path=STATUS_PATH):
+    """
+    Return the last status written by the warm-up job, or None
+    """
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def is_warming(status):
+    """
+    Return True if a warm-up job is running right now
+    """
+    return bool(status) and status["state"] == "running" and time.time() - status["updated_at"] < STALE_SECONDS
+
+
+def has_episodes(source_name):
+    """
+    Return True if the pregnancy pipeline has built the episode table of a source
+    """
+    from database.db_manager import DataManager
+
+    source = get_source(source_name)
+    try:
+        with DataManager.get_engine(source_name).connect() as conn:
+            return inspect(conn).has_table(EPISODE_TABLE, schema=source["results_schema"])
+    except Exception as e:
+        logger.warning(f"No se pudo comprobar la tabla de episodios de {source_name}: {e}")
+        return False
+
+
+def warmup_tasks(source_names=None):
+    """
+    Return one (source, preset, cohort, query) task per query to warm; the
+    pregnancy queries only for the sources with an episode table
+    """
+    # Las consultas de una fila por persona (STREAMED) llenarían la caché: se calculan al abrir su vista
+    queries = [name for name in QUERIES if name not in STREAMED]
+    cohorts = {"": Cohort(), **{name: cohort for name, (_, cohort) in cohort_presets().items()}}
+    tasks = []
+    for source in source_names or cdm_sources():
+        names = [*queries, *(EPISODE_QUERIES if has_episodes(source) else [])]
+        tasks += [(source, preset, cohort, name) for preset, cohort in cohorts.items() for name in names]
+    return tasks
+
+
+def run(tasks, workers):
+    """
+    Fetch every task through `DataManager` (filling the persistent cache)
+    and return one (task, seconds, rows) result per task
+    """
+    from database.db_manager import DataManager
+
+    data_manager = DataManager()
+
+    def warm(task):
+        source, _, cohort, name = task
+        start = time.perf_counter()
+        df = data_manager._fetch(name, source, cohort)
+        return time.perf_counter() - start, len(df)
+
+    status = {"state": "running", "started_at": time.time(), "done": 0, "total": len(tasks), "empty": 0}
+    write_status(status)
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="warmup") as pool:
+            futures = {pool.submit(warm, task): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                seconds, rows = future.result()
+                results.append((task, seconds, rows))
+                status["done"] += 1
+                status["empty"] += rows == 0
+                write_status(status)
+
+                source, preset, _, name = task
+                label = f"{source}/{preset}" if preset else source
+                print(f"[{status['done']}/{status['total']}] {label} {name}: {rows:,} filas en {seconds:.1f}s")
+    finally:
+        write_status({**status, "state": "done" if status["done"] == status["total"] else "failed", "finished_at": time.time()})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill the persistent result cache before users arrive")
+    parser.add_argument("--source", action="append", help="CDM source to warm (all by default)")
+    parser.add_argument("--workers", type=int, help="parallel queries (default: the connection pool size)")
+    args = parser.parse_args(argv)
+
+    if os.getenv("RESULT_CACHE", "parquet") == "none" and os.getenv("SHARED_CACHE", "none") == "none":
+        print("RESULT_CACHE=none y SHARED_CACHE=none: sin caché persistente no hay nada que calentar")
+        return 1
+
+    tasks = warmup_tasks(args.source)
+    start = time.perf_counter()
+    results = run(tasks, args.workers or database_settings()["pool_size"])
+    empty = sum(1 for _, _, rows in results if rows == 0)
+    print(f"{len(results)} consultas en {time.perf_counter() - start:.1f}s ({empty} sin filas o con error)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,14 @@
+import logging
+import os
+from dataclasses import replace
+from functools import cache
 import streamlit as st
+from database.cohort import Cohort, cohort_presets
 from database.db_manager import DataManager
-from ui.charts import create_pie_chart, create_histogram_bar_chart, create_treemap_conditions, create_big_number, create_line_chart_time, create_box_plot, create_bar_chart
+from database.instrumentation import MAX_RECORDS, get_records, summarize
+from database.settings import cdm_sources
+from database.warmup import is_warming, read_status
+from ui.charts import create_pie_chart, create_histogram_bar_chart, create_treemap_conditions, create_big_number, create_line_chart_time, create_box_plot, create_bar_chart, create_latency_histogram, create_timeline_chart
 
 
 
@@ -12,6 +20,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Logs estructurados de las consultas (una línea JSON por llamada)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(message)s")
+
 # Cargar estilos CSS
 def load_css(file_name):
     with open(file_name) as f:
@@ -20,13 +31,19 @@ def load_css(file_name):
 load_css('ui/style.css')
 
 # Función auxiliar para renderizar tarjetas con estilo
-def render_card(title, fig, footer_title, footer_desc):
+def render_card(title, fig, footer_title, footer_desc, loading=False):
     # 1. Header HTML
     st.markdown(f'<div class="card-header">{title}</div>', unsafe_allow_html=True)
     
-    # 2. Gráfico Plotly
-    if fig:
+    # 2. Gráfico Plotly (o un esqueleto mientras llegan los datos)
+    if loading:
+        st.markdown('<div class="card-skeleton"></div>', unsafe_allow_html=True)
+    elif fig:
         st.plotly_chart(fig, width='stretch', config={'displayModeBar': False})
+        # Modo rápido: margen de error de la estimación
+        note = st.session_state.get("estimate_note")
+        if note and note():
+            st.caption(note())
     else:
         st.warning("No hay datos disponibles")
         
@@ -38,36 +55,127 @@ def render_card(title, fig, footer_title, footer_desc):
         </div>
     ''', unsafe_allow_html=True)
 
-def view_dashboard():
-    # 2. Obtener datos (ahora con caché)
-    with st.spinner('Cargando datos...'):
-        df_patients = data_manager.get_count_patients()
-        df_sex = data_manager.get_sex()
-        df_age = data_manager.get_age_at_first_seen()
-        df_conditions = data_manager.get_conditions_per_person()
+# Reserva el sitio de una tarjeta y muestra su esqueleto; devuelve la función que
+# la dibuja cuando llegan sus datos (con otro footer_title si se indica)
+def card_slot(title, footer_title, footer_desc):
+    slot = st.empty()
+    with slot.container():
+        render_card(title, None, footer_title, footer_desc, loading=True)
+
+    def fill(fig, footer_title=footer_title):
+        with slot.container():
+            render_card(title, fig, footer_title, footer_desc)
+
+    return fill
+
+# Lanza a la vez los getters de las tarjetas de una vista y dibuja cada una en cuanto
+# termina el suyo: la primera gráfica depende de la consulta más rápida, no de la más lenta.
+# `cards` es etiqueta -> (getter o (getter, *args), función que dibuja el DataFrame)
+def load_cards(cards, source, cohort):
+    requests = {label: request for label, (request, _) in cards.items()}
+    for label, df in data_manager.fetch_as_completed(requests, source, cohort):
+        cards[label][1](df)
+
+# Ancho de los bins de los histogramas (años), elegido en la barra lateral
+def histogram_bin_width():
+    return st.sidebar.select_slider("Ancho de bin (años)", options=[1, 2, 5, 10], value=1)
+
+# Fuente CDM activa, elegida en la barra lateral cuando hay varias configuradas
+def select_source():
+    sources = cdm_sources()
+    if len(sources) == 1:
+        return next(iter(sources))
+    return st.sidebar.selectbox("Fuente CDM", list(sources), format_func=lambda name: sources[name]["label"])
+
+# Edad máxima del control deslizante: en el extremo no se filtra por edad máxima
+MAX_AGE = 110
+
+# Filtro de cohorte compartido por todas las vistas, elegido en la barra lateral
+def select_cohort(source):
+    presets = cohort_presets()
+    if presets:
+        preset = st.sidebar.selectbox(
+            "Cohorte", ["", *presets], format_func=lambda name: presets[name][0] if name else "Personalizada"
+        )
+        if preset:
+            return presets[preset][1]
+
+    # Opciones del vocabulario, no de person: no retrasa los esqueletos de las tarjetas
+    df_sex = data_manager.get_gender_concepts(source)
+    sexes = dict(zip(df_sex["concept_id"], df_sex["concept_name"])) if not df_sex.empty else {}
+
+    with st.sidebar.expander("Filtro de cohorte"):
+        period = st.date_input("Periodo", value=(), format="YYYY-MM-DD")
+        min_age, max_age = st.slider("Edad (años)", 0, MAX_AGE, (0, MAX_AGE))
+        genders = st.multiselect("Sexo", list(sexes), format_func=lambda concept_id: sexes[concept_id])
+
+    start_date, end_date = (tuple(period) + (None, None))[:2]
+    return Cohort(
+        start_date=start_date,
+        end_date=end_date,
+        min_age=min_age or None,
+        max_age=max_age if max_age < MAX_AGE else None,
+        gender_concept_ids=tuple(sorted(int(concept_id) for concept_id in genders)),
+    )
+
+# Fracciones de personas del modo rápido
+SAMPLE_SIZES = [0.01, 0.05, 0.1, 0.25]
+
+# Modo rápido: las vistas se calculan sobre una muestra determinista de personas
+def select_sample():
+    fast = st.sidebar.toggle(
+        "Modo rápido (aproximado)",
+        help="Calcula las gráficas con una muestra de personas y extrapola los conteos. Desactívelo para ver resultados exactos.",
+    )
+    if not fast:
+        return None
+    return st.sidebar.select_slider("Muestra de personas", options=SAMPLE_SIZES, value=0.05, format_func=lambda f: f"{f:.0%}")
+
+# Función que devuelve el texto con el margen de error del modo rápido (None si no se
+# pudo contar la muestra), o None con resultados exactos. El conteo se lanza al pool
+# y se espera solo al dibujar la primera gráfica, no antes de los esqueletos
+def estimate_note(source, cohort):
+    if not cohort.sample:
+        return None
+    future = data_manager.submit("get_count_patients", source, cohort)
+
+    @cache
+    def note():
+        try:
+            df = future.result()
+        except Exception:
+            return None # El error ya quedó registrado por el getter
+        persons = round(df.iloc[0, 0] * cohort.sample) if not df.empty else 0
+        return (
+            f"≈ Estimación con el {cohort.sample:.0%} de las personas ({persons:,} en la muestra): "
+            f"±{cohort.margin_of_error(persons):.1%} sobre el total (IC 95%), más en categorías pequeñas"
+        )
+
+    return note
 
-    # 3. Header Principal
+def view_dashboard(source, cohort):
+    bin_width = histogram_bin_width()
+
+    # 1. Header Principal
     st.title("📊 OMOP Dashboard")
     st.markdown("---")
 
-    # 4. Layout Principal
+    # 2. Layout Principal: cada tarjeta aparece con su esqueleto y se rellena al llegar sus datos
     
     # Fila 1: Espacio vacío (izquierda) y Gráfico de Sexo (derecha)
     # En Streamlit usamos columnas. 
     col1, col2 = st.columns([1, 1]) # 50% y 50%
     
     with col1:
-        render_card(
+        patients = card_slot(
             title="Total Patiets",
-            fig=create_big_number(df_patients),
             footer_title="10K Pregnant woman",
             footer_desc="Number of patients in the cohort"
         )
         
     with col2:
-        render_card(
+        sex = card_slot(
             title="Sex Distribution",
-            fig=create_pie_chart(df_sex),
             footer_title="10K Pregnant woman",
             footer_desc="Gender distribution across the patient cohort."
         )
@@ -75,9 +183,8 @@ def view_dashboard():
     st.write("###") # Espaciador
 
     # Fila 2: Histograma (Ancho completo)
-    render_card(
+    age = card_slot(
         title="Year of Birth",
-        fig=create_histogram_bar_chart(df_age),
         footer_title="10K Pregnant woman",
         footer_desc="The age of the patient cohort at first seen."
     )
@@ -85,26 +192,79 @@ def view_dashboard():
     st.write("###") # Espaciador
 
     # Fila 3: Treemap (Ancho completo)
-    render_card(
+    conditions = card_slot(
         title="Conditions",
-        fig=create_treemap_conditions(df_conditions),
         footer_title="10K Pregnant woman",
         footer_desc="Distribution of medical conditions across the patient cohort. Top 50 most common conditions."
     )
 
-def view_data_density():
-    st.title("📂 Data Density")
+    # 3. Obtener datos (con caché), dibujando cada gráfica en cuanto llega
+    load_cards({
+        "patients": ("get_count_patients", lambda df: patients(create_big_number(df))),
+        "sex": ("get_sex", lambda df: sex(create_pie_chart(df))),
+        "age": (("get_age_at_first_seen", bin_width), lambda df: age(create_histogram_bar_chart(df, bin_width))),
+        "conditions": ("get_conditions_per_person", lambda df: conditions(create_treemap_conditions(df))),
+    }, source, cohort)
+
+def view_pregnancy(source, cohort):
+    st.title("🤰 Pregnancy episodes")
     st.markdown("---")
+    notice = st.empty()
 
-    with st.spinner('Cargando datos...'):
-        df_data_density = data_manager.get_data_density_total_rows()
-        df_data_avg_records = data_manager.get_avg_records_per_person_per_month()
-        df_data_records_domain = data_manager.get_records_per_person_per_domain()
+    col1, col2 = st.columns([1, 1]) # 50% y 50%
+
+    with col1:
+        count = card_slot(
+            title="Pregnancy episodes",
+            footer_title="Pregnancy episodes",
+            footer_desc="Episodes derived from condition, procedure, measurement and observation records."
+        )
+
+    with col2:
+        outcomes = card_slot(
+            title="Outcomes",
+            footer_title="Pregnancy episodes",
+            footer_desc="Live birth, stillbirth, abortion, ectopic pregnancy or unknown outcome."
+        )
+
+    st.write("###") # Espaciador
+
+    gestation = card_slot(
+        title="Gestational age at outcome (weeks)",
+        footer_title="Pregnancy episodes",
+        footer_desc="From recorded gestational age when available, otherwise the typical length of the outcome."
+    )
+
+    st.write("###") # Espaciador
+
+    per_month = card_slot(
+        title="Episodes per month",
+        footer_title="Pregnancy episodes",
+        footer_desc="Number of pregnancy episodes ending in each month."
+    )
+
+    def draw_count(df):
+        if df.empty:
+            notice.info("No hay episodios de embarazo: genérelos con `python -m database.pregnancy`.")
+            count(None)
+        else:
+            count(create_big_number(df), footer_title=f"{int(df.iloc[0, 0]):,} pregnancy episodes")
+
+    # Todas las gráficas leen la tabla de episodios del esquema de resultados
+    load_cards({
+        "count": ("get_pregnancy_episode_count", draw_count),
+        "outcomes": ("get_pregnancy_outcomes", lambda df: outcomes(create_pie_chart(df))),
+        "gestation": ("get_pregnancy_gestational_age", lambda df: gestation(create_bar_chart(df))),
+        "per_month": ("get_pregnancy_episodes_per_month", lambda df: per_month(create_line_chart_time(df))),
+    }, source, cohort)
+
+def view_data_density(source, cohort):
+    st.title("📂 Data Density")
+    st.markdown("---")
 
     # Fila 1: densidad de datos
-    render_card(
+    density = card_slot(
         title="Data density - Records",
-        fig= create_line_chart_time(df_data_density),
         footer_title="10K Pregnant woman",
         footer_desc="Number of records of each domain per month."
     )
@@ -112,9 +272,8 @@ def view_data_density():
     st.write("###") # Espaciador
 
     # Fila 2: Promedio de records por mes por persona
-    render_card(
+    avg_records = card_slot(
         title="Data density - Records",
-        fig= create_line_chart_time(df_data_avg_records),
         footer_title="10K Pregnant woman",
         footer_desc="Number of average records per person of each domain per month."
     )
@@ -123,28 +282,27 @@ def view_data_density():
 
     # Fila 3: Boxplots de records por persona
 
-    render_card(
+    records_domain = card_slot(
         title="Data density - Concepts",
-        fig= create_box_plot(df_data_records_domain),
         footer_title="10K Pregnant woman",
         footer_desc="Boxplot of records per person of each domain"
     )
 
-def view_person():
+    load_cards({
+        "density": ("get_data_density_total_rows", lambda df: density(create_line_chart_time(df))),
+        "avg_records": ("get_avg_records_per_person_per_month", lambda df: avg_records(create_line_chart_time(df))),
+        "records_domain": ("get_records_per_person_per_domain", lambda df: records_domain(create_box_plot(df))),
+    }, source, cohort)
+
+def view_person(source, cohort):
     st.title("🧑‍🤝‍🧑 Person")
     st.markdown("---")
 
-    with st.spinner('Cargando datos...'):
-        df_data_age_years = data_manager.get_year_of_birth_patients()
-        df_sex = data_manager.get_sex()
-        df_race = data_manager.get_race()
-        df_ethnicity = data_manager.get_ethnicity()
+    bin_width = histogram_bin_width()
 
-    
     # Fila 2: Histograma (Ancho completo)
-    render_card(
+    age_years = card_slot(
         title="Year of Birth",
-        fig=create_histogram_bar_chart(df_data_age_years),
         footer_title="10K Pregnant woman",
         footer_desc="The number of people in this cohort shown with respect to their year of birth."
     )
@@ -155,41 +313,39 @@ def view_person():
     col1, col2, col3 = st.columns([1, 1, 1]) # 50% y 50%
     
     with col1:
-        render_card(
+        sex = card_slot(
             title="Sex Distribution",
-            fig=create_pie_chart(df_sex),
             footer_title="10K Pregnant woman",
             footer_desc="Gender distribution across the patient cohort."
         )
         
     with col2:
-        render_card(
+        race = card_slot(
             title="Race Distribution",
-            fig=create_pie_chart(df_race),
             footer_title="10K Pregnant woman",
             footer_desc="Race distribution across the patient cohort."
         )
     with col3:
-        render_card(
+        ethnicity = card_slot(
             title="Ethnicity Distribution",
-            fig=create_pie_chart(df_ethnicity),
             footer_title="10K Pregnant woman",
             footer_desc="Ethnicity distribution across the patient cohort."
         )
 
+    load_cards({
+        "age_years": (("get_year_of_birth_patients", bin_width), lambda df: age_years(create_histogram_bar_chart(df, bin_width))),
+        "sex": ("get_sex", lambda df: sex(create_pie_chart(df))),
+        "race": ("get_race", lambda df: race(create_pie_chart(df))),
+        "ethnicity": ("get_ethnicity", lambda df: ethnicity(create_pie_chart(df))),
+    }, source, cohort)
+
 
-def view_visit():
+def view_visit(source, cohort):
     st.title("👩‍⚕️ Visit")
     st.markdown("---")
 
-    with st.spinner('Cargando datos...'):
-        df_data_visits_concepts = data_manager.get_visits_concepts()
-        df_data_visits_duration = data_manager.get_visits_duration()
-        df_data_visits_types = data_manager.get_visit_type_concept_id()
-    
-    render_card(
+    visits_concepts = card_slot(
         title="Visits",
-        fig=create_bar_chart(df_data_visits_concepts),
         footer_title="10K Pregnant woman",
         footer_desc="Visits concepts distribution across the patient cohort. Top 50 most common concepts."
         )
@@ -198,21 +354,137 @@ def view_visit():
     col1, col2 = st.columns([1, 1]) # 50% y 50%
 
     with col1:
-        render_card(
+        visits_duration = card_slot(
         title="Visits duration (Days)",
-        fig=create_big_number(df_data_visits_duration),
         footer_title="10K Pregnant woman",
         footer_desc="Visits duration distribution across the patient cohort. (Less than 365 days)"
         )
     
     with col2:
-        render_card(
+        visits_types = card_slot(
         title="Visits type concepts",
-        fig=create_bar_chart(df_data_visits_types),
         footer_title="10K Pregnant woman",
         footer_desc="Visits type concepts distribution across the patient cohort."
         )
 
+    load_cards({
+        "visits_concepts": ("get_visits_concepts", lambda df: visits_concepts(create_bar_chart(df))),
+        "visits_duration": ("get_visits_duration", lambda df: visits_duration(create_big_number(df))),
+        "visits_types": ("get_visit_type_concept_id", lambda df: visits_types(create_bar_chart(df))),
+    }, source, cohort)
+
+# Páginas servidas por el motor genérico de dominios: página -> (dominio, descripción)
+DOMAIN_PAGES = {
+    "Condition Ocurrence": ("condition", "conditions"),
+    "Procedure": ("procedure", "procedures"),
+    "Drug Exposure": ("drug", "drug exposures"),
+    "Measurement": ("measurement", "measurements"),
+    "Observation": ("observation", "observations"),
+    "Death": ("death", "causes of death"),
+}
+
+def view_domain(title, source, cohort):
+    domain, label = DOMAIN_PAGES[title]
+    st.title(f"📂 {title}")
+    st.markdown("---")
+
+    top = card_slot(
+        title=f"Top {label}",
+        footer_title="10K Pregnant woman",
+        footer_desc=f"Distribution of {label} across the patient cohort. Top 50 by number of persons."
+    )
+
+    st.write("###") # Espaciador
+
+    trend = card_slot(
+        title=f"{title} - Records per month",
+        footer_title="10K Pregnant woman",
+        footer_desc=f"Number of records and distinct persons with {label} per month."
+    )
+
+    st.write("###") # Espaciador
+    col1, col2 = st.columns([1, 1]) # 50% y 50%
+
+    with col1:
+        per_person = card_slot(
+            title="Records per person",
+            footer_title="10K Pregnant woman",
+            footer_desc=f"Boxplot of the number of {label} per person."
+        )
+
+    with col2:
+        types = card_slot(
+            title="Record types",
+            footer_title="10K Pregnant woman",
+            footer_desc=f"Provenance of the {label} records (type concept)."
+        )
+
+    # Las cuatro gráficas salen del mismo resumen del dominio (un solo recorrido de la tabla)
+    load_cards({
+        "top": (("get_domain_top_concepts", domain), lambda df: top(create_treemap_conditions(df, root=f"All {label}"))),
+        "trend": (("get_domain_monthly_trend", domain), lambda df: trend(create_line_chart_time(df))),
+        "per_person": (("get_domain_records_per_person", domain), lambda df: per_person(create_box_plot(df, yaxis_title="records"))),
+        "types": (("get_domain_type_breakdown", domain), lambda df: types(create_pie_chart(df))),
+    }, source, cohort)
+
+def view_person_timeline(source):
+    st.title("🩺 Person timeline")
+    st.markdown("---")
+
+    # Los botones +/- recorren las personas; las vistas recientes salen del LRU del proceso
+    person_id = st.number_input("person_id", min_value=0, value=1, step=1)
+    with st.spinner('Cargando datos...'):
+        timeline = data_manager.get_person_timeline(person_id, source)
+    # Precargar la persona siguiente mientras se mira esta
+    data_manager.get_executor().submit(data_manager.get_person_timeline, person_id + 1, source)
+
+    if not timeline.exists():
+        st.warning(f"No hay datos de la persona {person_id}")
+        return
+
+    counts = timeline.counts()
+    cols = st.columns(2 + len(counts))
+    cols[0].metric("Sex", timeline.names.get(timeline.gender_concept_id) or "-")
+    cols[1].metric("Year of birth", timeline.year_of_birth or "-")
+    for col, (domain, n) in zip(cols[2:], counts.items()):
+        col.metric(domain.capitalize(), f"{n:,}")
+
+    st.write("###") # Espaciador
+
+    render_card(
+        title=f"Person {person_id} - Events",
+        fig=create_timeline_chart(timeline.to_frame()),
+        footer_title=f"{len(timeline):,} events",
+        footer_desc="Every visit, condition, procedure, drug, measurement and observation of the person, by start date."
+    )
+
+def view_performance(source):
+    st.title("⏱️ Performance")
+    st.markdown("---")
+
+    records = get_records()
+    if records.empty:
+        st.info("Todavía no hay consultas registradas en este proceso.")
+        return
+
+    st.dataframe(summarize(records), width='stretch', hide_index=True)
+
+    st.write("###") # Espaciador
+
+    query = st.selectbox("Consulta", sorted(records["query"].unique()))
+    render_card(
+        title=f"Latency - {query}",
+        fig=create_latency_histogram(records[records["query"] == query]),
+        footer_title=f"Last {MAX_RECORDS} calls",
+        footer_desc="Wall time per call, by data source (memory, disk, summary, live, coalesced, derived, error)."
+    )
+
+    st.write("###") # Espaciador
+
+    # Uso del pool de conexiones, para dimensionarlo
+    st.subheader("Connection pool")
+    st.json(data_manager.get_pool_status(source))
+
 def view_placeholder(title):
     st.title(f"📂 {title}")
     st.markdown("---")
@@ -221,30 +493,52 @@ def view_placeholder(title):
 def main():
     st.sidebar.title("Navegación")
     
-    page = st.sidebar.radio(
-        "Seleccione una vista:",
-        [
-            "Dashboard",
-            "Data density",
-            "Person",
-            "Visit",
-            "Condition Ocurrence",
-            "Procedure",
-            "Drug Exposure",
-            "Measurement",
-            "Observation",
-            "Death"
-        ]
-    )
+    pages = [
+        "Dashboard",
+        "Pregnancy",
+        "Data density",
+        "Person",
+        "Person timeline",
+        "Visit",
+        "Condition Ocurrence",
+        "Procedure",
+        "Drug Exposure",
+        "Measurement",
+        "Observation",
+        "Death"
+    ]
+
+    # Página oculta: solo con ?perf=1 en la URL o SHOW_PERFORMANCE_PAGE=1
+    if st.query_params.get("perf") == "1" or os.getenv("SHOW_PERFORMANCE_PAGE") == "1":
+        pages.append("Performance")
+
+    page = st.sidebar.radio("Seleccione una vista:", pages)
+    source = select_source()
+    data_manager.check_refresh(source)
+
+    # Aviso mientras el job de calentamiento llena la caché (la página carga igualmente)
+    status = read_status()
+    if is_warming(status):
+        st.sidebar.info(f"Calentando caché: {status['done']}/{status['total']} consultas")
+    cohort = replace(select_cohort(source), sample=select_sample())
+    st.session_state.estimate_note = estimate_note(source, cohort) if page not in ("Person timeline", "Performance") else None
 
     if page == "Dashboard":
-        view_dashboard()
+        view_dashboard(source, cohort)
+    elif page == "Pregnancy":
+        view_pregnancy(source, cohort)
     elif page == "Data density":
-        view_data_density()
+        view_data_density(source, cohort)
     elif page == "Person":
-        view_person()
+        view_person(source, cohort)
+    elif page == "Person timeline":
+        view_person_timeline(source)
     elif page == "Visit":
-        view_visit()
+        view_visit(source, cohort)
+    elif page in DOMAIN_PAGES:
+        view_domain(page, source, cohort)
+    elif page == "Performance":
+        view_performance(source)
     else:
         view_placeholder(page)
 
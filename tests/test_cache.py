@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from database.cache import MemoryCache, NullCache, ParquetCache, TieredCache
+from database.singleflight import SingleFlight
+
+pytest.importorskip("pyarrow")
+
+
+def frame(rows=3):
+    return pd.DataFrame({"concept_id": range(rows), "total": range(rows)})
+
+
+def run_concurrently(target, callers=8):
+    threads = [threading.Thread(target=target) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_single_flight_runs_concurrent_calls_once():
+    flight = SingleFlight()
+    calls, results = [], []
+
+    def query():
+        calls.append(1)
+        time.sleep(0.2)
+        return frame()
+
+    def caller():
+        results.append(flight.do("key", query))
+
+    run_concurrently(caller)
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False] + [True] * 7
+    assert all(df is results[0][0] for df, _ in results)
+    assert len(flight) == 0
+
+
+def test_single_flight_followers_get_the_exception():
+    flight = SingleFlight()
+    calls, errors = [], []
+
+    def query():
+        calls.append(1)
+        time.sleep(0.2)
+        raise ValueError("timeout")
+
+    def caller():
+        try:
+            flight.do("key", query)
+        except ValueError as e:
+            errors.append(e)
+
+    run_concurrently(caller, callers=4)
+
+    assert len(calls) == 1
+    assert len(errors) == 4
+    assert len(flight) == 0
+
+
+def test_single_flight_runs_again_after_the_call_finishes():
+    flight = SingleFlight()
+
+    assert flight.do("key", lambda: 1) == (1, False)
+    assert flight.do("key", lambda: 2) == (2, False)
+
+
+def test_tiered_cache_backfills_the_local_tier():
+    local = MemoryCache(ttl_seconds=0, max_bytes=1 << 20)
+    shared = MemoryCache(ttl_seconds=0, max_bytes=1 << 20)
+    cache = TieredCache(local, shared)
+    shared.put("key", frame())
+
+    assert local.get("key") is None
+    pd.testing.assert_frame_equal(cache.get("key"), frame())
+    pd.testing.assert_frame_equal(local.get("key"), frame())
+
+
+def test_tiered_cache_writes_both_tiers():
+    cache = TieredCache(MemoryCache(0, 1 << 20), MemoryCache(0, 1 << 20))
+    cache.put("key", frame())
+
+    assert cache.local.get("key") is not None
+    assert cache.shared.get("key") is not None
+
+
+def test_tiered_cache_without_shared_tier_is_the_local_cache():
+    cache = TieredCache(MemoryCache(0, 1 << 20), NullCache())
+    cache.put("key", frame())
+
+    pd.testing.assert_frame_equal(cache.get("key"), frame())
+
+
+def test_memory_cache_expires_after_the_ttl(monkeypatch):
+    cache = MemoryCache(ttl_seconds=60, max_bytes=1 << 20)
+    cache.put("key", frame())
+    now = time.time()
+
+    monkeypatch.setattr(time, "time", lambda: now + 30)
+    assert cache.get("key") is not None
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("key") is None
+
+
+def test_memory_cache_evicts_least_recently_used_within_max_bytes():
+    size = len(frame(50).to_parquet(index=False))
+    cache = MemoryCache(ttl_seconds=0, max_bytes=int(size * 2.5))
+    cache.put("a", frame(50))
+    cache.put("b", frame(50))
+    cache.get("a")
+    cache.put("c", frame(50))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert sum(len(data) for _, data in cache._entries.values()) <= cache.max_bytes
+
+
+def test_memory_cache_keeps_dtypes():
+    df = pd.DataFrame({"total": pd.array([1, 2], dtype="int32"), "concept_name": pd.Categorical(["a", "b"])})
+    cache = MemoryCache(ttl_seconds=0, max_bytes=1 << 20)
+    cache.put("key", df)
+
+    assert cache.get("key").dtypes.to_dict() == df.dtypes.to_dict()
+
+
+def test_empty_results_are_not_cached():
+    cache = MemoryCache(ttl_seconds=0, max_bytes=1 << 20)
+    cache.put("key", pd.DataFrame())
+
+    assert cache.get("key") is None
+
+
+def test_parquet_cache_evicts_least_recently_used_within_max_bytes(tmp_path):
+    probe = ParquetCache(tmp_path / "probe", ttl_seconds=0, max_bytes=1 << 20)
+    probe.put("probe", frame(50))
+    size = (tmp_path / "probe" / "probe.parquet").stat().st_size
+
+    cache = ParquetCache(tmp_path / "results", ttl_seconds=0, max_bytes=int(size * 2.5))
+    cache.put("a", frame(50))
+    cache.put("b", frame(50))
+    # "a" se leyó después de escribir "b": la menos usada es "b"
+    now = time.time()
+    os.utime(cache._path("a"), (now - 5, now - 20))
+    os.utime(cache._path("b"), (now - 10, now - 20))
+    cache.put("c", frame(50))
+
+    remaining = sorted(path.stem for path in (tmp_path / "results").glob("*.parquet"))
+    assert remaining == ["a", "c"]
+    assert sum(path.stat().st_size for path in (tmp_path / "results").glob("*.parquet")) <= cache.max_bytes
+
+
+def test_parquet_cache_expires_after_the_ttl(tmp_path):
+    cache = ParquetCache(tmp_path, ttl_seconds=60, max_bytes=1 << 20)
+    cache.put("key", frame())
+    old = time.time() - 120
+    os.utime(cache._path("key"), (old, old))
+
+    assert cache.get("key") is None
+    assert not cache._path("key").exists()
+
+
+def test_parquet_cache_concurrent_writes_of_the_same_key(tmp_path, caplog):
+    cache = ParquetCache(tmp_path, ttl_seconds=0, max_bytes=1 << 30)
+
+    run_concurrently(lambda: cache.put("key", frame(20000)), callers=16)
+
+    assert not caplog.records
+    pd.testing.assert_frame_equal(cache.get("key"), frame(20000))
+    assert [path.name for path in tmp_path.iterdir()] == ["key.parquet"]
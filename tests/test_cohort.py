@@ -0,0 +1,148 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+pytest.importorskip("duckdb_engine")
+
+from database.cohort import SAMPLE_HASH, SAMPLE_MODULUS, Cohort
+from database.queries import QUERIES
+
+FEMALE, MALE = 8532, 8507
+THIS_YEAR = date.today().year
+
+# (person_id, sexo, edad, inicio y fin del periodo de observación)
+PERSONS = [
+    (1, FEMALE, 30, "2019-01-01", "2021-12-31"),
+    (2, MALE, 50, "2015-01-01", "2016-12-31"),
+    (3, FEMALE, 70, "2020-01-01", "2022-12-31"),
+    (4, MALE, 20, "2010-01-01", "2024-12-31"),
+]
+
+# (condition_occurrence_id, person_id, concept, fecha)
+CONDITIONS = [
+    (1, 1, 100, "2020-05-01"),
+    (2, 1, 101, "2018-01-01"),
+    (3, 2, 100, "2015-06-01"),
+    (4, 3, 100, "2021-03-01"),
+    (5, 4, 102, "2020-07-01"),
+]
+
+
+@pytest.fixture(scope="module")
+def engine(tmp_path_factory):
+    engine = create_engine(f"duckdb:///{tmp_path_factory.mktemp('cohort') / 'synth.duckdb'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE SCHEMA cdm"))
+        conn.execute(text("CREATE TABLE cdm.person (person_id BIGINT, gender_concept_id BIGINT, year_of_birth INTEGER)"))
+        conn.execute(text(
+            "CREATE TABLE cdm.observation_period (observation_period_id BIGINT, person_id BIGINT, "
+            "observation_period_start_date DATE, observation_period_end_date DATE)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE cdm.condition_occurrence (condition_occurrence_id BIGINT, person_id BIGINT, "
+            "condition_concept_id BIGINT, condition_start_date DATE, condition_type_concept_id BIGINT)"
+        ))
+        for person_id, gender, age, start, end in PERSONS:
+            conn.execute(text("INSERT INTO cdm.person VALUES (:id, :gender, :year)"),
+                         {"id": person_id, "gender": gender, "year": THIS_YEAR - age})
+            conn.execute(text("INSERT INTO cdm.observation_period VALUES (:id, :id, :start, :end)"),
+                         {"id": person_id, "start": start, "end": end})
+        for condition_id, person_id, concept_id, day in CONDITIONS:
+            conn.execute(text("INSERT INTO cdm.condition_occurrence VALUES (:id, :person, :concept, :day, 32020)"),
+                         {"id": condition_id, "person": person_id, "concept": concept_id, "day": day})
+    yield engine
+    engine.dispose()
+
+
+def run(engine, cohort, query):
+    sql, params = cohort.compile(QUERIES.get(query, query), "cdm")
+    with engine.connect() as conn:
+        return pd.read_sql(text(sql), conn, params=params)
+
+
+def patients(engine, cohort):
+    return int(run(engine, cohort, "count_patients").iloc[0, 0])
+
+
+def persons_per_concept(engine, cohort):
+    df = run(engine, cohort, "conditions_per_person")
+    return dict(zip(df["condition_concept_id"], df["cnt"]))
+
+
+def test_empty_cohort_is_the_query_itself(engine):
+    sql, params = Cohort().compile(QUERIES["count_patients"], "cdm")
+
+    assert "WITH" not in sql and params == {}
+    assert patients(engine, Cohort()) == 4
+
+
+def test_ctes_shadow_the_tables_in_a_fixed_order():
+    cohort = Cohort(start_date=date(2020, 1, 1), gender_concept_ids=(FEMALE,), sample=0.5)
+
+    sql, _ = cohort.compile(QUERIES["conditions_per_person"], "cdm")
+
+    header, body = sql.split("\nSELECT", 1)
+    assert header.startswith("WITH person AS (")
+    assert header.index("person AS (") < header.index("condition_occurrence AS (")
+    assert "FROM condition_occurrence co" in body and "cdm." not in body
+    assert cohort.compile(QUERIES["conditions_per_person"], "cdm")[0] == sql
+
+
+def test_query_with_its_own_with_clause_gets_one_with(engine):
+    cohort = Cohort(gender_concept_ids=(FEMALE,))
+
+    sql, _ = cohort.compile(QUERIES["domain_summary_condition"], "cdm")
+    df = run(engine, cohort, "domain_summary_condition")
+
+    assert sql.upper().count("WITH ") == 1
+    concepts = df[df["facet"] == "concept"].set_index("concept_id")["persons"]
+    assert concepts.to_dict() == {100: 2, 101: 1}
+
+
+def test_date_range_keeps_overlapping_persons_and_events_inside_it(engine):
+    cohort = Cohort(start_date=date(2020, 1, 1), end_date=date(2020, 12, 31))
+
+    # La persona 2 solo se observó en 2015-2016
+    assert patients(engine, cohort) == 3
+    assert persons_per_concept(engine, cohort) == {100: 1, 102: 1}
+
+
+def test_age_band_filters_by_year_of_birth(engine):
+    cohort = Cohort(min_age=25, max_age=60)
+
+    assert patients(engine, cohort) == 2
+    assert persons_per_concept(engine, cohort) == {100: 2, 101: 1}
+
+
+def test_sex_filters_persons_and_their_events(engine):
+    cohort = Cohort(gender_concept_ids=(FEMALE,))
+
+    sex = run(engine, cohort, "sex")
+    assert sex.set_index("gender_concept_id")["total"].to_dict() == {FEMALE: 2}
+    assert persons_per_concept(engine, cohort) == {100: 2, 101: 1}
+
+
+def test_sample_keeps_the_same_persons_in_every_table(engine):
+    cohort = Cohort(sample=0.5)
+    cut = int(0.5 * SAMPLE_MODULUS)
+    expected = {
+        person_id for person_id, *_ in PERSONS
+        if (person_id % SAMPLE_MODULUS) * 1327217884 % SAMPLE_MODULUS < cut
+    }
+
+    persons = set(run(engine, cohort, "SELECT person_id FROM {cdm}.person")["person_id"])
+    with_conditions = set(run(engine, cohort, "SELECT DISTINCT person_id FROM {cdm}.condition_occurrence")["person_id"])
+
+    assert persons == expected
+    assert with_conditions == expected & {person_id for _, person_id, _, _ in CONDITIONS}
+
+
+def test_sample_hash_spreads_consecutive_ids(engine):
+    with engine.connect() as conn:
+        kept = conn.execute(text(
+            f"SELECT COUNT(*) FROM range(1, 10001) t(person_id) WHERE {SAMPLE_HASH} < {int(0.1 * SAMPLE_MODULUS)}"
+        )).scalar()
+
+    assert 900 <= kept <= 1100
@@ -0,0 +1,79 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+pytest.importorskip("duckdb_engine")
+
+from benchmarks.synthetic_cdm import build
+from database.incremental import refresh
+from database.queries import QUERIES
+from database.summaries import build_summaries, summary_table
+
+SOURCE = {"name": "test", "schema": "cdm", "results_schema": "cdm_results"}
+FULL = {**SOURCE, "results_schema": "full_results"}
+
+# Filas nuevas con ids por encima de los existentes: un append
+APPEND = [
+    "INSERT INTO cdm.condition_occurrence SELECT * REPLACE (condition_occurrence_id + 100000000 AS condition_occurrence_id, "
+    "condition_start_date + 400 AS condition_start_date) FROM cdm.condition_occurrence WHERE condition_occurrence_id % 7 = 0",
+    "INSERT INTO cdm.visit_occurrence SELECT * REPLACE (visit_occurrence_id + 100000000 AS visit_occurrence_id) "
+    "FROM cdm.visit_occurrence WHERE visit_occurrence_id % 5 = 0",
+    "INSERT INTO cdm.measurement SELECT * REPLACE (measurement_id + 100000000 AS measurement_id, "
+    "measurement_concept_id + 1 AS measurement_concept_id) FROM cdm.measurement WHERE measurement_id % 11 = 0",
+]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    path = tmp_path / "synth.duckdb"
+    build(path, 300)
+    engine = create_engine(f"duckdb:///{path}")
+    refresh(engine, SOURCE)
+    yield engine
+    engine.dispose()
+
+
+def summaries(engine, source):
+    frames = {}
+    with engine.connect() as conn:
+        for name in QUERIES:
+            df = pd.read_sql(f"SELECT * FROM {summary_table(source, name)}", conn)
+            frames[name] = df.sort_values(list(df.columns), na_position="first").reset_index(drop=True)
+    return frames
+
+
+def assert_same_as_full_rebuild(engine):
+    build_summaries(engine, FULL)
+    merged, full = summaries(engine, SOURCE), summaries(engine, FULL)
+    for name in QUERIES:
+        pd.testing.assert_frame_equal(merged[name], full[name], check_dtype=False, obj=name)
+
+
+def test_unchanged_cdm_touches_no_summary(engine):
+    assert refresh(engine, SOURCE) == []
+
+
+def test_append_is_merged_and_equals_a_full_rebuild(engine):
+    with engine.begin() as conn:
+        for sql in APPEND:
+            conn.execute(text(sql))
+
+    log = refresh(engine, SOURCE)
+
+    merged = {line.split(":")[0] for line in log if "reconstruido" not in line}
+    assert merged >= {
+        "domain_month_counts", "conditions_per_person", "visits_concepts",
+        "records_per_person_per_domain", "concepts_per_person_distribution",
+    }
+    assert_same_as_full_rebuild(engine)
+
+
+def test_deleted_rows_rebuild_and_equal_a_full_rebuild(engine):
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM cdm.condition_occurrence WHERE condition_occurrence_id % 3 = 0"))
+        conn.execute(text(APPEND[0]))
+
+    log = refresh(engine, SOURCE)
+
+    assert "conditions_per_person" in {line.split(":")[0] for line in log if "reconstruido" in line}
+    assert_same_as_full_rebuild(engine)
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from database.pregnancy import EPISODE_COLUMNS, MAX_TERM, UNKNOWN_OUTCOME, detect_episodes
+
+LIVE_BIRTH, STILLBIRTH, GESTATIONAL_AGE, WEEKS_32, MARKER = 1, 2, 3, 4, 5
+
+CONCEPTS = pd.DataFrame({
+    "concept_id": [LIVE_BIRTH, STILLBIRTH, GESTATIONAL_AGE, WEEKS_32, MARKER],
+    "kind": ["outcome", "outcome", "gestation", "gestation", "marker"],
+    "outcome": ["LB", "SB", None, None, None],
+    "weeks": [np.nan, np.nan, np.nan, 32.0, np.nan],
+})
+
+
+def events(*rows):
+    """
+    Build the records of `events_query` from (person_id, date, concept_id[, value]) tuples
+    """
+    df = pd.DataFrame(
+        [(row + (None,))[:4] for row in rows],
+        columns=["person_id", "event_date", "concept_id", "value_as_number"],
+    )
+    df["event_date"] = pd.to_datetime(df["event_date"])
+    df["value_as_number"] = df["value_as_number"].astype("float64")
+    return df
+
+
+def day(value):
+    return pd.Timestamp(value)
+
+
+def test_no_pregnancy_records():
+    episodes = detect_episodes(events((1, "2020-01-01", 999)), CONCEPTS)
+
+    assert episodes.empty
+    assert list(episodes.columns) == EPISODE_COLUMNS
+
+
+def test_close_outcomes_are_one_episode_with_the_first_outcome_by_priority():
+    episodes = detect_episodes(events(
+        (1, "2020-06-01", LIVE_BIRTH),
+        (1, "2020-06-11", LIVE_BIRTH),
+        (1, "2020-06-21", STILLBIRTH),
+    ), CONCEPTS)
+
+    assert len(episodes) == 1
+    episode = episodes.iloc[0]
+    assert episode["outcome"] == "SB"
+    assert episode["episode_end_date"] == day("2020-06-01")
+
+
+def test_distant_outcomes_are_separate_episodes_numbered_per_person():
+    episodes = detect_episodes(events(
+        (1, "2020-01-01", LIVE_BIRTH),
+        (1, "2021-06-01", LIVE_BIRTH),
+        (2, "2020-03-01", LIVE_BIRTH),
+    ), CONCEPTS)
+
+    assert episodes[["person_id", "episode_number"]].values.tolist() == [[1, 1], [1, 2], [2, 1]]
+
+
+def test_start_from_recorded_gestational_age():
+    episodes = detect_episodes(events(
+        (1, "2020-03-01", GESTATIONAL_AGE, 30),
+        (1, "2020-05-10", LIVE_BIRTH),
+    ), CONCEPTS)
+
+    episode = episodes.iloc[0]
+    assert episode["gestation_source"] == "recorded"
+    assert episode["episode_start_date"] == day("2020-03-01") - pd.Timedelta(weeks=30)
+    assert episode["gestational_age_days"] == 30 * 7 + 70
+
+
+def test_weeks_written_in_the_concept_name():
+    episodes = detect_episodes(events(
+        (1, "2020-03-01", WEEKS_32),
+        (1, "2020-04-01", LIVE_BIRTH),
+    ), CONCEPTS)
+
+    assert episodes.iloc[0]["episode_start_date"] == day("2020-03-01") - pd.Timedelta(weeks=32)
+
+
+def test_typical_length_without_gestational_age_in_the_window():
+    # La edad gestacional queda fuera de la ventana de MAX_TERM días antes del desenlace
+    episodes = detect_episodes(events(
+        (1, "2019-01-01", GESTATIONAL_AGE, 30),
+        (1, "2020-05-10", LIVE_BIRTH),
+    ), CONCEPTS)
+
+    outcome = episodes[episodes["outcome"] == "LB"].iloc[0]
+    assert outcome["gestation_source"] == "typical"
+    assert outcome["gestational_age_days"] == 280
+
+
+def test_start_does_not_overlap_the_previous_episode():
+    episodes = detect_episodes(events(
+        (1, "2020-01-01", LIVE_BIRTH),
+        (1, "2020-08-01", LIVE_BIRTH),
+    ), CONCEPTS)
+
+    second = episodes.iloc[1]
+    assert second["episode_start_date"] == day("2020-01-02")
+
+
+def test_markers_inside_an_outcome_episode_are_not_a_new_episode():
+    episodes = detect_episodes(events(
+        (1, "2020-02-01", MARKER),
+        (1, "2020-05-10", LIVE_BIRTH),
+        (1, "2020-06-01", MARKER),
+    ), CONCEPTS)
+
+    assert episodes["outcome"].tolist() == ["LB"]
+
+
+def test_markers_without_outcome_are_an_unknown_outcome_episode():
+    episodes = detect_episodes(events(
+        (1, "2022-01-01", MARKER),
+        (1, "2022-03-01", MARKER),
+    ), CONCEPTS)
+
+    assert len(episodes) == 1
+    episode = episodes.iloc[0]
+    assert episode["outcome"] == UNKNOWN_OUTCOME
+    assert episode["gestation_source"] == "markers"
+    assert (episode["episode_start_date"], episode["episode_end_date"]) == (day("2022-01-01"), day("2022-03-01"))
+
+
+def test_long_marker_chain_is_split_into_pregnancy_length_parts():
+    # Un marcador al mes durante tres años, sin huecos mayores que MAX_TERM
+    dates = pd.date_range("2020-01-01", "2022-12-31", freq="MS")
+    episodes = detect_episodes(events(*[(1, date, MARKER) for date in dates]), CONCEPTS)
+
+    assert len(episodes) == 4
+    assert (episodes["outcome"] == UNKNOWN_OUTCOME).all()
+    assert (episodes["gestational_age_days"] <= MAX_TERM).all()
+    assert episodes["episode_start_date"].min() == day("2020-01-01")
+    assert episodes["episode_end_date"].max() == day("2022-12-01")
+
+
+@pytest.mark.parametrize("weeks", [0, 60])
+def test_implausible_gestational_age_is_ignored(weeks):
+    episodes = detect_episodes(events(
+        (1, "2020-03-01", GESTATIONAL_AGE, weeks),
+        (1, "2020-05-10", LIVE_BIRTH),
+    ), CONCEPTS)
+
+    assert episodes[episodes["outcome"] == "LB"].iloc[0]["gestation_source"] == "typical"
@@ -1,8 +1,83 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import pandas as pd
+
+# Máximo de figuras serializadas en memoria, compartidas por todas las sesiones
+FIGURE_CACHE_SIZE = int(os.getenv("FIGURE_CACHE_SIZE", "256"))
+
+_figures = OrderedDict()
+_figures_lock = threading.Lock()
+
+
+def frame_key(df):
+    """
+    Return a digest of the content, columns and dtypes of a DataFrame
+    """
+    # Las columnas de objetos (listas de outliers) no se pueden hashear: se usa su repr
+    objects = {column: str for column in df.columns if df[column].dtype == object}
+    hashes = pd.util.hash_pandas_object(df.astype(objects) if objects else df, index=True)
+    digest = hashlib.blake2b(hashes.to_numpy().tobytes(), digest_size=16)
+    digest.update(repr([(str(column), str(dtype)) for column, dtype in df.dtypes.items()]).encode())
+    return digest.hexdigest()
+
+
+def clear_figure_cache():
+    with _figures_lock:
+        _figures.clear()
+
+
+def cached_figure(builder):
+    """
+    Memoize a chart builder on the content of its DataFrame and its options.
+
+    The figure is cached as its JSON (numeric arrays already typed-array
+    encoded by Plotly) and every call rebuilds a fresh Figure from it
+    without validation, so a rerun costs a lookup instead of a Plotly
+    Express build.
+    """
+    @functools.wraps(builder)
+    def wrapper(df, *args, **kwargs):
+        if df.empty:
+            return None
+
+        key = (builder.__name__, frame_key(df), repr(args), repr(sorted(kwargs.items())))
+        with _figures_lock:
+            spec = _figures.get(key)
+            if spec is not None:
+                _figures.move_to_end(key)
+
+        if spec is None:
+            fig = builder(df, *args, **kwargs)
+            if fig is None:
+                return None
+            spec = fig.to_json()
+            with _figures_lock:
+                _figures[key] = spec
+                while len(_figures) > FIGURE_CACHE_SIZE:
+                    _figures.popitem(last=False)
+
+        # La figura ya se validó al construirla: reconstruirla sin validar es ~50 veces más rápido
+        return go.Figure(json.loads(spec), _validate=False)
+
+    return wrapper
 
 
+def _epoch_ms(values):
+    """
+    Return dates as float64 milliseconds since the epoch, which Plotly
+    sends as a typed array (dates would be sent as one string each)
+    """
+    return pd.to_datetime(values).astype("datetime64[ms]").astype("int64").astype("float64")
+
+
+@cached_figure
 def create_big_number(df):
     if df.empty:
         return None
@@ -28,6 +103,7 @@ def create_big_number(df):
     
     return fig
         
+@cached_figure
 def create_pie_chart(df):
     if df.empty:
         return None
@@ -53,15 +129,19 @@ def create_pie_chart(df):
     # Retornar figura de Plotly
     return fig
 
-def create_histogram_bar_chart(df):
+@cached_figure
+def create_histogram_bar_chart(df, bin_width=1):
     if df.empty:
         return None
 
-    # Crear gráfica en Plotly
-    fig = px.histogram(
-        df, 
-        x='age_in_years'
-    )
+    # Los bins ya vienen contados desde la base de datos (bin_start, total);
+    # cada barra cubre [bin_start, bin_start + bin_width)
+    fig = go.Figure(go.Bar(
+        x=df['bin_start'],
+        y=df['total'],
+        width=bin_width,
+        offset=0,
+    ))
 
     # Personalizar Layout histogram
     fig.update_layout(
@@ -88,14 +168,15 @@ def create_histogram_bar_chart(df):
     # Retornar figura de Plotly
     return fig
 
-def create_treemap_conditions(df):
+@cached_figure
+def create_treemap_conditions(df, root="All Conditions"):
     if df.empty:
         return None
 
     # Crear treemap con Plotly Express
     fig = px.treemap(
         df,
-        path=[px.Constant("All Conditions"), 'concept_name'],  # Jerarquía
+        path=[px.Constant(root), 'concept_name'],  # Jerarquía
         values='cnt',  # Tamaño de cada bloque
         color='cnt',  # Color basado en el conteo
         color_continuous_scale='Blues',  # Escala de colores
@@ -123,28 +204,38 @@ def create_treemap_conditions(df):
     # Retornar figura de Plotly
     return fig
 
+@cached_figure
 def create_line_chart_time(df):
     if df.empty:
         return None
-    
-    # Convertir columnas de valores a numérico (float) para evitar problemas con tipos Decimal u Object
-    df_plot = df.copy()
-    for col in df_plot.columns[1:]:
-        df_plot[col] = pd.to_numeric(df_plot[col], errors='coerce')
 
-    # Crear gráfica en plotly
+    # DataManager ya entrega columnas numéricas compactas: no hace falta convertirlas
+    x = df.columns[0]
+    dates = pd.api.types.is_datetime64_any_dtype(df[x])
+    if dates:
+        df = df.assign(**{x: _epoch_ms(df[x])})
+
     fig = px.line(
-        df_plot, 
-        x=df_plot.columns[0],
-        y=df_plot.columns[1:],
+        df, 
+        x=x,
+        y=df.columns[1:],
         template="plotly_white",)
+
+    # Las fechas viajan como milisegundos en un array tipado; el eje las muestra como fechas
+    if dates:
+        fig.update_xaxes(type="date")
     
     return fig
 
-def create_box_plot(df):
+@cached_figure
+def create_box_plot(df, yaxis_title="n_concepts"):
     if df.empty:
         return None
 
+    # Estadísticas precalculadas por dominio (una fila por caja)
+    if 'q1' in df.columns:
+        return create_box_plot_from_stats(df, yaxis_title)
+
     # Crear gráfica en plotly
     fig = px.box(
         df, 
@@ -154,6 +245,44 @@ def create_box_plot(df):
     
     return fig
 
+def create_box_plot_from_stats(df, yaxis_title="n_concepts"):
+    if df.empty:
+        return None
+
+    # Cajas dibujadas a partir de cuartiles y bigotes, sin puntos por persona
+    fig = go.Figure(go.Box(
+        x=df['domain'],
+        q1=df['q1'],
+        median=df['median'],
+        q3=df['q3'],
+        lowerfence=df['lowerfence'],
+        upperfence=df['upperfence'],
+        mean=df['mean'],
+        name='',
+        showlegend=False,
+    ))
+
+    # Muestra acotada de valores atípicos
+    outliers = df[['domain', 'outliers']].explode('outliers').dropna()
+    if not outliers.empty:
+        fig.add_trace(go.Scatter(
+            x=outliers['domain'],
+            y=outliers['outliers'],
+            mode='markers',
+            marker=dict(size=4, color='rgb(108, 142, 168)'),
+            name='Outliers',
+            showlegend=False,
+        ))
+
+    fig.update_layout(
+        template="plotly_white",
+        xaxis_title="domain",
+        yaxis_title=yaxis_title,
+    )
+
+    return fig
+
+@cached_figure
 def create_bar_chart(df):
     if df.empty:
         return None
@@ -165,4 +294,49 @@ def create_bar_chart(df):
         y = df.columns[1],
         template="plotly_white",)
     
-    return fig
\ No newline at end of file
+    return fig
+
+@cached_figure
+def create_timeline_chart(df):
+    if df.empty:
+        return None
+
+    # Un punto por evento, una fila por dominio; WebGL para historias largas
+    fig = px.scatter(
+        df.assign(event_date=_epoch_ms(df['event_date'])),
+        x='event_date',
+        y='domain',
+        color='domain',
+        hover_name='concept_name',
+        hover_data={'concept_id': True, 'domain': False},
+        render_mode='webgl',
+        template="plotly_white",)
+
+    fig.update_traces(marker=dict(size=7, opacity=0.7))
+    fig.update_layout(
+        showlegend=False,
+        xaxis=dict(type="date", title="Date"),
+        yaxis=dict(title="", categoryorder="array", categoryarray=list(df['domain'].cat.categories)[::-1]),
+    )
+
+    return fig
+
+# Sin cached_figure: los registros cambian en cada llamada y la figura nunca se reutilizaría
+def create_latency_histogram(df):
+    if df.empty:
+        return None
+
+    # Histograma de tiempos de una consulta, coloreado por origen del dato
+    fig = px.histogram(
+        df,
+        x='seconds',
+        color='source',
+        template="plotly_white",)
+
+    fig.update_layout(
+        xaxis_title="Seconds",
+        yaxis_title="Calls",
+        bargap=0.05,
+    )
+
+    return fig